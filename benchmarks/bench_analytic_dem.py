@@ -0,0 +1,56 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares building detector error models from the layout against stim's analysis of the circuit.
+
+For each distance and number of rounds, times `generate_analytic_detector_error_model`
+against `stim.Circuit.detector_error_model(decompose_errors=True)` on an already
+generated circuit, and against generating the circuit as well. Layouts are cached in
+both cases, as they are in a sweep. Run with `python benchmarks/bench_analytic_dem.py`.
+"""
+
+import timeit
+
+from stimcircuits.analytic_dem import generate_analytic_detector_error_model
+from stimcircuits.surface_code import generate_circuit
+
+NOISE = dict(
+    after_clifford_depolarization=0.001,
+    before_round_data_depolarization=0.001,
+    before_measure_flip_probability=0.001,
+    after_reset_flip_probability=0.001,
+)
+
+
+def _best(fn, repeat: int = 3) -> float:
+    return min(timeit.repeat(fn, number=1, repeat=repeat))
+
+
+def main() -> None:
+    print(f"{'task':>30} {'d':>4} {'rounds':>6} {'stim dem (s)':>13} {'+ generate (s)':>15} "
+          f"{'analytic (s)':>13} {'speedup':>8}")
+    for code_task in ("surface_code:rotated_memory_z", "surface_code:unrotated_memory_x"):
+        for d, rounds in ((15, 15), (31, 31), (31, 300), (51, 51)):
+            kwargs = dict(distance=d, rounds=rounds, **NOISE)
+            circuit = generate_circuit(code_task, **kwargs)
+            stim_dem = _best(lambda: circuit.detector_error_model(decompose_errors=True))
+            stim_total = _best(lambda: generate_circuit(code_task, **kwargs).detector_error_model(
+                decompose_errors=True))
+            analytic = _best(lambda: generate_analytic_detector_error_model(code_task, **kwargs))
+            print(f"{code_task:>30} {d:>4} {rounds:>6} {stim_dem:>13.3f} {stim_total:>15.3f} "
+                  f"{analytic:>13.3f} {stim_dem / analytic:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
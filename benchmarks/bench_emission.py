@@ -0,0 +1,60 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares bulk (program text) emission of circuits against appending instructions one by one.
+
+Run with `python benchmarks/bench_emission.py`.
+"""
+
+import timeit
+
+from stimcircuits.surface_code import (
+    CircuitGenParameters,
+    _circuit_from_layout,
+    _rotated_surface_code_layout,
+    _unrotated_surface_or_toric_code_layout,
+)
+
+
+def main() -> None:
+    print(f"{'layout':>10} {'d':>4} {'append (s)':>12} {'bulk (s)':>12} {'speedup':>8}")
+    for name, make_layout in [
+        ("rotated", lambda d: _rotated_surface_code_layout(d, d)),
+        ("toric", lambda d: _unrotated_surface_or_toric_code_layout(d, is_toric=True)),
+    ]:
+        for d in (3, 7, 15, 25, 51):
+            layout = make_layout(d)
+            params = CircuitGenParameters(
+                code_name="surface_code",
+                task="rotated_memory_x",
+                rounds=d,
+                distance=d,
+                after_clifford_depolarization=0.001,
+                before_round_data_depolarization=0.001,
+                before_measure_flip_probability=0.001,
+                after_reset_flip_probability=0.001
+            )
+            times = {}
+            for bulk in (False, True):
+                repeats = max(1, 200 // d ** 2)
+                times[bulk] = min(timeit.repeat(
+                    lambda: _circuit_from_layout(layout, params, True, bulk=bulk),
+                    number=repeats,
+                    repeat=3
+                )) / repeats
+            print(f"{name:>10} {d:>4} {times[False]:>12.5f} {times[True]:>12.5f} {times[False] / times[True]:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compares `generate_circuits` on a pool of processes against a serial loop over `generate_circuit`.
+
+The grid sweeps distances, rounds and noise strengths, with layouts cached as in a real
+sweep. The speedup is bounded by the number of CPUs, so run this on a multi-core
+machine: `python benchmarks/bench_generate_circuits.py --workers 8`.
+"""
+
+import argparse
+import os
+import time
+
+from stimcircuits.surface_code import generate_circuit, generate_circuits, layout_cache
+
+
+def _grid(distances, noise_levels):
+    return [
+        dict(code_task=code_task, distance=d, rounds=d, after_clifford_depolarization=p,
+             before_round_data_depolarization=p, before_measure_flip_probability=p, after_reset_flip_probability=p)
+        for code_task in ("surface_code:rotated_memory_x", "surface_code:unrotated_memory_z")
+        for d in distances
+        for p in noise_levels
+    ]
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--distances", type=int, nargs="+", default=[5, 9, 15, 21])
+    parser.add_argument("--noise-levels", type=float, nargs="+", default=[0.001, 0.002, 0.005, 0.01])
+    args = parser.parse_args()
+    specs = _grid(args.distances, args.noise_levels)
+
+    layout_cache.clear()
+    start = time.perf_counter()
+    serial = [generate_circuit(**spec) for spec in specs]
+    serial_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    parallel = generate_circuits(specs, workers=args.workers)
+    parallel_seconds = time.perf_counter() - start
+
+    assert parallel == serial
+    print(f"{len(specs)} circuits, {os.cpu_count()} CPUs, {args.workers} workers")
+    print(f"serial loop over generate_circuit: {serial_seconds:.3f}s")
+    print(f"generate_circuits:                 {parallel_seconds:.3f}s ({serial_seconds / parallel_seconds:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
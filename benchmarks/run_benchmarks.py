@@ -0,0 +1,177 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Times circuit generation and the stim analysis that usually follows it.
+
+For every code task, distance, number of rounds and noise setting in the grid, this
+times `generate_circuit`, `stim.Circuit.detector_error_model(decompose_errors=True)`
+and `stim.Circuit.compile_detector_sampler`, and writes the results to a JSON file.
+Comparing two such files highlights performance regressions between versions:
+
+    python benchmarks/run_benchmarks.py --output before.json
+    # ... change the code ...
+    python benchmarks/run_benchmarks.py --output after.json --compare before.json
+
+The default grid is small enough to run in a few minutes. Use `--distances 3 5 ... 51`
+and `--rounds-per-distance 0 1 10` for the full grid (rounds of 0 mean one round).
+"""
+
+import argparse
+import datetime
+import json
+import platform
+import subprocess
+import time
+from typing import Any, Callable, Dict, List, Optional
+
+import stim
+
+from stimcircuits.surface_code import generate_circuit, layout_cache
+
+CODE_TASKS = [
+    "surface_code:rotated_memory_x",
+    "surface_code:rotated_memory_z",
+    "surface_code:unrotated_memory_x",
+    "surface_code:unrotated_memory_z",
+    "toric_code:unrotated_memory_x",
+    "toric_code:unrotated_memory_z",
+]
+
+STAGES = ["generate", "detector_error_model", "compile_detector_sampler"]
+
+
+def _time(fn: Callable[[], Any], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def _git_revision() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(
+        distances: List[int],
+        rounds_per_distance: List[int],
+        noise_levels: List[float],
+        stages: List[str],
+        repeat: int,
+        max_dem_detectors: int
+) -> List[Dict[str, Any]]:
+    results = []
+    for code_task in CODE_TASKS:
+        for d in distances:
+            for rounds in sorted({max(1, k * d) for k in rounds_per_distance}):
+                for p in noise_levels:
+                    kwargs = dict(
+                        code_task=code_task,
+                        distance=d,
+                        rounds=rounds,
+                        after_clifford_depolarization=p,
+                        before_round_data_depolarization=p,
+                        before_measure_flip_probability=p,
+                        after_reset_flip_probability=p,
+                    )
+                    # Time generation without the benefit of a warm layout cache.
+                    layout_cache.clear()
+                    record: Dict[str, Any] = dict(code_task=code_task, distance=d, rounds=rounds, noise=p)
+                    circuit = generate_circuit(**kwargs)
+                    record["num_qubits"] = circuit.num_qubits
+                    record["num_detectors"] = circuit.num_detectors
+                    record["num_instructions"] = len(circuit.flattened())
+                    timings: Dict[str, float] = {}
+                    if "generate" in stages:
+                        timings["generate"] = _time(lambda: (layout_cache.clear(), generate_circuit(**kwargs)), repeat)
+                    if "detector_error_model" in stages and circuit.num_detectors <= max_dem_detectors:
+                        timings["detector_error_model"] = _time(
+                            lambda: circuit.detector_error_model(decompose_errors=True), repeat)
+                    if "compile_detector_sampler" in stages:
+                        timings["compile_detector_sampler"] = _time(circuit.compile_detector_sampler, repeat)
+                    record["seconds"] = timings
+                    results.append(record)
+                    print(json.dumps(record), flush=True)
+    return results
+
+
+def _key(record: Dict[str, Any]) -> tuple:
+    return record["code_task"], record["distance"], record["rounds"], record["noise"]
+
+
+def compare(results: List[Dict[str, Any]], baseline: List[Dict[str, Any]], threshold: float) -> int:
+    """Prints the stages that got slower than the baseline by more than `threshold` and counts them."""
+    baseline_by_key = {_key(r): r for r in baseline}
+    regressions = 0
+    for record in results:
+        old = baseline_by_key.get(_key(record))
+        if old is None:
+            continue
+        for stage, seconds in record["seconds"].items():
+            old_seconds = old["seconds"].get(stage)
+            if old_seconds and seconds / old_seconds > threshold:
+                regressions += 1
+                print(f"REGRESSION {stage} {_key(record)}: {old_seconds:.4g}s -> {seconds:.4g}s "
+                      f"({seconds / old_seconds:.2f}x)")
+    return regressions
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--distances", type=int, nargs="+", default=[3, 5, 11, 25])
+    parser.add_argument("--rounds-per-distance", type=int, nargs="+", default=[0, 1, 3],
+                        help="Rounds are these multiples of the distance (0 means a single round).")
+    parser.add_argument("--noise", type=float, nargs="+", default=[0.0, 0.001],
+                        help="Noise strengths, with 0 meaning a noiseless circuit.")
+    parser.add_argument("--stages", nargs="+", choices=STAGES, default=STAGES)
+    parser.add_argument("--repeat", type=int, default=3, help="Each timing is the best of this many runs.")
+    parser.add_argument("--max-dem-detectors", type=int, default=200_000,
+                        help="Skip detector error models of circuits with more detectors than this.")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", help="A previous output file to check for regressions against.")
+    parser.add_argument("--threshold", type=float, default=1.2,
+                        help="Slowdown ratio reported as a regression by --compare.")
+    args = parser.parse_args()
+
+    results = run(args.distances, args.rounds_per_distance, args.noise, args.stages, args.repeat,
+                  args.max_dem_detectors)
+    output = {
+        "metadata": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "git_revision": _git_revision(),
+            "stim_version": stim.__version__,
+            "python_version": platform.python_version(),
+            "platform": platform.platform(),
+            "repeat": args.repeat,
+        },
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(output, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        print(f"{regressions} regression(s) above {args.threshold}x")
+
+
+if __name__ == "__main__":
+    main()
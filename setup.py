@@ -4,5 +4,9 @@ setup(
     name='StimCircuits',
     packages=find_packages(),
     author='oscarhiggott',
-    install_requires=['stim', 'pytest']
+    install_requires=['stim', 'numpy', 'pytest'],
+    extras_require={'pymatching': ['pymatching']},
+    entry_points={
+        'console_scripts': ['stimcircuits=stimcircuits.cli:main'],
+    },
 )
@@ -1 +1,76 @@
-from stimcircuits.surface_code import generate_circuit
+# The public names are imported lazily, on first access, so that importing the package
+# (e.g. to run `python -m stimcircuits`) doesn't pay for importing stim and numpy.
+import importlib
+
+_EXPORTS = {
+    "DetectorErrorModelSlices": "stimcircuits.analytic_dem",
+    "generate_analytic_detector_error_model": "stimcircuits.analytic_dem",
+    "generate_detector_error_model_slices": "stimcircuits.analytic_dem",
+    "DiskCache": "stimcircuits.disk_cache",
+    "GenerationStats": "stimcircuits.instrumentation",
+    "HeterogeneousNoiseParameters": "stimcircuits.surface_code",
+    "LogicalErrorRateEstimate": "stimcircuits.estimation",
+    "PointEstimate": "stimcircuits.estimation",
+    "estimate_logical_error_rate": "stimcircuits.estimation",
+    "schedule_shots": "stimcircuits.estimation",
+    "wilson_interval": "stimcircuits.estimation",
+    "MatchingGraph": "stimcircuits.matching_graph",
+    "generate_matching_graph": "stimcircuits.matching_graph",
+    "matching_graph_from_dem": "stimcircuits.matching_graph",
+    "canonical_error_map": "stimcircuits.optimize",
+    "circuits_equivalent": "stimcircuits.optimize",
+    "detector_error_models_equivalent": "stimcircuits.optimize",
+    "optimize_circuit": "stimcircuits.optimize",
+    "compiled_detector_sampler": "stimcircuits.sampling",
+    "compiled_m2d_converter": "stimcircuits.sampling",
+    "sample_to_file": "stimcircuits.sampling",
+    "sampler_cache": "stimcircuits.sampling",
+    "generate_circuit": "stimcircuits.surface_code",
+    "generate_circuits": "stimcircuits.surface_code",
+    "generate_circuits_for_noise_grid": "stimcircuits.surface_code",
+    "generate_detector_error_model": "stimcircuits.surface_code",
+    "generate_detector_metadata": "stimcircuits.surface_code",
+    "generate_fragments": "stimcircuits.surface_code",
+    "generate_surface_or_toric_code_circuit_from_params": "stimcircuits.surface_code",
+    "get_layout": "stimcircuits.surface_code",
+    "fragments_cache": "stimcircuits.surface_code",
+    "SurfaceCodeFragments": "stimcircuits.surface_code",
+    "iter_grid_circuits": "stimcircuits.surface_code",
+    "iter_grid_metadata": "stimcircuits.surface_code",
+    "layout_cache": "stimcircuits.surface_code",
+    "write_circuit": "stimcircuits.surface_code",
+    "write_circuit_from_params": "stimcircuits.surface_code",
+}
+
+# The submodules, which are also imported on first access, so that e.g.
+# `stimcircuits.surface_code` works after a plain `import stimcircuits`.
+_SUBMODULES = (
+    "analytic_dem",
+    "cli",
+    "disk_cache",
+    "estimation",
+    "instrumentation",
+    "lru_cache",
+    "matching_graph",
+    "optimize",
+    "sampling",
+    "surface_code",
+)
+
+__all__ = sorted(_EXPORTS)
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f"{__name__}.{name}")
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(module), name)
+    # Cache the value, so that later accesses don't go through __getattr__.
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__) | set(_SUBMODULES))
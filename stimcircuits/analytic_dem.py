@@ -0,0 +1,700 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Builds the detector error models of generated circuits straight from their layouts.
+
+Every round of a memory experiment applies the same operations, so the effect of each
+error in a round only needs to be found once. X and Z errors on each qubit are
+propagated through the rest of a round (its H and four CNOT layers), and the effect of
+any other Pauli error is the XOR of the effects of its X and Z parts. An effect is a
+set of "flips", the measurement qubits whose measurement it flips in the round, and a
+"residue", the stabilizers and observables anticommuting with the errors it leaves on
+the data qubits, which flip every later measurement of them.
+
+A flip of measurement qubit a in round t flips its detector in round t, and a
+measurement whose result changes between rounds t and t + 1 (because it is either
+flipped or anticommutes with the residue, but not both) flips its detector in round
+t + 1. The detectors of the final data measurements act as a round `rounds` of the
+chosen basis stabilizers. As this is linear, the symptoms of every error of a round are
+found at once with NumPy.
+"""
+
+import math
+from dataclasses import dataclass
+from typing import List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import stim
+
+from stimcircuits.instrumentation import NULL_STATS
+from stimcircuits.surface_code import (
+    CircuitGenParameters,
+    SurfaceCodeLayout,
+    _check_params,
+    _detector_metadata_from_layout,
+    _layout_for_params,
+    _params_from_code_task,
+)
+
+# Pads rows of codes, sorting after every real code.
+_PAD = np.iinfo(np.int64).max
+# The Paulis of DEPOLARIZE2, as the Paulis on each of its two qubits (see `_round_errors`).
+_PAULIS_2 = [(a, b) for a in range(4) for b in range(4)][1:]
+
+
+def _depolarize1_probability(p: float) -> float:
+    # DEPOLARIZE1(p) is equivalent to independent X, Y and Z errors with this probability.
+    return 0.5 - 0.5 * math.sqrt(1 - 4 * p / 3)
+
+
+def _depolarize2_probability(p: float) -> float:
+    # DEPOLARIZE2(p) is equivalent to 15 independent two-qubit Pauli errors with this probability.
+    return 0.5 - 0.5 * (1 - 16 * p / 15) ** 0.125
+
+
+def _odd_codes(rows: np.ndarray, pad: int = _PAD) -> np.ndarray:
+    """Keeps the codes occurring an odd number of times in each row, sorted and padded with `pad`.
+
+    Negative codes and `_PAD` are ignored. This is the XOR of the sets of codes in each row.
+    """
+    valid = (rows >= 0) & (rows != _PAD)
+    return _odd_codes_by_row(np.nonzero(valid)[0], rows[valid], len(rows), pad)
+
+
+def _odd_codes_by_row(row_ids: np.ndarray, codes: np.ndarray, n: int, pad: int = _PAD) -> np.ndarray:
+    """Like `_odd_codes`, for the rows of n rows given as the row of each of their codes."""
+    span = int(codes.max(initial=0)) + 1
+    keys, counts = np.unique(row_ids * span + codes, return_counts=True)
+    keys = keys[counts % 2 == 1]
+    row_ids = keys // span
+    position = np.arange(len(keys)) - np.searchsorted(row_ids, row_ids)
+    out = np.full((n, int(position.max(initial=-1)) + 1), pad, dtype=np.int64)
+    out[row_ids, position] = keys % span
+    return out
+
+
+def _group_rows(rows: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Groups equal rows of non-negative codes (or `_PAD`), like `np.unique(rows, axis=0)`.
+
+    Rows are packed into as few int64 keys as their codes fit in, which is much faster
+    to sort than the rows themselves. Returns the index of the first row of each group,
+    and the group of each row.
+    """
+    n, width = rows.shape
+    if width == 0:
+        return np.zeros(min(n, 1), dtype=np.int64), np.zeros(n, dtype=np.int64)
+    values = np.where(rows == _PAD, -1, rows) + 1
+    bits = max(int(values.max(initial=0)).bit_length(), 1)
+    per_key = 63 // bits
+    keys = []
+    for start in range(0, width, per_key):
+        key = np.zeros(n, dtype=np.int64)
+        for column in values[:, start:start + per_key].T:
+            key = (key << bits) | column
+        keys.append(key)
+    # A stable sort, so the first row of each group comes first.
+    order = np.lexsort(keys[::-1])
+    is_start = np.ones(n, dtype=bool)
+    is_start[1:] = np.any([np.diff(key[order]) != 0 for key in keys], axis=0)
+    inverse = np.empty(n, dtype=np.int64)
+    inverse[order] = np.cumsum(is_start) - 1
+    return order[is_start], inverse
+
+
+class _RoundEffects:
+    """The effects of X and Z errors on each qubit, at each step of a round.
+
+    Step 0 is the start of the round, step 1 follows the first H, steps 2 to 5 follow
+    each CNOT layer, and step 6 follows the second H, just before the measurements.
+    Effects are rows of `codes`: the index of each flipped measurement, `m` plus the
+    index of each measurement anticommuting with the residue, and `2 * m` plus the index
+    of each anticommuting observable, padded with -1. `ids[step, pauli, qubit]` is the
+    row of the effect of an X (pauli 0) or Z (pauli 1) error, where row -1 is empty.
+    """
+
+    def __init__(self, layout: SurfaceCodeLayout, is_memory_x: bool):
+        self.layout = layout
+        m = len(layout.measurement_qubits)
+        self.num_measurements = m
+        n = int(layout.qubits.max()) + 1
+        measurement_qubits = layout.measurement_qubits
+
+        # The effects of X and Z errors just before measurement, as the rows `pauli * n + q`.
+        # On data qubits, they are the residues.
+        stabilizers = np.searchsorted(measurement_qubits, layout.stabilizer_qubits)
+        # X stabilizers detect Z errors, and Z stabilizers detect X errors.
+        stabilizer_paulis = np.isin(layout.stabilizer_qubits, layout.x_measurement_qubits).astype(np.int64)
+        neighbours = layout.stabilizer_neighbours
+        is_neighbour = neighbours != -1
+        observable = layout.x_observable if is_memory_x else layout.z_observable
+        observable_codes = 2 * m + np.repeat(np.arange(layout.num_patches), len(observable) // layout.num_patches)
+        owners = np.concatenate([
+            (stabilizer_paulis[:, np.newaxis] * n + neighbours)[is_neighbour],
+            (1 if is_memory_x else 0) * n + observable,
+            # An X error on a measurement qubit flips its result.
+            measurement_qubits,
+        ])
+        codes = np.concatenate([
+            np.broadcast_to((m + stabilizers)[:, np.newaxis], neighbours.shape)[is_neighbour],
+            observable_codes,
+            np.arange(m),
+        ])
+        after = _odd_codes_by_row(owners, codes, 2 * n, pad=-1).reshape(2, n, -1)
+        steps = [after]
+
+        # Work backwards through the second H, the CNOT layers and the first H.
+        x_measure = layout.x_measurement_qubits
+        operations = [None] + list(layout.cnot_targets) + [None]
+        for targets in reversed(operations):
+            if targets is None:
+                before = after.copy()
+                before[0, x_measure], before[1, x_measure] = after[1, x_measure], after[0, x_measure]
+            else:
+                c, t = targets.reshape(-1, 2).T
+                # X spreads from control to target, and Z from target to control.
+                x_c = _odd_codes(np.concatenate([after[0, c], after[0, t]], axis=1), pad=-1)
+                z_t = _odd_codes(np.concatenate([after[1, t], after[1, c]], axis=1), pad=-1)
+                width = max(after.shape[2], x_c.shape[1], z_t.shape[1])
+                before = np.pad(after, ((0, 0), (0, 0), (0, width - after.shape[2])), constant_values=-1)
+                before[0, c] = np.pad(x_c, ((0, 0), (0, width - x_c.shape[1])), constant_values=-1)
+                before[1, t] = np.pad(z_t, ((0, 0), (0, width - z_t.shape[1])), constant_values=-1)
+            steps.append(before)
+            after = before
+        steps.reverse()
+
+        # Number the distinct effects.
+        width = max(step.shape[2] for step in steps)
+        rows = np.concatenate([
+            np.pad(step, ((0, 0), (0, 0), (0, width - step.shape[2])), constant_values=-1).reshape(-1, width)
+            for step in steps
+        ])
+        first, inverse = _group_rows(np.where(rows == -1, _PAD, rows))
+        effects = rows[first]
+        nonempty = effects[:, 0] != -1 if width else np.zeros(len(first), dtype=bool)
+        numbers = np.where(nonempty, np.cumsum(nonempty) - 1, -1)
+        self.ids = numbers[inverse].reshape(len(steps), 2, n)
+        # The extra row at the end is the empty effect.
+        self.codes = np.full((int(np.count_nonzero(nonempty)) + 1, max(width, 1)), -1, dtype=np.int64)
+        self.codes[:-1, :width] = effects[nonempty]
+
+
+class _Errors:
+    """The error mechanisms of a round, as the effect rows of their X and Z parts."""
+
+    def __init__(self):
+        self.probabilities: List[np.ndarray] = []
+        self.x_rows: List[np.ndarray] = []
+        self.z_rows: List[np.ndarray] = []
+
+    def add(self, p: float, x_rows: np.ndarray, z_rows: np.ndarray) -> None:
+        self.probabilities.append(np.full(len(x_rows), p))
+        self.x_rows.append(x_rows.reshape(len(x_rows), -1))
+        self.z_rows.append(z_rows.reshape(len(z_rows), -1))
+
+    def arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        width = max([rows.shape[1] for rows in self.x_rows + self.z_rows], default=1)
+
+        def stack(parts: List[np.ndarray]) -> np.ndarray:
+            if not parts:
+                return np.full((0, width), -1, dtype=np.int64)
+            return np.concatenate([np.pad(p, ((0, 0), (0, width - p.shape[1])), constant_values=-1) for p in parts])
+
+        probabilities = np.concatenate(self.probabilities) if self.probabilities else np.zeros(0)
+        return probabilities, stack(self.x_rows), stack(self.z_rows)
+
+
+def _round_errors(
+        effects: _RoundEffects,
+        params: CircuitGenParameters,
+        is_memory_x: bool
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Lists the probability of every error mechanism of a round, and the effect rows of its X and Z parts.
+
+    The first round also has the errors of `_initial_errors`.
+    """
+    layout = effects.layout
+    ids = effects.ids
+    errors = _Errors()
+
+    def single(p: float, step: int, qubits: np.ndarray, pauli: int) -> None:
+        if pauli == 0:
+            errors.add(p, ids[step, 0, qubits], np.full(len(qubits), -1))
+        elif pauli == 1:
+            errors.add(p, np.full(len(qubits), -1), ids[step, 1, qubits])
+        else:
+            errors.add(p, ids[step, 0, qubits], ids[step, 1, qubits])
+
+    p_reset = params.after_reset_flip_probability
+    if p_reset > 0:
+        # The flips after the reset of the measurement qubits, at the end of the previous round.
+        single(p_reset, 0, layout.measurement_qubits, 0)
+    p_data = params.before_round_data_depolarization
+    if p_data > 0:
+        for pauli in range(3):
+            single(_depolarize1_probability(p_data), 0, layout.data_qubits, pauli)
+    p_clifford = params.after_clifford_depolarization
+    if p_clifford > 0:
+        q1 = _depolarize1_probability(p_clifford)
+        q2 = _depolarize2_probability(p_clifford)
+        for step in (1, 6):
+            for pauli in range(3):
+                single(q1, step, layout.x_measurement_qubits, pauli)
+        for layer, targets in enumerate(layout.cnot_targets):
+            pairs = targets.reshape(-1, 2)
+            c, t = pairs[:, 0], pairs[:, 1]
+            for a, b in _PAULIS_2:
+                # Bit 0 of a Pauli is its X part and bit 1 its Z part, so 3 is Y.
+                x_rows = np.stack([ids[2 + layer, 0, c] if a & 1 else np.full(len(c), -1),
+                                   ids[2 + layer, 0, t] if b & 1 else np.full(len(c), -1)], axis=1)
+                z_rows = np.stack([ids[2 + layer, 1, c] if a & 2 else np.full(len(c), -1),
+                                   ids[2 + layer, 1, t] if b & 2 else np.full(len(c), -1)], axis=1)
+                errors.add(q2, x_rows, z_rows)
+    p_measure = params.before_measure_flip_probability
+    if p_measure > 0:
+        single(p_measure, 6, layout.measurement_qubits, 0)
+    return errors.arrays()
+
+
+def _initial_errors(
+        effects: _RoundEffects,
+        params: CircuitGenParameters,
+        is_memory_x: bool
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # The flips after the reset of the data qubits, at the start of the circuit.
+    data_qubits = effects.layout.data_qubits
+    p = params.after_reset_flip_probability
+    if p == 0:
+        data_qubits = data_qubits[:0]
+    rows = effects.ids[0, 1 if is_memory_x else 0, data_qubits].reshape(-1, 1)
+    return np.full(len(rows), float(p)), rows, np.full_like(rows, -1)
+
+
+def _reduced_errors(
+        effects: _RoundEffects,
+        probabilities: np.ndarray,
+        x_rows: np.ndarray,
+        z_rows: np.ndarray
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Merges the errors whose X parts, and Z parts, have the same effects.
+
+    These have the same symptoms, and decomposition, in every round. Each column of
+    `probabilities` is merged separately. Returns the merged probabilities and the
+    effect codes of the X and Z parts of each merged error, padded with -1.
+    """
+    def effects_of(rows: np.ndarray) -> np.ndarray:
+        return _odd_codes(effects.codes[rows].reshape(len(rows), rows.shape[1] * effects.codes.shape[1]))
+
+    x_effects = effects_of(x_rows)
+    z_effects = effects_of(z_rows)
+    first, inverse = _group_rows(np.concatenate([x_effects, z_effects], axis=1))
+    parity = np.ones((len(first), probabilities.shape[1]))
+    np.multiply.at(parity, inverse, 1 - 2 * probabilities)
+
+    def padded(codes: np.ndarray) -> np.ndarray:
+        return np.where(codes == _PAD, -1, codes)
+
+    return (1 - parity) / 2, padded(x_effects[first]), padded(z_effects[first])
+
+
+class _DetectorIndex:
+    """Numbers the detectors of each round, as in `_detector_metadata_from_layout`."""
+
+    def __init__(self, layout: SurfaceCodeLayout, rounds: int, is_memory_x: bool, exclude_other_basis: bool):
+        self.rounds = rounds
+        measurement_qubits = layout.measurement_qubits
+        chosen = layout.stabilizer_qubits[layout.x_stabilizers if is_memory_x else layout.z_stabilizers]
+        # The index of the detector of each measurement qubit among those of the first
+        # (and final) round, and among those of the other rounds, or -1 if it has none.
+        self.boundary = np.full(len(measurement_qubits), -1, dtype=np.int64)
+        self.boundary[np.searchsorted(measurement_qubits, chosen)] = np.arange(len(chosen))
+        is_chosen = layout.measurement_is_x if is_memory_x else ~layout.measurement_is_x
+        if exclude_other_basis:
+            self.bulk = np.where(is_chosen, np.cumsum(is_chosen) - 1, -1)
+        else:
+            self.bulk = np.arange(len(measurement_qubits), dtype=np.int64)
+        self.num_boundary = len(chosen)
+        self.num_bulk = int(np.count_nonzero(self.bulk != -1))
+        self.num_detectors = 2 * self.num_boundary + (rounds - 1) * self.num_bulk
+
+    def round_detectors(self, t: int) -> np.ndarray:
+        """The detector of each measurement qubit in round t, or -1 if it has none."""
+        if t == 0 or t == self.rounds:
+            k = self.boundary
+            offset = 0 if t == 0 else self.num_boundary + (self.rounds - 1) * self.num_bulk
+        elif 0 < t < self.rounds:
+            k = self.bulk
+            offset = self.num_boundary + (t - 1) * self.num_bulk
+        else:
+            return np.full(len(self.bulk), -1, dtype=np.int64)
+        return np.where(k == -1, -1, k + offset)
+
+
+def _symptom_map(index: _DetectorIndex, num_observables: int, t: Optional[int], final: bool = False) -> np.ndarray:
+    """Maps each effect code of an error in round t to the (up to two) symptoms it toggles.
+
+    Symptoms are detector indices, or `index.num_detectors` plus an observable index.
+    With `final`, maps the residues of errors just before the final data measurements.
+    The last row maps the padding code -1 to nothing.
+    """
+    m = len(index.bulk)
+    symptoms = np.full((2 * m + num_observables + 1, 2), -1, dtype=np.int64)
+    if final:
+        symptoms[m:2 * m, 0] = index.round_detectors(index.rounds)
+    else:
+        symptoms[:m, 0] = index.round_detectors(t)
+        symptoms[:m, 1] = index.round_detectors(t + 1)
+        symptoms[m:2 * m, 0] = index.round_detectors(t + 1)
+    symptoms[2 * m:2 * m + num_observables, 0] = index.num_detectors + np.arange(num_observables)
+    return symptoms
+
+
+class _MergedErrors(NamedTuple):
+    """The errors of a round with distinct symptoms, as rows of symptoms padded with `_PAD`.
+
+    Symptoms are detector indices, or the number of detectors plus an observable index.
+    Errors are decomposed into the symptoms of their X and Z parts where `split`.
+    """
+    probabilities: np.ndarray
+    symptoms: np.ndarray
+    x_symptoms: np.ndarray
+    z_symptoms: np.ndarray
+    split: np.ndarray
+
+
+def _merged_errors(
+        errors: Tuple[np.ndarray, np.ndarray, np.ndarray],
+        symptom_map: np.ndarray,
+        num_detectors: int
+) -> _MergedErrors:
+    """Merges the errors of a round (see `_reduced_errors`) with the same symptoms.
+
+    Each error is decomposed into the symptoms of its X and Z parts, when both flip
+    detectors. Errors without symptoms, or that never occur, are left out.
+    """
+    probabilities, x_effects, z_effects = errors
+
+    def symptoms(effects: np.ndarray) -> np.ndarray:
+        return _odd_codes(symptom_map[effects].reshape(len(effects), 2 * effects.shape[1]))
+
+    x_symptoms = symptoms(x_effects)
+    z_symptoms = symptoms(z_effects)
+    total = _odd_codes(np.concatenate([x_symptoms, z_symptoms], axis=1))
+    first, inverse = _group_rows(total)
+    parity = np.ones(len(first))
+    np.multiply.at(parity, inverse, 1 - 2 * probabilities)
+    merged = (1 - parity) / 2
+
+    def has_detectors(codes: np.ndarray) -> np.ndarray:
+        return np.any(codes < num_detectors, axis=1)
+
+    order = np.sort(first)
+    if total.shape[1]:
+        order = order[total[order, 0] != _PAD]
+    else:
+        order = order[:0]
+    order = order[merged[inverse[order]] > 0]
+    return _MergedErrors(
+        probabilities=merged[inverse[order]],
+        symptoms=total[order],
+        x_symptoms=x_symptoms[order],
+        z_symptoms=z_symptoms[order],
+        split=has_detectors(x_symptoms[order]) & has_detectors(z_symptoms[order]),
+    )
+
+
+def _error_lines(errors: _MergedErrors, num_detectors: int, num_observables: int, shift: int) -> List[str]:
+    tokens = np.array([f"D{c - shift}" for c in range(num_detectors)]
+                      + [f"L{k}" for k in range(num_observables)] + [""], dtype=object)
+
+    def components(rows: np.ndarray) -> np.ndarray:
+        # Formats each row of symptoms, a column at a time.
+        text = np.full(len(rows), "", dtype=object)
+        for column in np.where(rows == _PAD, -1, rows).T:
+            text = np.where(column == -1, text, text + " " + tokens[column])
+        return text
+
+    split = errors.split
+    targets = components(errors.symptoms)
+    targets[split] = components(errors.x_symptoms[split]) + " ^" + components(errors.z_symptoms[split])
+    # Few errors have distinct probabilities, so each is formatted once.
+    values, value_index = np.unique(errors.probabilities, return_inverse=True)
+    heads = np.array([f"error({p!r})" for p in values.tolist()], dtype=object)
+    return (heads[value_index] + targets).tolist()
+
+
+def _edges(errors: _MergedErrors, num_detectors: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """The edges of the components of errors, as for `stimcircuits.matching_graph`.
+
+    Returns an (n, 2) array of the detectors of each component with detectors (with -1 for
+    a missing second detector), its probability and a bitmask of its observables.
+    """
+    split = errors.split
+    width = max(errors.symptoms.shape[1], errors.x_symptoms.shape[1], errors.z_symptoms.shape[1], 2)
+
+    def padded(rows: np.ndarray) -> np.ndarray:
+        return np.pad(rows, ((0, 0), (0, width - rows.shape[1])), constant_values=_PAD)
+
+    rows = np.concatenate([padded(errors.symptoms[~split]), padded(errors.x_symptoms[split]),
+                           padded(errors.z_symptoms[split])])
+    probabilities = np.concatenate([errors.probabilities[~split]] + [errors.probabilities[split]] * 2)
+    is_detector = rows < num_detectors
+    counts = np.count_nonzero(is_detector, axis=1)
+    if np.any(counts > 2):
+        raise ValueError("An error isn't graphlike")
+    is_observable = ~is_detector & (rows != _PAD)
+    bits = np.where(is_observable, rows - num_detectors, 0).astype(np.uint64)
+    observables = np.bitwise_or.reduce(np.where(is_observable, np.left_shift(np.uint64(1), bits), np.uint64(0)),
+                                       axis=1)
+    # Detectors sort before observables, so are in the first columns.
+    nodes = np.full((len(rows), 2), -1, dtype=np.int64)
+    nodes[counts >= 1, 0] = rows[counts >= 1, 0]
+    nodes[counts == 2, 1] = rows[counts == 2, 1]
+    # Components without detectors can't be detected, so don't belong in the graph.
+    keep = counts > 0
+    return nodes[keep], probabilities[keep], observables[keep]
+
+
+def _final_measurement_errors(
+        effects: _RoundEffects,
+        params: CircuitGenParameters,
+        is_memory_x: bool
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    # The flips before the final data measurements only leave a residue.
+    data_qubits = effects.layout.data_qubits
+    p = params.before_measure_flip_probability
+    if p == 0:
+        data_qubits = data_qubits[:0]
+    rows = effects.ids[-1, 1 if is_memory_x else 0, data_qubits].reshape(-1, 1)
+    return np.full(len(rows), float(p)), rows, np.full_like(rows, -1)
+
+
+def _detector_lines(metadata: np.ndarray, start: int, stop: int, shift: int, t_shift: int) -> List[str]:
+    return [
+        f"detector({x}, {y}, {t - t_shift}) D{k - shift}"
+        for k, (x, y, t) in enumerate(zip(metadata["x"][start:stop].tolist(), metadata["y"][start:stop].tolist(),
+                                          metadata["round"][start:stop].tolist()), start)
+    ]
+
+
+class _Rounds:
+    """Formats the errors and detectors of the rounds of a memory experiment with `rounds` rounds."""
+
+    def __init__(self, params: CircuitGenParameters, rounds: int):
+        if type(params) is not CircuitGenParameters:
+            raise TypeError("Only the uniform noise of CircuitGenParameters is supported")
+        _check_params(params)
+        layout, is_memory_x = _layout_for_params(params, NULL_STATS)
+        exclude = params.exclude_other_basis_detectors
+        self.effects = _RoundEffects(layout, is_memory_x)
+        self.index = _DetectorIndex(layout, rounds, is_memory_x, exclude)
+        self.metadata = _detector_metadata_from_layout(layout, rounds, is_memory_x, exclude)
+        self.num_observables = layout.num_patches
+        # The errors of the first round are those of every round, plus the initial errors,
+        # so are merged together with a column of probabilities for each.
+        bulk = _round_errors(self.effects, params, is_memory_x)
+        initial = _initial_errors(self.effects, params, is_memory_x)
+        probabilities = np.zeros((len(bulk[0]) + len(initial[0]), 2))
+        probabilities[:len(bulk[0])] = bulk[0][:, np.newaxis]
+        probabilities[len(bulk[0]):, 1] = initial[0]
+        width = max(bulk[1].shape[1], 1)
+        self.errors = _reduced_errors(
+            self.effects,
+            probabilities,
+            np.concatenate([bulk[1], np.pad(initial[1], ((0, 0), (0, width - 1)), constant_values=-1)]),
+            np.concatenate([bulk[2], np.pad(initial[2], ((0, 0), (0, width - 1)), constant_values=-1)]),
+        )
+        final = _final_measurement_errors(self.effects, params, is_memory_x)
+        self.final = _reduced_errors(self.effects, final[0][:, np.newaxis], final[1], final[2])
+
+    def merged_errors(self, t: int) -> _MergedErrors:
+        """The errors of round t, or of the final data measurements if t is `rounds`."""
+        if t == self.index.rounds:
+            probabilities, x_effects, z_effects = self.final
+            symptom_map = _symptom_map(self.index, self.num_observables, None, final=True)
+        else:
+            probabilities, x_effects, z_effects = self.errors
+            symptom_map = _symptom_map(self.index, self.num_observables, t)
+        column = 1 if t == 0 else 0
+        return _merged_errors((probabilities[:, column], x_effects, z_effects), symptom_map,
+                              self.index.num_detectors)
+
+    def error_lines(self, t: int, shift: int) -> List[str]:
+        return _error_lines(self.merged_errors(t), self.index.num_detectors, self.num_observables, shift)
+
+    def edges(self, t: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        return _edges(self.merged_errors(t), self.index.num_detectors)
+
+    def detector_lines(self, t: int, shift: int, t_shift: int) -> List[str]:
+        """The detectors of round t."""
+        n0, nb = self.index.num_boundary, self.index.num_bulk
+        start = 0 if t == 0 else n0 + (t - 1) * nb
+        stop = n0 if t == 0 else start + (n0 if t == self.index.rounds else nb)
+        return _detector_lines(self.metadata, start, stop, shift, t_shift)
+
+    def observable_lines(self) -> List[str]:
+        # Declared as stim does, so that every observable is counted even if no error flips it.
+        return [f"logical_observable L{k}" for k in range(self.num_observables)]
+
+
+def _dem_sections(params: CircuitGenParameters) -> Tuple[str, str, str]:
+    """The head, bulk and tail of the detector error models of experiments with at least two rounds.
+
+    Each but the tail ends by shifting the detectors past its own, so that the model with
+    r rounds is the head, then the bulk r - 2 times, then the tail. Their detectors are
+    those of the rounds of an experiment with three rounds. The tail declares the logical
+    observables.
+    """
+    model = _Rounds(params, 3)
+    n0, nb = model.index.num_boundary, model.index.num_bulk
+    head = model.error_lines(0, 0) + model.detector_lines(0, 0, 0) + [f"shift_detectors(0, 0, 1) {n0}"]
+    bulk = model.error_lines(1, n0) + model.detector_lines(1, n0, 1) + [f"shift_detectors(0, 0, 1) {nb}"]
+    tail = (model.error_lines(2, n0 + nb) + model.detector_lines(2, n0 + nb, 2)
+            + model.error_lines(3, n0 + nb) + model.detector_lines(3, n0 + nb, 2) + model.observable_lines())
+    return "\n".join(head), "\n".join(bulk), "\n".join(tail)
+
+
+def _dem_text(params: CircuitGenParameters) -> str:
+    rounds = params.rounds
+    if rounds == 1:
+        model = _Rounds(params, 1)
+        return "\n".join(model.error_lines(0, 0) + model.detector_lines(0, 0, 0)
+                         + model.error_lines(1, 0) + model.detector_lines(1, 0, 0) + model.observable_lines())
+    head, bulk, tail = _dem_sections(params)
+    # Rounds 1 to rounds - 2 have the same errors relative to their detectors, so are repeated.
+    if rounds - 2 >= 2:
+        middle = [f"repeat {rounds - 2} {{", "    " + bulk.replace("\n", "\n    "), "}"]
+    else:
+        middle = [bulk] * (rounds - 2)
+    return "\n".join([head] + middle + [tail])
+
+
+def _matching_graph_edges(params: CircuitGenParameters) -> Tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+    """The edges of the decomposed errors of a memory experiment, without building its detector error model.
+
+    Returns the number of detectors, and the detectors (with -1 for the boundary),
+    probability and observables of each error component with detectors, as for
+    `stimcircuits.matching_graph`. The edges of the middle rounds are tiled from those
+    of one round.
+    """
+    rounds = params.rounds
+    if rounds == 1:
+        model = _Rounds(params, 1)
+        parts = [model.edges(0), model.edges(1)]
+        offsets = [0, 0]
+    else:
+        model = _Rounds(params, 3)
+        nb = model.index.num_bulk
+        head, bulk, tail = model.edges(0), model.edges(1), model.edges(2)
+        final = model.edges(3)
+        # The detectors of the bulk and tail are those of an experiment with three rounds.
+        parts = [head] + [bulk] * (rounds - 2) + [tail, final]
+        offsets = [0] + [k * nb for k in range(rounds - 2)] + [(rounds - 3) * nb] * 2
+    nodes = np.concatenate([np.where(part[0] == -1, -1, part[0] + offset) for part, offset in zip(parts, offsets)])
+    probabilities = np.concatenate([part[1] for part in parts])
+    observables = np.concatenate([part[2] for part in parts])
+    num_detectors = 2 * model.index.num_boundary + (rounds - 1) * model.index.num_bulk
+    return num_detectors, nodes, probabilities, observables
+
+
+@dataclass(frozen=True)
+class DetectorErrorModelSlices:
+    """The head, bulk and tail of the detector error model of a memory experiment, which don't depend on its rounds.
+
+    The head has the errors and detectors of the first round, the bulk those of any
+    other round but the last, and the tail those of the last round and the final data
+    measurements. The errors of each slice also flip detectors of the next one, and each
+    slice ends by shifting the detectors (and time coordinate) past its own, so the model
+    with r rounds is `head + bulk * (r - 2) + tail`. The tail also declares the logical
+    observables, so windows without it only count the observables their errors flip.
+    """
+    head: stim.DetectorErrorModel
+    bulk: stim.DetectorErrorModel
+    tail: stim.DetectorErrorModel
+
+    def with_rounds(self, rounds: int) -> stim.DetectorErrorModel:
+        """The detector error model of the memory experiment with `rounds` rounds."""
+        if rounds < 2:
+            raise ValueError("Need rounds >= 2")
+        return self.window(rounds, head=True, tail=True)
+
+    def window(self, rounds: int, *, head: bool = False, tail: bool = False) -> stim.DetectorErrorModel:
+        """The detector error model of a window of consecutive rounds.
+
+        Args:
+            rounds: The number of rounds in the window.
+            head: Defaults to False. Whether the window starts with the first round.
+            tail: Defaults to False. Whether the window ends with the last round.
+
+        Returns:
+            The errors and detectors of the rounds in the window, with the detectors
+            numbered from the start of the window and the bulk rounds in a `repeat`
+            block. Unless `tail` is True, the errors of the last round of the window also
+            flip detectors of the round after it, which follow the window's detectors
+            and have no coordinates (a sliding-window decoder can treat them as a
+            boundary).
+        """
+        repeated = rounds - head - tail
+        if repeated < 0:
+            raise ValueError("The window needs a round for each of its head and tail")
+        dem = self.bulk * repeated
+        if head:
+            dem = self.head + dem
+        if tail:
+            dem += self.tail
+        return dem
+
+
+def generate_detector_error_model_slices(code_task: str, **kwargs) -> DetectorErrorModelSlices:
+    """Builds the slices that the detector error models of memory experiments with any number of rounds are made of.
+
+    Takes the same arguments as `generate_analytic_detector_error_model`, except for
+    `rounds`. The slices are built from the layout (see the module docstring), so a
+    window of rounds for a sliding-window decoder costs a concatenation rather than an
+    analysis of the whole circuit:
+
+        slices = generate_detector_error_model_slices("surface_code:rotated_memory_z", distance=5)
+        window = slices.window(10, head=True)
+
+    `slices.with_rounds(r)` has the same errors as `generate_analytic_detector_error_model`
+    with `rounds=r`.
+    """
+    head, bulk, tail = _dem_sections(_params_from_code_task(code_task, rounds=2, **kwargs))
+    return DetectorErrorModelSlices(
+        head=stim.DetectorErrorModel(head),
+        bulk=stim.DetectorErrorModel(bulk),
+        tail=stim.DetectorErrorModel(tail),
+    )
+
+
+def generate_analytic_detector_error_model(code_task: str, **kwargs) -> stim.DetectorErrorModel:
+    """Builds the decomposed detector error model of a generated circuit, without generating it.
+
+    The model is built from the layout of the code (see the module docstring), rather
+    than by stim's analysis of the circuit, so its cost doesn't grow with the number of
+    rounds: the rounds between the first and the last are written as a `repeat` block.
+    It has the same errors as
+    `generate_circuit(...).detector_error_model(decompose_errors=True)`, up to their
+    order and rounding (see `stimcircuits.optimize.detector_error_models_equivalent`).
+    Each error is decomposed into the symptoms of its X and Z parts, which may differ
+    from the (equally graphlike) decomposition stim picks.
+
+    Args:
+        code_task: The type of circuit, as for `generate_circuit`.
+        **kwargs: The remaining arguments of `generate_circuit`, e.g. `rounds`,
+            `distance` and the noise parameters.
+
+    Returns:
+        The detector error model.
+    """
+    return stim.DetectorErrorModel(_dem_text(_params_from_code_task(code_task, **kwargs)))
@@ -0,0 +1,223 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Writes generated circuits, and optionally their detector error models, to files.
+
+Generate a single circuit:
+
+    python -m stimcircuits --code-task surface_code:rotated_memory_z --distance 5 \\
+        --rounds 5 --after-clifford-depolarization 0.001 --output d5.stim --dem
+
+or every circuit listed in a JSON file (a list of objects) or CSV file (with a header
+row), whose fields are the keyword arguments of `stimcircuits.generate_circuit`:
+
+    python -m stimcircuits --grid grid.csv --output-dir circuits/ --jobs 8 --dem
+
+Grid circuits are written to `<name>.stim`, where `name` is the optional "name" field of
+the spec or else the content hash of its parameters. Each written path is printed.
+"""
+
+# Only the standard library is imported at module level, so that starting up and
+# parsing arguments stays cheap. stim, numpy and the generators are imported once a
+# circuit actually needs generating.
+import argparse
+import csv
+import json
+import os
+import sys
+from typing import Any, Dict, List, Optional, Sequence
+
+_INT_FIELDS = ("rounds", "distance", "x_distance", "z_distance", "patches")
+_FLOAT_FIELDS = (
+    "after_clifford_depolarization",
+    "before_round_data_depolarization",
+    "before_measure_flip_probability",
+    "after_reset_flip_probability",
+)
+_BOOL_FIELDS = ("exclude_other_basis_detectors",)
+
+
+def _parse_bool(value: str) -> bool:
+    lowered = value.strip().lower()
+    if lowered in ("1", "true", "yes"):
+        return True
+    if lowered in ("", "0", "false", "no"):
+        return False
+    raise ValueError(f"Not a boolean: {value!r}")
+
+
+def _positive_int(value: str) -> int:
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {number}")
+    return number
+
+
+def _normalize_spec(spec: Dict[str, Any]) -> Dict[str, Any]:
+    """Converts the fields of a spec to their expected types, dropping empty fields."""
+    result: Dict[str, Any] = {}
+    for key, value in spec.items():
+        if value is None or value == "":
+            continue
+        if key in _INT_FIELDS:
+            value = int(value)
+        elif key in _FLOAT_FIELDS:
+            value = float(value)
+        elif key in _BOOL_FIELDS and isinstance(value, str):
+            value = _parse_bool(value)
+        elif key not in ("code_task", "name"):
+            raise ValueError(f"Unrecognised field {key!r}")
+        result[key] = value
+    if "code_task" not in result:
+        raise ValueError("Every spec needs a code_task")
+    if "rounds" not in result:
+        raise ValueError("Every spec needs rounds")
+    if "distance" not in result and ("x_distance" not in result or "z_distance" not in result):
+        raise ValueError("Every spec needs a distance, or an x_distance and a z_distance")
+    return result
+
+
+def read_grid(path: str) -> List[Dict[str, Any]]:
+    """Reads a list of specs from a JSON file (a list of objects) or CSV file."""
+    with open(path, newline="") as f:
+        if path.endswith(".csv"):
+            specs = list(csv.DictReader(f))
+        else:
+            specs = json.load(f)
+    return [_normalize_spec(spec) for spec in specs]
+
+
+def _write_text(path: str, text: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+def write_spec(spec: Dict[str, Any], stim_path: str, dem: bool) -> List[str]:
+    """Generates the circuit of `spec`, writing it to `stim_path` and returning the paths written."""
+    import stim
+    from stimcircuits.surface_code import write_circuit
+
+    kwargs = {k: v for k, v in spec.items() if k != "name"}
+    # Streamed with full precision, unlike str(stim.Circuit), which rounds probabilities.
+    tmp_path = stim_path + ".tmp"
+    write_circuit(file=tmp_path, **kwargs)
+    os.replace(tmp_path, stim_path)
+    written = [stim_path]
+    if dem:
+        dem_path = os.path.splitext(stim_path)[0] + ".dem"
+        model = stim.Circuit.from_file(stim_path).detector_error_model(decompose_errors=True)
+        _write_text(dem_path, str(model) + "\n")
+        written.append(dem_path)
+    return written
+
+
+def _grid_output_path(spec: Dict[str, Any], output_dir: str) -> str:
+    name = spec.get("name")
+    if name is None:
+        from stimcircuits.surface_code import _params_from_code_task
+        kwargs = {k: v for k, v in spec.items() if k != "name"}
+        name = _params_from_code_task(**kwargs).content_hash()
+    return os.path.join(output_dir, f"{name}.stim")
+
+
+def check_output_paths(specs: List[Dict[str, Any]], output_dir: str) -> None:
+    """Raises ValueError if two specs would be written to the same file."""
+    seen = set()
+    for spec in specs:
+        path = _grid_output_path(spec, output_dir)
+        if path in seen:
+            raise ValueError(f"More than one spec would be written to {path}. Give them distinct names.")
+        seen.add(path)
+
+
+def _write_grid_entry(args: tuple) -> List[str]:
+    spec, output_dir, dem = args
+    return write_spec(spec, _grid_output_path(spec, output_dir), dem)
+
+
+def write_grid(specs: List[Dict[str, Any]], output_dir: str, *, dem: bool = False, jobs: int = 1):
+    """Writes the circuit of every spec to `output_dir`, yielding the paths written in order."""
+    # Specs written to the same file would race on its temporary file.
+    check_output_paths(specs, output_dir)
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(spec, output_dir, dem) for spec in specs]
+    if jobs == 1 or len(tasks) <= 1:
+        for task in tasks:
+            yield _write_grid_entry(task)
+        return
+    import concurrent.futures
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as pool:
+        yield from pool.map(_write_grid_entry, tasks)
+
+
+def _build_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        prog="stimcircuits",
+        description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    spec = parser.add_argument_group("single circuit")
+    spec.add_argument("--code-task", help='E.g. "surface_code:rotated_memory_x".')
+    for name in _INT_FIELDS:
+        spec.add_argument("--" + name.replace("_", "-"), type=int)
+    for name in _FLOAT_FIELDS:
+        spec.add_argument("--" + name.replace("_", "-"), type=float)
+    spec.add_argument("--exclude-other-basis-detectors", action="store_true")
+    spec.add_argument("--output", "-o", help="The .stim file to write. Defaults to stdout.")
+
+    grid = parser.add_argument_group("grid of circuits")
+    grid.add_argument("--grid", help="A .json or .csv file listing the circuits to generate.")
+    grid.add_argument("--output-dir", default=".", help="Where grid circuits are written.")
+    grid.add_argument("--jobs", "-j", type=_positive_int, default=1,
+                      help="The number of processes to generate grid circuits with.")
+
+    parser.add_argument("--dem", action="store_true",
+                        help="Also write the decomposed detector error model of each circuit as a .dem file.")
+    return parser
+
+
+def main(argv: Optional[Sequence[str]] = None) -> int:
+    parser = _build_parser()
+    args = parser.parse_args(argv)
+
+    if args.grid is not None:
+        if args.code_task is not None:
+            parser.error("--grid and --code-task can't be used together")
+        try:
+            specs = read_grid(args.grid)
+            check_output_paths(specs, args.output_dir)
+        except ValueError as e:
+            parser.error(f"{args.grid}: {e}")
+        for paths in write_grid(specs, args.output_dir, dem=args.dem, jobs=args.jobs):
+            print(*paths, sep="\n")
+        return 0
+
+    if args.code_task is None:
+        parser.error("either --code-task or --grid is required")
+    if args.rounds is None:
+        parser.error("--rounds is required")
+    spec = {"code_task": args.code_task, "exclude_other_basis_detectors": args.exclude_other_basis_detectors}
+    for name in _INT_FIELDS + _FLOAT_FIELDS:
+        if getattr(args, name) is not None:
+            spec[name] = getattr(args, name)
+    if args.output is None:
+        if args.dem:
+            parser.error("--dem needs --output")
+        from stimcircuits.surface_code import write_circuit
+        write_circuit(file=sys.stdout, **spec)
+        return 0
+    print(*write_spec(spec, args.output, args.dem), sep="\n")
+    return 0
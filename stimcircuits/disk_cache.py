@@ -0,0 +1,190 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import os
+import re
+import tempfile
+import time
+from typing import BinaryIO, Callable, List, Optional, Tuple, Union
+
+import stim
+
+DEFAULT_MAX_BYTES = 2 ** 30
+
+# Temporary files older than this are assumed to belong to a writer that died.
+_STALE_TEMP_SECONDS = 3600
+_TEMP_PREFIX = ".stimcircuits-tmp-"
+# Entry filenames start with a key from `entry_key` (a SHA-256 hex digest) and a suffix.
+# Only files matching this (and the cache's own temporary files) are ever evicted or
+# cleared, so the cache can share a directory with other files.
+_ENTRY_FILENAME = re.compile(r"[0-9a-f]{64}\.[^/\\]+")
+# The most writes between scans of the cache directory, which catch up with the entries
+# other processes have written or removed since the last scan.
+_PUTS_PER_SCAN = 64
+
+
+class DiskCache:
+    """A content-addressed on-disk cache of generated circuits and detector error models.
+
+    Entries are keyed by a hash of the canonical generation parameters and the stim
+    version, and are stored as plain text files, e.g. `<key>.stim` and `<key>.dem`. Other
+    files in `cache_dir` are left alone.
+
+    Writes go to a temporary file which is then atomically renamed into place, so
+    several processes can read and write the same cache directory concurrently: a
+    reader either sees a complete entry or none at all. Once the total size of the
+    entries exceeds `max_bytes`, the least recently used entries are deleted.
+
+    Rather than scanning the directory on every write, the cache keeps a running total of
+    the size of the entries, which is brought up to date by a scan whenever it exceeds
+    `max_bytes`, and at least once every 64 writes to account for other processes.
+    """
+
+    def __init__(self, cache_dir: Union[str, os.PathLike], max_bytes: Optional[int] = DEFAULT_MAX_BYTES):
+        self.cache_dir = os.fspath(cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # The total size of the entries as of the last scan, plus those written since, or
+        # None before the first scan.
+        self._bytes: Optional[int] = None
+        self._puts_since_scan = 0
+
+    def entry_key(self, params) -> str:
+        """The key of the entries generated from `params` (a `CircuitGenParameters`)."""
+        content = f"stim={stim.__version__}\n{params.canonical_json()}"
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get_text(self, filename: str) -> Optional[str]:
+        path = os.path.join(self.cache_dir, filename)
+        try:
+            with open(path, "r") as f:
+                text = f.read()
+        except FileNotFoundError:
+            return None
+        _touch(path)
+        return text
+
+    def get_path(self, filename: str) -> Optional[str]:
+        """The path of an entry, or None if it isn't cached. Marks the entry as recently used."""
+        path = os.path.join(self.cache_dir, filename)
+        if not os.path.isfile(path):
+            return None
+        _touch(path)
+        return path
+
+    def put_text(self, filename: str, text: str) -> None:
+        self.put_file(filename, lambda f: f.write(text.encode("utf-8")))
+
+    def put_file(self, filename: str, write: Callable[[BinaryIO], None]) -> None:
+        """Atomically creates an entry, whose contents are written by `write(binary_file)`.
+
+        The filename must be an entry key followed by a suffix, e.g. `<key>.stim`.
+        """
+        if not _ENTRY_FILENAME.fullmatch(filename):
+            raise ValueError(f"Cache entry filenames must be an entry key and a suffix, got {filename!r}")
+        path = os.path.join(self.cache_dir, filename)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, prefix=_TEMP_PREFIX)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+                size = f.tell()
+            replaced = _size_if_present(path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+        if self.max_bytes is None:
+            return
+        self._puts_since_scan += 1
+        if self._bytes is not None:
+            self._bytes += size - replaced
+        if self._bytes is None or self._bytes > self.max_bytes or self._puts_since_scan >= _PUTS_PER_SCAN:
+            self.evict()
+
+    def get_or_create_text(self, filename: str, factory: Callable[[], str]) -> str:
+        text = self.get_text(filename)
+        if text is None:
+            text = factory()
+            self.put_text(filename, text)
+        return text
+
+    def _entries(self) -> List[Tuple[float, int, str]]:
+        entries = []
+        now = time.time()
+        with os.scandir(self.cache_dir) as it:
+            for entry in it:
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                if entry.name.startswith(_TEMP_PREFIX):
+                    if now - stat.st_mtime > _STALE_TEMP_SECONDS:
+                        _remove_if_present(entry.path)
+                    continue
+                if entry.is_file() and _ENTRY_FILENAME.fullmatch(entry.name):
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        return entries
+
+    def total_bytes(self) -> int:
+        return sum(size for _, size, _ in self._entries())
+
+    def evict(self) -> None:
+        """Deletes the least recently used entries until the cache fits in `max_bytes`."""
+        if self.max_bytes is None:
+            return
+        entries = self._entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            _remove_if_present(path)
+            total -= size
+        self._bytes = total
+        self._puts_since_scan = 0
+
+    def clear(self) -> None:
+        """Deletes every entry (but no other files in `cache_dir`)."""
+        for _, _, path in self._entries():
+            _remove_if_present(path)
+        self._bytes = 0
+        self._puts_since_scan = 0
+
+
+def _touch(path: str) -> None:
+    # Mark the entry as recently used.
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+
+def _size_if_present(path: str) -> int:
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+def _remove_if_present(path: str) -> None:
+    # Another process may have removed the same file concurrently.
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,456 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import concurrent.futures
+import json
+import math
+import os
+import secrets
+import time
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, NamedTuple, Optional, Tuple, Union
+
+import numpy as np
+
+from stimcircuits.lru_cache import LRUCache
+from stimcircuits.sampling import _write_progress
+from stimcircuits.surface_code import (
+    CircuitGenParameters,
+    _check_params,
+    _params_from_code_task,
+    generate_surface_or_toric_code_circuit_from_params,
+)
+
+DECODERS = (None, "pymatching")
+DEFAULT_BATCH_SIZE = 10_000
+# The number of consecutive batches sampled by one compiled sampler.
+BATCHES_PER_TASK = 8
+
+# Each process keeps the circuits and decoders of the last few parameters it has seen,
+# so that tasks only pay for compiling their seeded sampler. `schedule_shots` resizes it
+# to hold every point of its grid.
+_worker_cache = LRUCache(maxsize=4)
+
+
+def _resize_worker_cache(maxsize: int) -> None:
+    _worker_cache.resize(maxsize)
+
+
+class LogicalErrorRateEstimate(NamedTuple):
+    shots: int
+    errors: int
+    # The seed the batch seeds were derived from, which reproduces the estimate.
+    seed: int
+
+    @property
+    def logical_error_rate(self) -> float:
+        return self.errors / self.shots if self.shots else float("nan")
+
+
+def _task_seed(seed: int, *spawn_key: int) -> int:
+    """The seed of a sampler, from the child of `seed`'s `np.random.SeedSequence` at `spawn_key`."""
+    return int(np.random.SeedSequence(seed, spawn_key=spawn_key).generate_state(1, np.uint64)[0])
+
+
+def _circuit_and_decoder(params: CircuitGenParameters, decoder: Optional[str]) -> Tuple[Any, Any]:
+    def build():
+        circuit = generate_surface_or_toric_code_circuit_from_params(params)
+        if decoder is None:
+            return circuit, None
+        import pymatching
+        return circuit, pymatching.Matching.from_detector_error_model(
+            circuit.detector_error_model(decompose_errors=True))
+
+    return _worker_cache.get_or_create((params.canonical_json(), decoder), build)
+
+
+def _iter_errors(task: Tuple[CircuitGenParameters, Optional[str], Tuple[int, ...], int]) -> Iterator[int]:
+    """Samples a task's batches in turn from one seeded sampler, yielding the logical errors of each."""
+    params, decoder, batch_shots, seed = task
+    circuit, matcher = _circuit_and_decoder(params, decoder)
+    sampler = circuit.compile_detector_sampler(seed=seed)
+    for shots in batch_shots:
+        dets, obs = sampler.sample(shots, separate_observables=True, bit_packed=True)
+        if matcher is None:
+            # Without a decoder, every shot that flips an observable is an error.
+            yield int(np.count_nonzero(np.any(obs, axis=1)))
+            continue
+        predictions = matcher.decode_batch(dets, bit_packed_shots=True, bit_packed_predictions=True)
+        yield int(np.count_nonzero(np.any(predictions != obs, axis=1)))
+
+
+def _count_errors(task: Tuple[CircuitGenParameters, Optional[str], Tuple[int, ...], int]) -> List[int]:
+    """Samples a task's batches, returning how many shots of each have a logical error."""
+    return list(_iter_errors(task))
+
+
+def _batches(max_shots: int, batch_size: int) -> Iterator[Tuple[int, ...]]:
+    """Splits the shots into batches of `batch_size`, grouped into tasks of `BATCHES_PER_TASK`."""
+    task_shots = batch_size * BATCHES_PER_TASK
+    for start in range(0, max_shots, task_shots):
+        end = min(start + task_shots, max_shots)
+        yield tuple(min(batch_size, end - k) for k in range(start, end, batch_size))
+
+
+def estimate_logical_error_rate(
+        code_task: str,
+        *,
+        max_shots: int,
+        max_errors: Optional[int] = None,
+        workers: Optional[int] = None,
+        decoder: Optional[str] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        seed: Optional[int] = None,
+        **kwargs
+) -> LogicalErrorRateEstimate:
+    """Estimates the logical error rate of a generated circuit, sampling on a pool of processes.
+
+    The shots are split into batches of `batch_size`, and the batches into tasks of
+    `BATCHES_PER_TASK` consecutive batches. Each task compiles one sampler, seeded from
+    child k of `np.random.SeedSequence(seed)` for task k, so tasks are independent of
+    each other and of which worker samples them. Batch results are merged in order, and
+    sampling stops after the first batch at which the total number of errors reaches
+    `max_errors`, with later batches cancelled or discarded. So for a given seed the
+    estimate is the same for any number of workers. Each worker only holds one batch of
+    samples at a time.
+
+    Args:
+        code_task: The type of circuit, as for `generate_circuit`.
+        max_shots: The most shots to sample.
+        max_errors: Defaults to None. If given, stop sampling once this many logical
+            errors have been seen.
+        workers: Defaults to None. The number of worker processes. If None, one worker
+            per CPU is used. If 1, batches are sampled in the calling process.
+        decoder: Defaults to None. Either None, which counts every shot that flips a
+            logical observable as an error (e.g. to measure the raw error rate), or
+            "pymatching", which decodes each shot with `pymatching` (an optional
+            dependency) and counts the shots whose prediction is wrong.
+        batch_size: Defaults to 10000. The number of shots per batch.
+        seed: Defaults to None. The seed the batch seeds are derived from. If None, a
+            random seed is chosen and returned in the estimate.
+        **kwargs: The remaining arguments of `generate_circuit`, e.g. `rounds`,
+            `distance` and the noise parameters.
+
+    Returns:
+        The number of shots sampled and the number of those with a logical error.
+    """
+    if decoder not in DECODERS:
+        raise ValueError(f"Unrecognised decoder {decoder!r}, expected one of {DECODERS}")
+    if max_shots < 0:
+        raise ValueError("Need max_shots >= 0")
+    if batch_size < 1:
+        raise ValueError("Need batch_size >= 1")
+    if max_errors is not None and max_errors < 1:
+        raise ValueError("Need max_errors >= 1")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError("Need workers >= 1")
+    if decoder == "pymatching":
+        # Fail in the calling process, rather than in every worker.
+        import pymatching  # noqa: F401
+    params = _params_from_code_task(code_task, **kwargs)
+    _check_params(params)
+    if seed is None:
+        seed = secrets.randbits(63)
+
+    tasks = (
+        (params, decoder, batch_shots, _task_seed(seed, k))
+        for k, batch_shots in enumerate(_batches(max_shots, batch_size))
+    )
+    shots_done = 0
+    errors = 0
+
+    def done() -> bool:
+        return max_errors is not None and errors >= max_errors
+
+    def merge(batch_shots: Tuple[int, ...], batch_errors: Iterable[int]) -> None:
+        nonlocal shots_done, errors
+        for shots, count in zip(batch_shots, batch_errors):
+            if done():
+                break
+            errors += count
+            shots_done += shots
+
+    if workers == 1:
+        for task in tasks:
+            if done():
+                break
+            # Lazily, so that no batch is sampled after reaching max_errors.
+            merge(task[2], _iter_errors(task))
+        return LogicalErrorRateEstimate(shots_done, errors, seed)
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        # Keep a bounded number of tasks in flight, consuming them in submission order.
+        in_flight = collections.deque()
+        for task in tasks:
+            in_flight.append((executor.submit(_count_errors, task), task[2]))
+            if len(in_flight) < 2 * workers:
+                continue
+            future, batch_shots = in_flight.popleft()
+            merge(batch_shots, future.result())
+            if done():
+                break
+        for future, batch_shots in in_flight:
+            if done():
+                future.cancel()
+                continue
+            merge(batch_shots, future.result())
+    return LogicalErrorRateEstimate(shots_done, errors, seed)
+
+
+def wilson_interval(errors: int, shots: int, z: float = 1.96) -> Tuple[float, float]:
+    """The Wilson score interval of an error rate, with `z` standard deviations (1.96 for 95%)."""
+    if shots == 0:
+        return 0.0, 1.0
+    p = errors / shots
+    denominator = 1 + z * z / shots
+    center = (p + z * z / (2 * shots)) / denominator
+    half_width = z * math.sqrt(p * (1 - p) / shots + z * z / (4 * shots * shots)) / denominator
+    return max(0.0, center - half_width), min(1.0, center + half_width)
+
+
+def _relative_width(errors: float, shots: int, z: float) -> float:
+    low, high = wilson_interval(errors, shots, z)
+    # Relative to the center of the interval, as logical error rates span many orders of magnitude.
+    return (high - low) / max((high + low) / 2, 1e-300)
+
+
+class PointEstimate(NamedTuple):
+    # The generate_circuit keyword arguments of the point, including code_task.
+    point: Dict[str, Any]
+    shots: int
+    errors: int
+    # The measured sampling (and decoding) time of the point's shots.
+    seconds: float
+
+    @property
+    def logical_error_rate(self) -> float:
+        return self.errors / self.shots if self.shots else float("nan")
+
+    def interval(self, z: float = 1.96) -> Tuple[float, float]:
+        return wilson_interval(self.errors, self.shots, z)
+
+
+class _PointState:
+    __slots__ = ("key", "params", "point", "shots", "errors", "seconds", "build_seconds", "batches", "pending")
+
+    def __init__(self, key: str, params: CircuitGenParameters, point: Dict[str, Any]):
+        self.key = key
+        self.params = params
+        self.point = point
+        self.shots = 0
+        self.errors = 0
+        self.seconds = 0.0
+        # The time spent building the point's circuit and decoder, which counts against
+        # the budget but not towards the cost of its shots.
+        self.build_seconds = 0.0
+        # Batches started so far (each has its own seed), and shots started but not finished.
+        self.batches = 0
+        self.pending = 0
+
+    def gain_per_second(self, batch_size: int, z: float) -> float:
+        """The expected reduction of the relative interval width per CPU-second of another batch."""
+        if self.shots == 0:
+            # Points are measured before anything else, and then wait for their first batch.
+            return math.inf if self.pending == 0 else -math.inf
+        # The pending shots are counted as if already done, with the current error rate.
+        rate = (self.errors + 0.5) / (self.shots + 1)
+        shots = self.shots + self.pending
+        errors = self.errors + rate * self.pending
+        gain = _relative_width(errors, shots, z) - _relative_width(errors + rate * batch_size, shots + batch_size, z)
+        seconds_per_shot = max(self.seconds / self.shots, 1e-12)
+        return gain / (batch_size * seconds_per_shot)
+
+
+def _timed_count_errors(
+        task: Tuple[CircuitGenParameters, Optional[str], Tuple[int, ...], int]
+) -> Tuple[int, float, float]:
+    """Counts the errors of a task, with the time spent sampling and decoding its shots and
+    the time spent building its circuit and decoder (zero if they were cached)."""
+    start = time.perf_counter()
+    _circuit_and_decoder(task[0], task[1])
+    built = time.perf_counter()
+    errors = sum(_count_errors(task))
+    return errors, time.perf_counter() - built, built - start
+
+
+def _load_checkpoint(path: str, seed: Optional[int], decoder: Optional[str], states: Dict[str, _PointState]) -> int:
+    with open(path) as f:
+        checkpoint = json.load(f)
+    if checkpoint["decoder"] != decoder or (seed is not None and checkpoint["seed"] != seed):
+        raise ValueError(f"{path} holds a different schedule. Remove it to start again.")
+    for key, saved in checkpoint["points"].items():
+        state = states.get(key)
+        if state is not None:
+            state.shots = saved["shots"]
+            state.errors = saved["errors"]
+            state.seconds = saved["seconds"]
+            state.build_seconds = saved.get("build_seconds", 0.0)
+            state.batches = saved["batches"]
+    return checkpoint["seed"]
+
+
+def _save_checkpoint(path: str, seed: int, decoder: Optional[str], states: Dict[str, _PointState]) -> None:
+    _write_progress(path, {
+        "seed": seed,
+        "decoder": decoder,
+        "points": {
+            key: {"shots": s.shots, "errors": s.errors, "seconds": s.seconds, "build_seconds": s.build_seconds,
+                  "batches": s.batches}
+            for key, s in states.items()
+        },
+    })
+
+
+def schedule_shots(
+        points: Iterable[Mapping[str, Any]],
+        *,
+        max_shots: Optional[int] = None,
+        max_seconds: Optional[float] = None,
+        batch_size: int = DEFAULT_BATCH_SIZE,
+        workers: int = 1,
+        decoder: Optional[str] = None,
+        checkpoint_path: Union[str, os.PathLike, None] = None,
+        seed: Optional[int] = None,
+        z: float = 1.96
+) -> List[PointEstimate]:
+    """Spends a shot or CPU budget over a grid of points where it best narrows their error bars.
+
+    Every point first gets one batch, to measure how fast its shots are sampled. After
+    that, each batch goes to the point where it is expected to shrink the relative
+    width of the Wilson interval of the logical error rate (see `wilson_interval`) the
+    most per CPU-second, using the point's current error rate and its measured seconds
+    per shot. Points that are already resolved, or expensive to sample, get fewer shots.
+
+    Args:
+        points: The grid, as mappings of `generate_circuit` keyword arguments including
+            `code_task`, e.g. from `stimcircuits.iter_grid_metadata`. Any "content_hash"
+            field is ignored.
+        max_shots: Defaults to None. The total number of shots to spend, over all
+            points (and over resumed runs).
+        max_seconds: Defaults to None. The total time to spend sampling and decoding, and
+            building circuits and decoders, as measured by the workers (so with several
+            workers, more than the wall time). Building doesn't count towards the cost
+            per shot a point is scheduled by.
+        batch_size: Defaults to 10000. The number of shots given to a point at a time.
+        workers: Defaults to 1. The number of processes sampling batches concurrently.
+            If 1, batches are sampled in the calling process.
+        decoder: Defaults to None. As for `estimate_logical_error_rate`.
+        checkpoint_path: Defaults to None. If given, a JSON file the counts of every
+            point are saved to after each batch. If the file exists, the schedule
+            resumes from it, and the budgets include the shots and seconds it records.
+        seed: Defaults to None. The seed that the seed of each batch is derived from,
+            with batch k of a point sampled by a sampler seeded from the child of
+            `np.random.SeedSequence(seed)` at the point's content hash and k. If None,
+            a random seed is used (or the seed of the checkpoint being resumed).
+        z: Defaults to 1.96. The number of standard deviations of the intervals.
+
+    Returns:
+        The estimate of each point, in the order of `points`.
+    """
+    if max_shots is None and max_seconds is None:
+        raise ValueError("Need a budget: max_shots or max_seconds")
+    if decoder not in DECODERS:
+        raise ValueError(f"Unrecognised decoder {decoder!r}, expected one of {DECODERS}")
+    if batch_size < 1:
+        raise ValueError("Need batch_size >= 1")
+    if workers < 1:
+        raise ValueError("Need workers >= 1")
+    if decoder == "pymatching":
+        import pymatching  # noqa: F401
+
+    states: Dict[str, _PointState] = {}
+    order: List[str] = []
+    for point in points:
+        point = {k: v for k, v in point.items() if k != "content_hash"}
+        params = _params_from_code_task(**point)
+        _check_params(params)
+        key = params.content_hash()
+        states.setdefault(key, _PointState(key, params, point))
+        order.append(key)
+
+    if checkpoint_path is not None:
+        checkpoint_path = os.fspath(checkpoint_path)
+        if os.path.exists(checkpoint_path):
+            seed = _load_checkpoint(checkpoint_path, seed, decoder, states)
+    if seed is None:
+        seed = secrets.randbits(63)
+
+    def budget_left(pending_shots: int) -> bool:
+        total_shots = sum(s.shots for s in states.values()) + pending_shots
+        total_seconds = sum(s.seconds + s.build_seconds for s in states.values())
+        return ((max_shots is None or total_shots < max_shots) and
+                (max_seconds is None or total_seconds < max_seconds))
+
+    def next_task() -> Optional[Tuple[_PointState, tuple]]:
+        pending_shots = sum(s.pending for s in states.values())
+        if not states or not budget_left(pending_shots):
+            return None
+        state = max(states.values(), key=lambda s: s.gain_per_second(batch_size, z))
+        if state.gain_per_second(batch_size, z) == -math.inf:
+            # Every point is waiting for its first batch.
+            return None
+        shots = batch_size
+        if max_shots is not None:
+            shots = min(shots, max_shots - sum(s.shots for s in states.values()) - pending_shots)
+        batch_seed = _task_seed(seed, int(state.key, 16), state.batches)
+        state.batches += 1
+        state.pending += shots
+        return state, (state.params, decoder, (shots,), batch_seed)
+
+    def finish(state: _PointState, shots: int, errors: int, seconds: float, build_seconds: float) -> None:
+        state.pending -= shots
+        state.shots += shots
+        state.errors += errors
+        state.seconds += seconds
+        state.build_seconds += build_seconds
+        if checkpoint_path is not None:
+            _save_checkpoint(checkpoint_path, seed, decoder, states)
+
+    # Points are visited in turn, so every process keeps the circuit and decoder of every
+    # point rather than rebuilding them each time it comes back to a point.
+    cache_size = max(len(states), 1)
+    if workers == 1:
+        previous_size = _worker_cache.info().maxsize
+        _resize_worker_cache(max(cache_size, previous_size))
+        try:
+            while True:
+                scheduled = next_task()
+                if scheduled is None:
+                    break
+                state, task = scheduled
+                finish(state, task[2][0], *_timed_count_errors(task))
+        finally:
+            _resize_worker_cache(previous_size)
+    else:
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_resize_worker_cache, initargs=(cache_size,)) as executor:
+            running: Dict[concurrent.futures.Future, Tuple[_PointState, int]] = {}
+            while True:
+                while len(running) < workers:
+                    scheduled = next_task()
+                    if scheduled is None:
+                        break
+                    state, task = scheduled
+                    running[executor.submit(_timed_count_errors, task)] = (state, task[2][0])
+                if not running:
+                    break
+                finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    state, shots = running.pop(future)
+                    finish(state, shots, *future.result())
+
+    return [PointEstimate(states[key].point, states[key].shots, states[key].errors, states[key].seconds)
+            for key in order]
@@ -0,0 +1,126 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import time
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Optional
+
+# The phases of circuit generation, in the order they run.
+PHASES = (
+    "layout",
+    "indexing",
+    "cnot_scheduling",
+    "cycle",
+    "head",
+    "body",
+    "tail",
+    "concatenation",
+)
+
+
+@dataclass
+class PhaseStats:
+    seconds: float = 0.0
+    calls: int = 0
+    counts: Dict[str, int] = field(default_factory=dict)
+
+
+class GenerationStats:
+    """Collects the wall time and object counts of each phase of circuit generation.
+
+    Pass an instance as the `stats` argument of `generate_circuit` to have it filled in.
+    The phases are listed in `PHASES`. The "layout" phase covers fetching the layout of
+    the patch from `layout_cache`, recorded in its `cache_hits` and `cache_misses` counts.
+    On a miss it includes building the layout, which is further broken down into the
+    nested "indexing" and "cnot_scheduling" phases. Repeated phases (e.g. when the same
+    stats object is used for several circuits) accumulate.
+
+    Args:
+        callback: Defaults to None. If given, called as `callback(phase, seconds, counts)`
+            at the end of every phase.
+    """
+
+    def __init__(self, callback: Optional[Callable[[str, float, Dict[str, int]], None]] = None):
+        self.phases: Dict[str, PhaseStats] = {}
+        self.callback = callback
+        self._depth = 0
+        self._total_seconds = 0.0
+
+    def phase(self, name: str) -> "_Phase":
+        """A context manager timing a phase. It yields a dict for the phase's counts."""
+        return _Phase(self, name)
+
+    def record(self, name: str, seconds: float, counts: Dict[str, int]) -> None:
+        stats = self.phases.setdefault(name, PhaseStats())
+        stats.seconds += seconds
+        stats.calls += 1
+        for key, value in counts.items():
+            stats.counts[key] = stats.counts.get(key, 0) + value
+        if self.callback is not None:
+            self.callback(name, seconds, counts)
+
+    def total_seconds(self) -> float:
+        """The time spent in all phases, counting nested phases only once."""
+        return self._total_seconds
+
+    def __str__(self) -> str:
+        lines = []
+        for name, stats in self.phases.items():
+            counts = ", ".join(f"{k}={v}" for k, v in stats.counts.items())
+            lines.append(f"{name:>16}: {stats.seconds * 1e3:10.3f} ms  {counts}")
+        return "\n".join(lines)
+
+
+class _Phase:
+    __slots__ = ("_stats", "_name", "_counts", "_start")
+
+    def __init__(self, stats: GenerationStats, name: str):
+        self._stats = stats
+        self._name = name
+        self._counts: Dict[str, int] = {}
+
+    def __enter__(self) -> Dict[str, int]:
+        self._stats._depth += 1
+        self._start = time.perf_counter()
+        return self._counts
+
+    def __exit__(self, *exc_info) -> None:
+        seconds = time.perf_counter() - self._start
+        self._stats._depth -= 1
+        if self._stats._depth == 0:
+            self._stats._total_seconds += seconds
+        self._stats.record(self._name, seconds, self._counts)
+
+
+class _NullPhase:
+    __slots__ = ()
+
+    def __enter__(self) -> Dict[str, int]:
+        # Counts written to this dict are simply discarded.
+        return {}
+
+    def __exit__(self, *exc_info) -> None:
+        pass
+
+
+class _NullStats:
+    """Stands in for a `GenerationStats` when instrumentation is disabled."""
+
+    _phase = _NullPhase()
+
+    def phase(self, name: str) -> _NullPhase:
+        return self._phase
+
+
+NULL_STATS = _NullStats()
@@ -0,0 +1,289 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+from dataclasses import dataclass
+from typing import List, Optional, Tuple, Union
+
+import numpy as np
+import stim
+
+from stimcircuits.analytic_dem import _matching_graph_edges
+from stimcircuits.disk_cache import DiskCache
+from stimcircuits.surface_code import _as_disk_cache, _params_from_code_task
+
+# The arrays of a MatchingGraph, each saved to its own .npy file.
+_ARRAYS = ("edges", "probabilities", "weights", "observables", "is_boundary")
+
+
+@dataclass(frozen=True)
+class MatchingGraph:
+    """The decoding graph of a graphlike detector error model, as contiguous NumPy arrays.
+
+    Nodes are the detectors `0, ..., num_detectors - 1`, plus a boundary node with index
+    `num_detectors`. Parallel edges are merged, with the probability that an odd number
+    of them occurs. If they flip different observables (e.g. in codes of distance 2), the
+    merged edge flips the observables of the likeliest of them, where errors flipping the
+    same observables count together, as a decoder would choose for that edge.
+
+    Attributes:
+        edges: An (n, 2) int64 array of the nodes each edge joins. Boundary edges join a
+            detector to the boundary node, which is always in the second column.
+        probabilities: The probability of each edge.
+        weights: The matching weight of each edge, log((1 - p) / p).
+        observables: A uint64 bitmask of the logical observables each edge flips.
+        is_boundary: Whether each edge is a boundary edge.
+    """
+    num_detectors: int
+    num_observables: int
+    edges: np.ndarray
+    probabilities: np.ndarray
+    weights: np.ndarray
+    observables: np.ndarray
+    is_boundary: np.ndarray
+
+    @property
+    def boundary_node(self) -> int:
+        return self.num_detectors
+
+    @property
+    def num_edges(self) -> int:
+        return len(self.edges)
+
+    def to_csr(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Returns the adjacency of the graph in compressed sparse row form.
+
+        Returns:
+            A tuple (indptr, indices, edge_ids). The neighbours of node k are
+            `indices[indptr[k]:indptr[k + 1]]`, joined to it by the edges with the
+            corresponding `edge_ids`, which index the other arrays of the graph.
+            Every edge appears in the rows of both of its nodes.
+        """
+        num_nodes = self.num_detectors + 1
+        edge_ids = np.arange(self.num_edges, dtype=np.int64)
+        rows = np.concatenate([self.edges[:, 0], self.edges[:, 1]])
+        cols = np.concatenate([self.edges[:, 1], self.edges[:, 0]])
+        ids = np.concatenate([edge_ids, edge_ids])
+        order = np.argsort(rows, kind="stable")
+        indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=num_nodes), out=indptr[1:])
+        return indptr, cols[order], ids[order]
+
+    def save(self, directory: Union[str, os.PathLike]) -> None:
+        """Saves the graph as .npy files in `directory`, which can be memory-mapped by `load`."""
+        os.makedirs(directory, exist_ok=True)
+        for name in _ARRAYS:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+        with open(os.path.join(directory, "graph.json"), "w") as f:
+            json.dump(self._metadata(), f)
+
+    @classmethod
+    def load(cls, directory: Union[str, os.PathLike], *, mmap: bool = True) -> "MatchingGraph":
+        """Loads a graph saved by `save`, memory-mapping its arrays (read-only) unless `mmap` is False."""
+        with open(os.path.join(directory, "graph.json")) as f:
+            metadata = json.load(f)
+        return cls._from_files(metadata, lambda name: os.path.join(directory, f"{name}.npy"), mmap)
+
+    def _metadata(self) -> dict:
+        return {"num_detectors": self.num_detectors, "num_observables": self.num_observables}
+
+    @classmethod
+    def _from_files(cls, metadata: dict, path_of, mmap: bool) -> "MatchingGraph":
+        arrays = {name: np.load(path_of(name), mmap_mode="r" if mmap else None) for name in _ARRAYS}
+        return cls(num_detectors=metadata["num_detectors"], num_observables=metadata["num_observables"], **arrays)
+
+
+def _add_error(instruction: stim.DemInstruction, offset: int, edges: List[Tuple[int, int, float, int]]) -> None:
+    p = instruction.args_copy()[0]
+    u = v = -1
+    obs = 0
+    # A separator after the last target ends the last component.
+    for target in instruction.targets_copy() + [stim.target_separator()]:
+        if target.is_separator():
+            # Components without detectors can't be detected, so don't belong in the graph.
+            if u != -1:
+                edges.append((u, v, p, obs))
+            u = v = -1
+            obs = 0
+        elif target.is_relative_detector_id():
+            if u == -1:
+                u = target.val + offset
+            elif v == -1:
+                v = target.val + offset
+            else:
+                raise ValueError(f"The detector error model isn't graphlike: {instruction}. "
+                                 f"Try decomposing its errors.")
+        else:
+            obs |= 1 << target.val
+
+
+def _edge_arrays(dem: stim.DetectorErrorModel) -> Tuple[np.ndarray, np.ndarray, int]:
+    """Reads the errors of a block of a detector error model into arrays.
+
+    Returns an (n, 2) int64 array of the detectors of each error component (with -1 for
+    a missing second detector) relative to the start of the block, a structured array of
+    their probabilities and observables, and the total shift of the detector indices over
+    the block.
+    """
+    edges: List[Tuple[int, int, float, int]] = []
+    chunks: List[Tuple[np.ndarray, np.ndarray]] = []
+    offset = 0
+    for item in dem:
+        if isinstance(item, stim.DemRepeatBlock):
+            count = item.repeat_count
+            nodes, values, shift = _edge_arrays(item.body_copy())
+            # Each repetition of the block is the same, shifted along by the block's shift.
+            offsets = offset + shift * np.arange(count, dtype=np.int64)
+            tiled = nodes[np.newaxis, :, :] + offsets[:, np.newaxis, np.newaxis]
+            tiled[:, nodes[:, 1] == -1, 1] = -1
+            chunks.append((tiled.reshape(-1, 2), np.tile(values, count)))
+            offset += shift * count
+        elif item.type == "error":
+            _add_error(item, offset, edges)
+        elif item.type == "shift_detectors":
+            offset += item.targets_copy()[0]
+    nodes = np.array([(u, v) for u, v, _, _ in edges], dtype=np.int64).reshape(-1, 2)
+    values = np.array([(p, obs) for _, _, p, obs in edges], dtype=[("p", np.float64), ("obs", np.uint64)])
+    if chunks:
+        nodes = np.concatenate([nodes] + [c[0] for c in chunks])
+        values = np.concatenate([values] + [c[1] for c in chunks])
+    return nodes, values, offset
+
+
+def matching_graph_from_dem(dem: stim.DetectorErrorModel) -> MatchingGraph:
+    """Converts a graphlike (e.g. decomposed) detector error model to a `MatchingGraph`.
+
+    The model's instructions are read directly (rather than from its text), and repeated
+    blocks are read once and then tiled with NumPy, so the cost of the conversion is
+    dominated by the parts of the model that aren't repeated.
+
+    Raises:
+        ValueError: If the model isn't graphlike.
+    """
+    nodes, values, _ = _edge_arrays(dem)
+    return _graph_from_edges(dem.num_detectors, dem.num_observables, nodes, values["p"], values["obs"])
+
+
+def _graph_from_edges(
+        num_detectors: int,
+        num_observables: int,
+        nodes: np.ndarray,
+        probabilities: np.ndarray,
+        observables: np.ndarray
+) -> MatchingGraph:
+    """Merges the parallel edges of error components, given as for `_edge_arrays`."""
+    if num_observables > 64:
+        raise ValueError("Observable masks are 64 bits, so at most 64 observables are supported")
+
+    # Boundary edges join a detector to the boundary node, in the second column.
+    nodes = np.where(nodes == -1, num_detectors, nodes)
+    nodes.sort(axis=1)
+    keys = nodes[:, 0] * (num_detectors + 1) + nodes[:, 1]
+    unique_keys, first = np.unique(keys, return_index=True)
+
+    # Merge parallel edges: an odd number of them occurs with probability (1 - prod(1 - 2p)) / 2.
+    # They are first merged by the observables they flip, sorted by edge and then observables.
+    groups, group_inverse = np.unique(np.stack([keys.astype(np.uint64), observables.astype(np.uint64)], axis=1),
+                                      axis=0, return_inverse=True)
+    group_parity = np.ones(len(groups), dtype=np.float64)
+    np.multiply.at(group_parity, group_inverse.ravel(), 1 - 2 * probabilities)
+    group_edge = np.searchsorted(unique_keys, groups[:, 0].astype(np.int64))
+    parity = np.ones(len(unique_keys), dtype=np.float64)
+    np.multiply.at(parity, group_edge, group_parity)
+    merged = (1 - parity) / 2
+    # The likeliest group of each edge has the smallest parity product.
+    by_likelihood = np.lexsort((group_parity, group_edge))
+    likeliest = by_likelihood[np.searchsorted(group_edge[by_likelihood], np.arange(len(unique_keys)))]
+    with np.errstate(divide="ignore"):
+        weights = np.log((1 - merged) / merged)
+
+    edges = np.ascontiguousarray(nodes[first])
+    return MatchingGraph(
+        num_detectors=num_detectors,
+        num_observables=num_observables,
+        edges=edges,
+        probabilities=merged,
+        weights=weights,
+        observables=np.ascontiguousarray(groups[likeliest, 1]),
+        is_boundary=edges[:, 1] == num_detectors,
+    )
+
+
+def _matching_graph_from_params(params) -> MatchingGraph:
+    # Built from the layout, without generating the circuit or its detector error model.
+    num_detectors, nodes, probabilities, observables = _matching_graph_edges(params)
+    return _graph_from_edges(num_detectors, params.patches, nodes, probabilities, observables)
+
+
+def _load_cached_graph(cache: DiskCache, key: str, mmap: bool) -> Optional[MatchingGraph]:
+    meta_path = cache.get_path(f"{key}.graph.json")
+    if meta_path is None:
+        return None
+    paths = {name: cache.get_path(f"{key}.graph.{name}.npy") for name in _ARRAYS}
+    if any(path is None for path in paths.values()):
+        # Part of the entry has been evicted.
+        return None
+    with open(meta_path) as f:
+        metadata = json.load(f)
+    return MatchingGraph._from_files(metadata, paths.get, mmap)
+
+
+def _put_cached_graph(cache: DiskCache, key: str, graph: MatchingGraph) -> None:
+    for name in _ARRAYS:
+        cache.put_file(f"{key}.graph.{name}.npy", lambda f: np.save(f, getattr(graph, name)))
+    # Written last, so that a complete set of arrays exists whenever this file does.
+    cache.put_text(f"{key}.graph.json", json.dumps(graph._metadata()))
+
+
+def generate_matching_graph(
+        code_task: str,
+        *,
+        cache_dir: Union[str, os.PathLike, DiskCache, None] = None,
+        mmap: bool = True,
+        **kwargs
+) -> MatchingGraph:
+    """Returns the matching graph of the decomposed detector error model of a generated circuit.
+
+    The graph is built from the code's layout (see `stimcircuits.analytic_dem`), without
+    generating the circuit or its detector error model. Hyperedges are decomposed into the
+    edges of their X and Z parts, which may differ from the decomposition stim picks.
+
+    Args:
+        code_task: The type of circuit, as for `generate_circuit`.
+        cache_dir: Defaults to None. If given, a directory (or `DiskCache`) in which the
+            graph's arrays are cached as .npy files.
+        mmap: Defaults to True. Whether graphs loaded from `cache_dir` are memory-mapped
+            (read-only) rather than read into memory.
+        **kwargs: The remaining arguments of `generate_circuit`, e.g. `rounds` and
+            `distance`. Circuits generated with `exclude_other_basis_detectors=True`
+            give the smallest graphs.
+
+    Returns:
+        The matching graph.
+    """
+    params = _params_from_code_task(code_task, **kwargs)
+    if cache_dir is None:
+        return _matching_graph_from_params(params)
+    cache = _as_disk_cache(cache_dir)
+    key = cache.entry_key(params)
+    graph = _load_cached_graph(cache, key, mmap)
+    if graph is None:
+        built = _matching_graph_from_params(params)
+        _put_cached_graph(cache, key, built)
+        graph = _load_cached_graph(cache, key, mmap)
+        if graph is None:
+            # The cache is too small to hold the graph.
+            graph = built
+    return graph
@@ -0,0 +1,223 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+from typing import Dict, FrozenSet, List, Optional, Set
+
+import stim
+
+# Instructions that can be moved earlier in a circuit, past instructions acting on other
+# qubits, to merge with an earlier instruction of the same name and arguments. Moving
+# a measurement would change the measurement record, so measurements are never moved.
+_MOVABLE = {
+    "DEPOLARIZE1", "DEPOLARIZE2", "X_ERROR", "Y_ERROR", "Z_ERROR", "PAULI_CHANNEL_1", "PAULI_CHANNEL_2",
+    "H", "S", "S_DAG", "SQRT_X", "SQRT_X_DAG", "X", "Y", "Z", "I",
+    "CX", "CNOT", "CY", "CZ", "SWAP",
+    "R", "RX", "RY",
+}
+# Annotations that movable instructions can pass over, as they don't act on qubits.
+_TRANSPARENT = {"DETECTOR", "OBSERVABLE_INCLUDE", "QUBIT_COORDS", "SHIFT_COORDS"}
+
+# How far back to look for an instruction to merge with.
+_MAX_LOOKBACK = 64
+
+
+class _Instruction:
+    __slots__ = ("name", "args", "targets", "qubits", "movable")
+
+    def __init__(self, name: str, args: List[float], targets: List[str], qubits: Set[int], movable: bool):
+        self.name = name
+        self.args = args
+        self.targets = targets
+        self.qubits = qubits
+        self.movable = movable
+
+    def text(self) -> str:
+        # Arguments are written with repr, as str(stim.CircuitInstruction) rounds them.
+        args = f"({', '.join(repr(a) for a in self.args)})" if self.args else ""
+        return f"{self.name}{args} {' '.join(self.targets)}".rstrip()
+
+
+def _parse(instruction: stim.CircuitInstruction) -> _Instruction:
+    name = instruction.name
+    args = instruction.gate_args_copy()
+    # The targets are formatted by stim, rather than one GateTarget at a time.
+    text = str(instruction)
+    targets = text[text.index(")") + 1:].split() if args else text[len(name):].split()
+    qubits: Set[int] = set()
+    classical = False
+    for target in targets:
+        if target.startswith(("rec", "sweep")):
+            classical = True
+            continue
+        for part in target.split("*"):
+            part = part.lstrip("!")
+            if part[:1] in ("X", "Y", "Z"):
+                part = part[1:]
+            if part.isdigit():
+                qubits.add(int(part))
+    return _Instruction(name, args, targets, qubits, name in _MOVABLE and not classical)
+
+
+def _merge_into_earlier(out: List[_Instruction], instruction: _Instruction) -> bool:
+    """Tries to merge a movable instruction into an earlier one with the same name and arguments.
+
+    The instruction is merged into an earlier instruction E if everything between them
+    can be split into the instructions acting on other qubits than the new one, which
+    it can move back past, and movable instructions acting on other qubits than E,
+    which can move before E. The latter are moved before the merged instruction.
+    """
+    start = max(0, len(out) - _MAX_LOOKBACK)
+    for j in range(len(out) - 1, start - 1, -1):
+        earlier = out[j]
+        if earlier.name == instruction.name and earlier.args == instruction.args and earlier.movable:
+            moved = _instructions_to_move_before(out[j + 1:], earlier, instruction)
+            if moved is not None:
+                earlier.targets.extend(instruction.targets)
+                earlier.qubits |= instruction.qubits
+                rest = [b for b in out[j + 1:] if not any(b is m for m in moved)]
+                out[j:] = moved + [earlier] + rest
+                return True
+        if earlier.name not in _TRANSPARENT and not earlier.qubits.isdisjoint(instruction.qubits) \
+                and not earlier.movable:
+            # Nothing can move past this instruction, so there's no point looking further back.
+            return False
+    return False
+
+
+def _instructions_to_move_before(
+        between: List[_Instruction],
+        earlier: _Instruction,
+        instruction: _Instruction
+) -> Optional[List[_Instruction]]:
+    moved: List[_Instruction] = []
+    staying_qubits: Set[int] = set()
+    for b in between:
+        if b.name in _TRANSPARENT:
+            continue
+        if b.qubits.isdisjoint(instruction.qubits):
+            staying_qubits |= b.qubits
+        elif b.movable and b.qubits.isdisjoint(earlier.qubits) and b.qubits.isdisjoint(staying_qubits):
+            moved.append(b)
+        else:
+            return None
+    return moved
+
+
+def _optimize_block(circuit: stim.Circuit, remove_ticks: bool) -> List[str]:
+    out: List[_Instruction] = []
+    lines: List[str] = []
+
+    def flush():
+        lines.extend(instruction.text() for instruction in out)
+        out.clear()
+
+    for item in circuit:
+        if isinstance(item, stim.CircuitRepeatBlock):
+            flush()
+            lines.append(f"REPEAT {item.repeat_count} {{")
+            lines.extend(_optimize_block(item.body_copy(), remove_ticks))
+            lines.append("}")
+            continue
+        if item.name == "TICK":
+            if not remove_ticks:
+                flush()
+                lines.append("TICK")
+            continue
+        instruction = _parse(item)
+        if instruction.movable and _merge_into_earlier(out, instruction):
+            continue
+        out.append(instruction)
+    flush()
+    return lines
+
+
+def optimize_circuit(circuit: stim.Circuit, *, remove_ticks: bool = False) -> stim.Circuit:
+    """Returns an equivalent circuit with fewer instructions.
+
+    Noise channels, unitary gates and resets are moved earlier, past instructions acting
+    on other qubits, to merge with an earlier instruction with the same name and
+    arguments. For example, the X_ERROR after resetting the data qubits and the X_ERROR
+    after resetting the measurement qubits become a single instruction. Measurements
+    are never moved, so the measurement record, and the detectors and observables
+    defined on it, are unchanged, as is the detector error model (up to the order of
+    its errors, see `detector_error_models_equivalent`).
+
+    The pass pays off on circuits built one gate at a time, e.g. a CX followed by its
+    DEPOLARIZE2 for each pair of qubits, which it merges back into one instruction of
+    each per layer. The circuits of `generate_circuit` already apply each layer as one
+    instruction, so with the TICKs kept only a few instructions merge (e.g. 291 to 288
+    instructions for a distance 5 memory with 5 rounds). Most of what's left to remove
+    from them is the TICKs themselves, with `remove_ticks=True` (291 to 249).
+
+    Args:
+        circuit: The circuit to optimize.
+        remove_ticks: Defaults to False. If True, TICK instructions are removed, which
+            lets instructions merge across them. TICKs don't affect sampling or the
+            detector error model, but mark the moment structure of the circuit (e.g. for
+            conversion to cirq). When kept, instructions aren't moved across them.
+
+    Returns:
+        The optimized circuit.
+    """
+    return stim.Circuit("\n".join(_optimize_block(circuit, remove_ticks)))
+
+
+def _xor_probability(p: float, q: float) -> float:
+    return p * (1 - q) + q * (1 - p)
+
+
+def canonical_error_map(dem: stim.DetectorErrorModel) -> Dict[FrozenSet[str], float]:
+    """Maps the symptoms of each error of a detector error model to its total probability.
+
+    The symptoms of an error are the detectors and observables it flips (with any
+    decomposition ignored), and errors with the same symptoms are combined into one,
+    with the probability that an odd number of them occurs. Two detector error models
+    describe the same noise if and only if their maps are equal (up to rounding).
+    """
+    errors: Dict[FrozenSet[str], float] = {}
+    for instruction in dem.flattened():
+        if instruction.type != "error":
+            continue
+        symptoms: Set[str] = set()
+        for target in instruction.targets_copy():
+            if target.is_separator():
+                continue
+            symptoms ^= {str(target)}
+        key = frozenset(symptoms)
+        p = instruction.args_copy()[0]
+        errors[key] = _xor_probability(errors.get(key, 0.0), p)
+    return errors
+
+
+def detector_error_models_equivalent(
+        a: stim.DetectorErrorModel,
+        b: stim.DetectorErrorModel,
+        *,
+        rel_tol: float = 1e-9,
+        abs_tol: float = 1e-15
+) -> bool:
+    """Whether two detector error models have the same `canonical_error_map`, up to rounding."""
+    if a.num_detectors != b.num_detectors or a.num_observables != b.num_observables:
+        return False
+    errors_a = canonical_error_map(a)
+    errors_b = canonical_error_map(b)
+    if errors_a.keys() != errors_b.keys():
+        return False
+    return all(math.isclose(p, errors_b[key], rel_tol=rel_tol, abs_tol=abs_tol) for key, p in errors_a.items())
+
+
+def circuits_equivalent(a: stim.Circuit, b: stim.Circuit, **kwargs) -> bool:
+    """Whether two circuits have equivalent detector error models (see `detector_error_models_equivalent`)."""
+    return detector_error_models_equivalent(a.detector_error_model(), b.detector_error_model(), **kwargs)
@@ -0,0 +1,260 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from typing import Any, Dict, NamedTuple, Optional, Union
+
+import numpy as np
+import stim
+
+from stimcircuits.lru_cache import LRUCache
+from stimcircuits.surface_code import (
+    CircuitGenParameters,
+    _params_from_code_task,
+    generate_circuit,
+    generate_surface_or_toric_code_circuit_from_params,
+)
+
+SAMPLE_FORMATS = ("b8", "01")
+DEFAULT_CHUNK_SIZE = 100_000
+
+
+# The circuits samplers and converters are compiled from are keyed on the canonical
+# generation parameters, so equivalent ways of specifying the same circuit share an entry.
+sampler_cache = LRUCache(maxsize=32)
+
+# Compiled samplers and converters hold mutable state (a random number generator and
+# buffers) that isn't safe to share between threads, so each thread caches its own, and
+# they are freed with the thread.
+_thread_local = threading.local()
+
+
+def _cached_circuit(params: CircuitGenParameters) -> stim.Circuit:
+    return sampler_cache.get_or_create(
+        params.canonical_json(),
+        lambda: generate_surface_or_toric_code_circuit_from_params(params))
+
+
+def _thread_compiled() -> LRUCache:
+    compiled = getattr(_thread_local, "compiled", None)
+    if compiled is None:
+        compiled = _thread_local.compiled = LRUCache(maxsize=32)
+    return compiled
+
+
+def _compiled(kind: str, code_task: str, kwargs: Dict[str, Any]) -> Any:
+    circuit = _cached_circuit(_params_from_code_task(code_task, **kwargs))
+
+    def compile():
+        if kind == "detector_sampler":
+            return circuit, circuit.compile_detector_sampler()
+        return circuit, circuit.compile_m2d_converter()
+
+    # Keyed on the cached circuit, so that once it is evicted from (or cleared out of)
+    # `sampler_cache`, its samplers are compiled again. Holding the circuit keeps its id unique.
+    return _thread_compiled().get_or_create((kind, id(circuit)), compile)[1]
+
+
+def compiled_detector_sampler(
+        code_task: str,
+        *,
+        seed: Optional[int] = None,
+        **kwargs
+) -> stim.CompiledDetectorSampler:
+    """Returns a cached compiled detector sampler of a generated circuit.
+
+    Takes the same arguments as `generate_circuit`, but only compiles the sampler the
+    first time it is called with a given set of parameters on a given thread, from the
+    circuit kept in `sampler_cache`. The sampler is shared by later calls on the same
+    thread asking for the same parameters, and is seeded from system entropy. Each thread
+    gets its own sampler, as samplers aren't safe to use from several threads at once.
+
+    If `seed` is given, a fresh sampler seeded with it is compiled on every call (from the
+    cached circuit), so that its samples are reproducible whatever was sampled before.
+    """
+    if seed is not None:
+        return _cached_circuit(_params_from_code_task(code_task, **kwargs)).compile_detector_sampler(seed=seed)
+    return _compiled("detector_sampler", code_task, kwargs)
+
+
+def compiled_m2d_converter(code_task: str, **kwargs) -> stim.CompiledMeasurementsToDetectionEventsConverter:
+    """Returns a compiled measurements-to-detection-events converter of a generated circuit.
+
+    Like `compiled_detector_sampler`, converters are cached per thread, and compiled from
+    the circuits in `sampler_cache`.
+    """
+    return _compiled("m2d_converter", code_task, kwargs)
+
+
+class SampleFiles(NamedTuple):
+    path: str
+    obs_path: str
+    shots: int
+    num_detectors: int
+    num_observables: int
+    format: str
+
+
+def _row_bytes(num_bits: int, format: str) -> int:
+    if format == "b8":
+        return (num_bits + 7) // 8
+    # One character per bit, then a newline.
+    return num_bits + 1
+
+
+def _open_output(path: str, shots: int, row_bytes: int, fresh: bool) -> Optional[np.memmap]:
+    if fresh:
+        # Pre-allocate the whole file, without writing to it, so that it can be mapped.
+        with open(path, "wb") as f:
+            f.truncate(shots * row_bytes)
+    elif os.path.getsize(path) != shots * row_bytes:
+        raise ValueError(f"{path} doesn't have the size recorded in its progress file")
+    if shots * row_bytes == 0:
+        return None
+    return np.memmap(path, dtype=np.uint8, mode="r+", shape=(shots, row_bytes))
+
+
+def _write_progress(progress_path: str, progress: Dict[str, Any]) -> None:
+    # Replaced atomically, so that the progress file never claims a partially written chunk.
+    directory = os.path.dirname(os.path.abspath(progress_path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "w") as f:
+            json.dump(progress, f)
+        os.replace(tmp_path, progress_path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def _write_01(bits: np.ndarray, out: np.ndarray) -> None:
+    np.add(bits, ord("0"), out=out[:, :-1], dtype=np.uint8, casting="unsafe")
+    out[:, -1] = ord("\n")
+
+
+def sample_to_file(
+        code_task: str,
+        *,
+        shots: int,
+        path: Union[str, os.PathLike],
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+        format: str = "b8",
+        obs_path: Union[str, os.PathLike, None] = None,
+        seed: Optional[int] = None,
+        **kwargs
+) -> SampleFiles:
+    """Samples detection events of a generated circuit, streaming them to a file.
+
+    The detector sampler is compiled once, and shots are then sampled in chunks of
+    `chunk_size` straight into a pre-allocated, memory-mapped output file, so memory use
+    is bounded by the chunk size rather than the number of shots. Observable flips are
+    written to a separate file in the same format.
+
+    Progress is recorded in a `<path>.progress` file after every chunk. If sampling is
+    interrupted, calling `sample_to_file` again with the same arguments resumes from
+    the last completed chunk. Calling it again after sampling has finished does nothing.
+
+    Args:
+        code_task: The code task, as accepted by `generate_circuit`.
+        shots: The total number of shots to write.
+        path: The file to write the detection events to.
+        chunk_size: Defaults to 100000. The number of shots sampled at a time.
+        format: Defaults to "b8". The format of the output files, either "b8" (one
+            bit-packed row of bytes per shot) or "01" (one line of 0s and 1s per shot).
+            These are the same as stim's "b8" and "01" result formats, so the files
+            can be read back with `stim.read_shot_data_file`.
+        obs_path: Defaults to `<path>.obs`. The file to write the observable flips to.
+        seed: Defaults to None. Seeds the sampler. Resumed runs are seeded from both
+            `seed` and the number of shots already written, so they don't repeat the
+            shots sampled before the interruption.
+        **kwargs: The remaining arguments of `generate_circuit`, e.g. `rounds` and
+            `distance`.
+
+    Returns:
+        The paths of the output files, along with the shape of their contents.
+    """
+    if format not in SAMPLE_FORMATS:
+        raise ValueError(f"Unrecognised format {format!r}, expected one of {SAMPLE_FORMATS}")
+    if shots < 0:
+        raise ValueError("Need shots >= 0")
+    if chunk_size < 1:
+        raise ValueError("Need chunk_size >= 1")
+    path = os.fspath(path)
+    obs_path = path + ".obs" if obs_path is None else os.fspath(obs_path)
+    progress_path = path + ".progress"
+
+    circuit = generate_circuit(code_task, **kwargs)
+    num_detectors = circuit.num_detectors
+    num_observables = circuit.num_observables
+    progress = {
+        "circuit_sha256": hashlib.sha256(str(circuit).encode("utf-8")).hexdigest(),
+        "format": format,
+        "shots": shots,
+        "num_detectors": num_detectors,
+        "num_observables": num_observables,
+        "seed": seed,
+        "shots_done": 0,
+    }
+    result = SampleFiles(path, obs_path, shots, num_detectors, num_observables, format)
+
+    fresh = True
+    if os.path.exists(progress_path):
+        with open(progress_path) as f:
+            previous = json.load(f)
+        if {k: v for k, v in previous.items() if k != "shots_done"} != \
+                {k: v for k, v in progress.items() if k != "shots_done"}:
+            raise ValueError(f"{path} holds a different sampling run. Remove {progress_path} "
+                             f"and its output files to overwrite it.")
+        progress["shots_done"] = previous["shots_done"]
+        fresh = False
+    if progress["shots_done"] == shots and not fresh:
+        return result
+
+    dets = _open_output(path, shots, _row_bytes(num_detectors, format), fresh)
+    obs = _open_output(obs_path, shots, _row_bytes(num_observables, format), fresh)
+    if fresh:
+        _write_progress(progress_path, progress)
+
+    start = progress["shots_done"]
+    if seed is not None and start > 0:
+        seed = int.from_bytes(hashlib.sha256(f"{seed}:{start}".encode()).digest()[:8], "little")
+    sampler = circuit.compile_detector_sampler(seed=seed)
+    while start < shots:
+        end = min(start + chunk_size, shots)
+        if format == "b8":
+            # Sample straight into the mapped output.
+            sampler.sample(
+                end - start,
+                separate_observables=True,
+                bit_packed=True,
+                dets_out=dets[start:end],
+                obs_out=obs[start:end]
+            )
+        else:
+            chunk_dets, chunk_obs = sampler.sample(end - start, separate_observables=True)
+            _write_01(chunk_dets, dets[start:end])
+            _write_01(chunk_obs, obs[start:end])
+        dets.flush()
+        obs.flush()
+        progress["shots_done"] = end
+        _write_progress(progress_path, progress)
+        start = end
+    return result
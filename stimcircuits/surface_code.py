@@ -13,9 +13,21 @@
 # limitations under the License.
 
 import stim
-from typing import Callable, Set, List, Dict, Tuple, Optional
+from typing import Any, Callable, Container, Set, List, Dict, Tuple, Optional, Iterable, Iterator, Mapping, TextIO, Union
 from dataclasses import dataclass
-import math
+import concurrent.futures
+import dataclasses
+import hashlib
+import io
+import json
+import numbers
+import os
+
+import numpy as np
+
+from stimcircuits.disk_cache import DiskCache
+from stimcircuits.instrumentation import GenerationStats, NULL_STATS, _NullStats
+from stimcircuits.lru_cache import LRUCache
 
 
 def append_anti_basis_error(circuit: stim.Circuit, targets: List[int], p: float, basis: str) -> None:
@@ -39,6 +51,33 @@ class CircuitGenParameters:
     before_measure_flip_probability: float = 0
     after_reset_flip_probability: float = 0
     exclude_other_basis_detectors: bool = False
+    patches: int = 1
+
+    def canonical_json(self) -> str:
+        """Encodes the parameters as JSON, with equal parameters always giving equal text.
+
+        The x_distance and z_distance are ignored when a distance is given, so they are
+        left out, and the probabilities are normalized to floats. `patches` is left out
+        when it is 1, so single-patch circuits keep the hashes they had before it existed.
+        """
+        return json.dumps(self._canonical_fields(), sort_keys=True)
+
+    def _canonical_fields(self) -> Dict[str, Any]:
+        fields = dataclasses.asdict(self)
+        if self.distance is not None:
+            fields["x_distance"] = None
+            fields["z_distance"] = None
+        for name in NOISE_PARAMETERS:
+            fields[name] = float(fields[name])
+        fields["exclude_other_basis_detectors"] = bool(self.exclude_other_basis_detectors)
+        fields["patches"] = int(self.patches)
+        if fields["patches"] == 1:
+            del fields["patches"]
+        return fields
+
+    def content_hash(self) -> str:
+        """A stable SHA-256 hex digest of `canonical_json`."""
+        return hashlib.sha256(self.canonical_json().encode("utf-8")).hexdigest()
 
     def append_begin_round_tick(
             self,
@@ -93,21 +132,420 @@ class CircuitGenParameters:
         append_anti_basis_error(circuit, targets, self.after_reset_flip_probability, basis)
 
 
-def finish_surface_code_circuit(
+def _append_grouped(
+        circuit: stim.Circuit,
+        name: str,
+        targets: np.ndarray,
+        probabilities: np.ndarray,
+        arity: int = 1
+) -> None:
+    """Appends noise with a probability per group of `arity` targets, one instruction per distinct probability."""
+    targets = np.asarray(targets, dtype=np.int64).reshape(-1, arity)
+    values, inverse = np.unique(probabilities, return_inverse=True)
+    for k, p in enumerate(values.tolist()):
+        if p > 0:
+            circuit.append_operation(name, targets[inverse == k].ravel(), p)
+
+
+@dataclass(eq=False)
+class HeterogeneousNoiseParameters(CircuitGenParameters):
+    """Generation parameters with per-qubit and per-coupler noise.
+
+    Each per-qubit array is indexed by qubit index (so must have an entry for every
+    qubit index of the circuit, see `get_layout`) and, when given, replaces the uniform
+    probability of the same name for those operations. Coupler noise is given as an
+    array of qubit pairs, e.g. `get_layout(...).couplers`, with the DEPOLARIZE2
+    probability applied after a CNOT between each pair (in either direction). CNOTs
+    between pairs that aren't listed fall back to `after_clifford_depolarization`.
+
+    Targets sharing a probability are grouped into a single noise instruction.
+    """
+    qubit_after_clifford_depolarization: Optional[np.ndarray] = None
+    qubit_before_round_data_depolarization: Optional[np.ndarray] = None
+    qubit_before_measure_flip_probability: Optional[np.ndarray] = None
+    qubit_after_reset_flip_probability: Optional[np.ndarray] = None
+    couplers: Optional[np.ndarray] = None
+    coupler_after_clifford_depolarization: Optional[np.ndarray] = None
+
+    def __post_init__(self):
+        if (self.couplers is None) != (self.coupler_after_clifford_depolarization is None):
+            raise ValueError("couplers and coupler_after_clifford_depolarization must be given together")
+        if self.couplers is not None:
+            couplers = np.sort(np.asarray(self.couplers, dtype=np.int64).reshape(-1, 2), axis=1)
+            probabilities = np.asarray(self.coupler_after_clifford_depolarization, dtype=np.float64)
+            if len(probabilities) != len(couplers):
+                raise ValueError("Need a probability for every coupler")
+            # Pairs are looked up by a single sortable key.
+            self._num_keys = int(couplers.max(initial=0)) + 1
+            keys = couplers[:, 0] * self._num_keys + couplers[:, 1]
+            order = np.argsort(keys)
+            self._coupler_keys = keys[order]
+            self._coupler_probabilities = probabilities[order]
+
+    def _canonical_fields(self) -> Dict[str, Any]:
+        fields = super()._canonical_fields()
+        for name in _HETEROGENEOUS_NOISE_FIELDS:
+            value = getattr(self, name)
+            if value is not None:
+                fields[name] = np.asarray(value, dtype=np.int64 if name == "couplers" else np.float64).tolist()
+        return fields
+
+    def _qubit_probabilities(self, name: str, targets: np.ndarray) -> Optional[np.ndarray]:
+        per_qubit = getattr(self, "qubit_" + name)
+        if per_qubit is None:
+            return None
+        return np.asarray(per_qubit, dtype=np.float64)[np.asarray(targets, dtype=np.int64)]
+
+    def _append_qubit_noise(self, circuit: stim.Circuit, noise: str, name: str, targets: np.ndarray) -> bool:
+        """Appends per-qubit noise, returning False if there is none for this parameter."""
+        probabilities = self._qubit_probabilities(name, targets)
+        if probabilities is None:
+            return False
+        _append_grouped(circuit, noise, targets, probabilities)
+        return True
+
+    def _append_anti_basis_error(self, circuit: stim.Circuit, targets: np.ndarray, name: str, basis: str) -> None:
+        noise = "Z_ERROR" if basis == "X" else "X_ERROR"
+        if not self._append_qubit_noise(circuit, noise, name, targets):
+            append_anti_basis_error(circuit, targets, getattr(self, name), basis)
+
+    def append_begin_round_tick(self, circuit: stim.Circuit, data_qubits: List[int]) -> None:
+        if self.qubit_before_round_data_depolarization is None:
+            super().append_begin_round_tick(circuit, data_qubits)
+            return
+        circuit.append_operation("TICK", [])
+        self._append_qubit_noise(circuit, "DEPOLARIZE1", "before_round_data_depolarization", data_qubits)
+
+    def append_unitary_1(self, circuit: stim.Circuit, name: str, targets: List[int]) -> None:
+        if self.qubit_after_clifford_depolarization is None:
+            super().append_unitary_1(circuit, name, targets)
+            return
+        circuit.append_operation(name, targets)
+        self._append_qubit_noise(circuit, "DEPOLARIZE1", "after_clifford_depolarization", targets)
+
+    def append_unitary_2(self, circuit: stim.Circuit, name: str, targets: List[int]) -> None:
+        if self.couplers is None:
+            super().append_unitary_2(circuit, name, targets)
+            return
+        circuit.append_operation(name, targets)
+        pairs = np.sort(np.asarray(targets, dtype=np.int64).reshape(-1, 2), axis=1)
+        keys = pairs[:, 0] * self._num_keys + pairs[:, 1]
+        index = np.minimum(np.searchsorted(self._coupler_keys, keys), len(self._coupler_keys) - 1)
+        found = (pairs[:, 1] < self._num_keys) & (self._coupler_keys[index] == keys)
+        probabilities = np.where(found, self._coupler_probabilities[index], self.after_clifford_depolarization)
+        _append_grouped(circuit, "DEPOLARIZE2", targets, probabilities, arity=2)
+
+    def append_reset(self, circuit: stim.Circuit, targets: List[int], basis: str = "Z") -> None:
+        circuit.append_operation("R" + basis, targets)
+        self._append_anti_basis_error(circuit, targets, "after_reset_flip_probability", basis)
+
+    def append_measure(self, circuit: stim.Circuit, targets: List[int], basis: str = "Z") -> None:
+        self._append_anti_basis_error(circuit, targets, "before_measure_flip_probability", basis)
+        circuit.append_operation("M" + basis, targets)
+
+    def append_measure_reset(self, circuit: stim.Circuit, targets: List[int], basis: str = "Z") -> None:
+        self._append_anti_basis_error(circuit, targets, "before_measure_flip_probability", basis)
+        circuit.append_operation("MR" + basis, targets)
+        self._append_anti_basis_error(circuit, targets, "after_reset_flip_probability", basis)
+
+
+_HETEROGENEOUS_NOISE_FIELDS = tuple(
+    field.name for field in dataclasses.fields(HeterogeneousNoiseParameters)
+    if field.name not in {f.name for f in dataclasses.fields(CircuitGenParameters)}
+)
+
+
+@dataclass(frozen=True)
+class SurfaceCodeLayout:
+    """The qubit indexing and CNOT schedule of a surface or toric code patch.
+
+    A layout only depends on the geometry of the patch, and not on the noise, the
+    number of rounds or the memory basis, so it can be shared by every circuit
+    generated for the same patch. Qubits are described by NumPy arrays of qubit
+    indices, and coordinates by arrays of shape (n, 2) holding (x, y) pairs. The
+    generated layouts have integer coordinates, while layouts passed to
+    `finish_surface_code_circuit` may have floating point ones.
+    """
+    # Every qubit index in increasing order, and the coordinate of each.
+    qubits: np.ndarray
+    qubit_coords: np.ndarray
+    # Qubit indices in increasing order, which is also the order they are measured in.
+    data_qubits: np.ndarray
+    measurement_qubits: np.ndarray
+    x_measurement_qubits: np.ndarray
+    # The coordinate of each qubit in `measurement_qubits`, and whether it measures an X stabilizer.
+    measurement_coords: np.ndarray
+    measurement_is_x: np.ndarray
+    # The measurement qubit of each stabilizer, listing the X stabilizers and then the Z
+    # stabilizers, each sorted by coordinate. This is the order stabilizers are scheduled in.
+    stabilizer_qubits: np.ndarray
+    stabilizer_coords: np.ndarray
+    num_x_stabilizers: int
+    # The data qubit each stabilizer interacts with in each of the four CNOT layers, or
+    # -1 if it has no partner in that layer, as an array of shape (n_stabilizers, 4).
+    stabilizer_neighbours: np.ndarray
+    # A dense table of the data qubit at each coordinate (or -1), covering the
+    # coordinates from `grid_origin` onwards. Empty if the coordinates aren't integers.
+    data_grid: np.ndarray
+    grid_origin: Tuple[int, int]
+    # The data qubits supporting each logical observable.
+    x_observable: np.ndarray
+    z_observable: np.ndarray
+    wraparound_length: Optional[int]
+    # The flattened CNOT targets of each of the four interaction layers.
+    cnot_targets: List[np.ndarray]
+    # The number of disjoint copies of the patch the layout holds (see `_tiled_layout`).
+    # The observables list the data qubits of each copy in turn.
+    num_patches: int = 1
+    # The data qubit at each (x, y) coordinate, in place of `data_grid` when the
+    # coordinates aren't integers.
+    data_by_coord: Optional[Dict[Tuple[float, float], int]] = None
+
+    @property
+    def x_stabilizers(self) -> slice:
+        return slice(0, self.num_x_stabilizers)
+
+    @property
+    def couplers(self) -> np.ndarray:
+        """The (control, target) qubits of every CNOT in a round, in the order they're applied."""
+        return np.concatenate(self.cnot_targets).reshape(-1, 2)
+
+    @property
+    def z_stabilizers(self) -> slice:
+        return slice(self.num_x_stabilizers, len(self.stabilizer_qubits))
+
+    def data_qubits_at(self, coords: np.ndarray) -> np.ndarray:
+        """Returns the index of the data qubit at each (x, y) coordinate, or -1 if there is none.
+
+        On a torus, coordinates which are not in the table are wrapped around.
+        """
+        dtype = np.int64 if self.data_by_coord is None else np.float64
+        coords = np.asarray(coords, dtype=dtype).reshape(-1, 2)
+        result = self._grid_lookup(coords)
+        if self.wraparound_length is not None:
+            missing = result == -1
+            result[missing] = self._grid_lookup(np.mod(coords[missing], self.wraparound_length))
+        return result
+
+    def _grid_lookup(self, coords: np.ndarray) -> np.ndarray:
+        if self.data_by_coord is not None:
+            return np.array([self.data_by_coord.get((x, y), -1) for x, y in coords.tolist()], dtype=np.int64)
+        x = coords[:, 0] - self.grid_origin[0]
+        y = coords[:, 1] - self.grid_origin[1]
+        width, height = self.data_grid.shape
+        inside = (x >= 0) & (x < width) & (y >= 0) & (y < height)
+        result = np.full(len(coords), -1, dtype=np.int64)
+        result[inside] = self.data_grid[x[inside], y[inside]]
+        return result
+
+
+def _sorted_by_coord(coords: np.ndarray) -> np.ndarray:
+    # Orders by x and then by y.
+    return np.lexsort((coords[:, 1], coords[:, 0]))
+
+
+def _layout_from_arrays(
+        data_coords: np.ndarray,
+        data_indices: np.ndarray,
+        x_measure_coords: np.ndarray,
+        x_measure_indices: np.ndarray,
+        z_measure_coords: np.ndarray,
+        z_measure_indices: np.ndarray,
+        x_order: np.ndarray,
+        z_order: np.ndarray,
+        x_observable: np.ndarray,
+        z_observable: np.ndarray,
+        wraparound_length: Optional[int],
+        stats: Union[GenerationStats, _NullStats] = NULL_STATS
+) -> SurfaceCodeLayout:
+    with stats.phase("indexing") as counts:
+        # Index the measurement qubits and data qubits.
+        all_indices = np.concatenate([data_indices, x_measure_indices, z_measure_indices])
+        all_coords = np.concatenate([data_coords, x_measure_coords, z_measure_coords])
+        by_index = np.argsort(all_indices)
+
+        measure_indices = np.concatenate([x_measure_indices, z_measure_indices])
+        measure_coords = np.concatenate([x_measure_coords, z_measure_coords])
+        measure_is_x = np.arange(len(measure_indices)) < len(x_measure_indices)
+        measure_by_index = np.argsort(measure_indices)
+
+        x_by_coord = _sorted_by_coord(x_measure_coords)
+        z_by_coord = _sorted_by_coord(z_measure_coords)
+
+        data_by_coord = None
+        if not np.issubdtype(data_coords.dtype, np.integer):
+            data_by_coord = dict(zip(map(tuple, data_coords.tolist()), data_indices.tolist()))
+            grid_origin = np.zeros(2, dtype=np.int64)
+            data_grid = np.empty((0, 0), dtype=np.int64)
+        else:
+            grid_origin = data_coords.min(axis=0) if len(data_coords) else np.zeros(2, dtype=np.int64)
+            grid_shape = data_coords.max(axis=0) - grid_origin + 1 if len(data_coords) else (0, 0)
+            data_grid = np.full(tuple(grid_shape), -1, dtype=np.int64)
+            data_grid[data_coords[:, 0] - grid_origin[0], data_coords[:, 1] - grid_origin[1]] = data_indices
+
+        stabilizer_qubits = np.concatenate([x_measure_indices[x_by_coord], z_measure_indices[z_by_coord]])
+        stabilizer_coords = np.concatenate([x_measure_coords[x_by_coord], z_measure_coords[z_by_coord]])
+        num_x = len(x_measure_indices)
+
+        partial = SurfaceCodeLayout(
+            qubits=all_indices[by_index],
+            qubit_coords=all_coords[by_index],
+            data_qubits=np.sort(data_indices),
+            measurement_qubits=measure_indices[measure_by_index],
+            x_measurement_qubits=np.sort(x_measure_indices),
+            measurement_coords=measure_coords[measure_by_index],
+            measurement_is_x=measure_is_x[measure_by_index],
+            stabilizer_qubits=stabilizer_qubits,
+            stabilizer_coords=stabilizer_coords,
+            num_x_stabilizers=num_x,
+            stabilizer_neighbours=np.empty((0, 4), dtype=np.int64),
+            data_grid=data_grid,
+            grid_origin=(int(grid_origin[0]), int(grid_origin[1])),
+            x_observable=np.empty(0, dtype=np.int64),
+            z_observable=np.empty(0, dtype=np.int64),
+            wraparound_length=wraparound_length,
+            cnot_targets=[],
+            data_by_coord=data_by_coord
+        )
+        counts["qubits"] = len(all_indices)
+
+    with stats.phase("cnot_scheduling") as counts:
+        # Find the data qubit each stabilizer interacts with in each layer, in a single lookup.
+        orders = np.concatenate([
+            np.broadcast_to(x_order, (num_x, 4, 2)),
+            np.broadcast_to(z_order, (len(stabilizer_qubits) - num_x, 4, 2)),
+        ])
+        neighbour_coords = stabilizer_coords[:, np.newaxis, :] + orders
+        neighbours = partial.data_qubits_at(neighbour_coords.reshape(-1, 2)).reshape(-1, 4)
+
+        # List out CNOT gate targets using given interaction orders. X stabilizers control
+        # their data qubits, whereas data qubits control Z stabilizers.
+        is_x = np.arange(len(stabilizer_qubits)) < num_x
+        cnot_targets: List[np.ndarray] = []
+        for k in range(4):
+            present = neighbours[:, k] != -1
+            controls = np.where(is_x, stabilizer_qubits, neighbours[:, k])[present]
+            targets = np.where(is_x, neighbours[:, k], stabilizer_qubits)[present]
+            cnot_targets.append(np.stack([controls, targets], axis=1).ravel())
+        counts["cnots"] = sum(len(targets) // 2 for targets in cnot_targets)
+
+    return dataclasses.replace(
+        partial,
+        stabilizer_neighbours=neighbours,
+        x_observable=partial.data_qubits_at(x_observable),
+        z_observable=partial.data_qubits_at(z_observable),
+        cnot_targets=cnot_targets
+    )
+
+
+def _complex_to_pairs(coords: Iterable[complex]) -> np.ndarray:
+    """Converts complex coordinates (x + iy) to a float array of (x, y) pairs."""
+    return np.array([(q.real, q.imag) for q in coords], dtype=np.float64).reshape(-1, 2)
+
+
+def build_surface_code_layout(
         coord_to_index: Callable[[complex], int],
         data_coords: Set[complex],
         x_measure_coords: Set[complex],
         z_measure_coords: Set[complex],
-        params: CircuitGenParameters,
         x_order: List[complex],
         z_order: List[complex],
         x_observable: List[complex],
         z_observable: List[complex],
-        is_memory_x: bool,
         *,
-        exclude_other_basis_detectors: bool = False,
-        wraparound_length: Optional[int] = None
-) -> stim.Circuit:
+        wraparound_length: Optional[int] = None,
+        stats: Union[GenerationStats, _NullStats] = NULL_STATS
+) -> SurfaceCodeLayout:
+    qubit_coords = [list(data_coords), list(x_measure_coords), list(z_measure_coords)]
+    indices = [np.array([coord_to_index(q) for q in coords], dtype=np.int64).reshape(-1) for coords in qubit_coords]
+    pairs = [_complex_to_pairs(coords) for coords in qubit_coords + [x_order, z_order, x_observable, z_observable]]
+    if all(np.array_equal(np.rint(p), p) for p in pairs):
+        # Integer coordinates go on a dense grid. Otherwise qubits are looked up by their
+        # exact coordinates, which is slower but accepts any layout.
+        pairs = [np.rint(p).astype(np.int64) for p in pairs]
+    data, x_measure, z_measure, x_order, z_order, x_observable, z_observable = pairs
+
+    return _layout_from_arrays(
+        data,
+        indices[0],
+        x_measure,
+        indices[1],
+        z_measure,
+        indices[2],
+        x_order,
+        z_order,
+        x_observable,
+        z_observable,
+        wraparound_length,
+        stats
+    )
+
+
+def _tiled_layout(layout: SurfaceCodeLayout, patches: int) -> SurfaceCodeLayout:
+    """Lays out `patches` disjoint copies of a single-patch layout side by side.
+
+    Copy k has the qubit indices of the patch shifted by k times its largest index plus
+    one, and its coordinates shifted along x by k times the patch's width plus a gap, so
+    that every array of the tiled layout keeps the ordering of the single-patch one.
+    """
+    if layout.num_patches != 1:
+        raise ValueError("The layout is already tiled")
+    k = np.arange(patches, dtype=np.int64)
+    qubit_offsets = k * (int(layout.qubits.max()) + 1)
+    span = int(np.ptp(layout.qubit_coords[:, 0]))
+    # An even shift keeps the parity of the coordinates, which sets the role of a qubit.
+    coord_stride = span + 2 + span % 2
+    coord_offsets = np.stack([k * coord_stride, np.zeros_like(k)], axis=1)
+
+    def tile_qubits(qubits: np.ndarray) -> np.ndarray:
+        tiled = qubits[np.newaxis] + qubit_offsets.reshape((-1,) + (1,) * qubits.ndim)
+        # Missing qubits (-1) stay missing.
+        return np.where(qubits[np.newaxis] == -1, -1, tiled).reshape((-1,) + qubits.shape[1:])
+
+    def tile_coords(coords: np.ndarray) -> np.ndarray:
+        return (coords[np.newaxis] + coord_offsets[:, np.newaxis, :]).reshape(-1, 2)
+
+    x, z = layout.x_stabilizers, layout.z_stabilizers
+    width, height = layout.data_grid.shape
+    data_grid = np.full((coord_stride * (patches - 1) + width, height), -1, dtype=np.int64)
+    for offset, qubit_offset in zip((k * coord_stride).tolist(), qubit_offsets.tolist()):
+        data_grid[offset:offset + width] = np.where(layout.data_grid == -1, -1, layout.data_grid + qubit_offset)
+    data_by_coord = None
+    if layout.data_by_coord is not None:
+        data_by_coord = {
+            (x + offset, y): q + qubit_offset
+            for offset, qubit_offset in zip((k * coord_stride).tolist(), qubit_offsets.tolist())
+            for (x, y), q in layout.data_by_coord.items()
+        }
+
+    return SurfaceCodeLayout(
+        qubits=tile_qubits(layout.qubits),
+        qubit_coords=tile_coords(layout.qubit_coords),
+        data_qubits=tile_qubits(layout.data_qubits),
+        measurement_qubits=tile_qubits(layout.measurement_qubits),
+        x_measurement_qubits=tile_qubits(layout.x_measurement_qubits),
+        measurement_coords=tile_coords(layout.measurement_coords),
+        measurement_is_x=np.tile(layout.measurement_is_x, patches),
+        stabilizer_qubits=np.concatenate([tile_qubits(layout.stabilizer_qubits[x]),
+                                          tile_qubits(layout.stabilizer_qubits[z])]),
+        stabilizer_coords=np.concatenate([tile_coords(layout.stabilizer_coords[x]),
+                                          tile_coords(layout.stabilizer_coords[z])]),
+        num_x_stabilizers=layout.num_x_stabilizers * patches,
+        stabilizer_neighbours=np.concatenate([tile_qubits(layout.stabilizer_neighbours[x]),
+                                              tile_qubits(layout.stabilizer_neighbours[z])]),
+        data_grid=data_grid,
+        grid_origin=layout.grid_origin,
+        x_observable=tile_qubits(layout.x_observable),
+        z_observable=tile_qubits(layout.z_observable),
+        # The copies are placed side by side, so coordinates no longer wrap around a torus.
+        wraparound_length=None,
+        cnot_targets=[tile_qubits(targets) for targets in layout.cnot_targets],
+        num_patches=patches,
+        data_by_coord=data_by_coord
+    )
+
+
+def _check_params(params: CircuitGenParameters) -> None:
     if params.rounds < 1:
         raise ValueError("Need rounds >= 1")
     if params.distance is not None and params.distance < 2:
@@ -115,297 +553,630 @@ def finish_surface_code_circuit(
     if params.x_distance is not None and (params.x_distance < 2 or
                                           params.z_distance < 2):
         raise ValueError("Need a distance >= 2")
+    if params.patches < 1:
+        raise ValueError("Need patches >= 1")
 
-    chosen_basis_observable = x_observable if is_memory_x else z_observable
-    chosen_basis_measure_coords = x_measure_coords if is_memory_x else z_measure_coords
-
-    # Index the measurement qubits and data qubits.
-    p2q: Dict[complex, int] = {}
-    for q in data_coords:
-        p2q[q] = coord_to_index(q)
-
-    for q in x_measure_coords:
-        p2q[q] = coord_to_index(q)
-
-    for q in z_measure_coords:
-        p2q[q] = coord_to_index(q)
-
-    q2p: Dict[int, complex] = {v: k for k, v in p2q.items()}
-
-    data_qubits = [p2q[q] for q in data_coords]
-    measurement_qubits = [p2q[q] for q in x_measure_coords]
-    measurement_qubits += [p2q[q] for q in z_measure_coords]
-    x_measurement_qubits = [p2q[q] for q in x_measure_coords]
-
-    all_qubits: List[int] = []
-    all_qubits += data_qubits + measurement_qubits
-
-    all_qubits.sort()
-    data_qubits.sort()
-    measurement_qubits.sort()
-    x_measurement_qubits.sort()
-
-    # Reverse index the measurement order used for defining detectors
-    data_coord_to_order: Dict[complex, int] = {}
-    measure_coord_to_order: Dict[complex, int] = {}
-    for q in data_qubits:
-        data_coord_to_order[q2p[q]] = len(data_coord_to_order)
-    for q in measurement_qubits:
-        measure_coord_to_order[q2p[q]] = len(measure_coord_to_order)
-
-    # List out CNOT gate targets using given interaction orders.
-    cnot_targets: List[List[int]] = [[], [], [], []]
-    for k in range(4):
-        for measure in sorted(x_measure_coords, key=lambda c: (c.real, c.imag)):
-            data = measure + x_order[k]
-            if data in p2q:
-                cnot_targets[k].append(p2q[measure])
-                cnot_targets[k].append(p2q[data])
-            elif wraparound_length is not None:
-                data_wrapped = (data.real % wraparound_length) + (data.imag % wraparound_length) * 1j
-                cnot_targets[k].append(p2q[measure])
-                cnot_targets[k].append(p2q[data_wrapped])
-
-        for measure in sorted(z_measure_coords, key=lambda c: (c.real, c.imag)):
-            data = measure + z_order[k]
-            if data in p2q:
-                cnot_targets[k].append(p2q[data])
-                cnot_targets[k].append(p2q[measure])
-            elif wraparound_length is not None:
-                data_wrapped = (data.real % wraparound_length) + (data.imag % wraparound_length) * 1j
-                cnot_targets[k].append(p2q[data_wrapped])
-                cnot_targets[k].append(p2q[measure])
+
+def finish_surface_code_circuit(
+        coord_to_index: Callable[[complex], int],
+        data_coords: Set[complex],
+        x_measure_coords: Set[complex],
+        z_measure_coords: Set[complex],
+        params: CircuitGenParameters,
+        x_order: List[complex],
+        z_order: List[complex],
+        x_observable: List[complex],
+        z_observable: List[complex],
+        is_memory_x: bool,
+        *,
+        exclude_other_basis_detectors: bool = False,
+        wraparound_length: Optional[int] = None,
+        stats: Optional[GenerationStats] = None
+) -> stim.Circuit:
+    _check_params(params)
+    stats = NULL_STATS if stats is None else stats
+    layout = build_surface_code_layout(
+        coord_to_index,
+        data_coords,
+        x_measure_coords,
+        z_measure_coords,
+        x_order,
+        z_order,
+        x_observable,
+        z_observable,
+        wraparound_length=wraparound_length,
+        stats=stats
+    )
+    if params.patches > 1:
+        layout = _tiled_layout(layout, params.patches)
+    return _circuit_from_layout(
+        layout,
+        params,
+        is_memory_x,
+        exclude_other_basis_detectors=exclude_other_basis_detectors,
+        stats=stats
+    )
+
+
+class _ProgramText:
+    """Collects instructions as stim program text, to be parsed into a circuit in one go.
+
+    Has the same `append_operation`, `copy` and `+=` methods as `stim.Circuit`, so it can
+    be passed to the `append_*` methods of `CircuitGenParameters` in place of a circuit.
+    """
+
+    def __init__(self, lines: Optional[List[str]] = None):
+        self.lines: List[str] = [] if lines is None else lines
+
+    def append_operation(
+            self,
+            name: str,
+            targets: Iterable[Union[int, stim.GateTarget]],
+            arg: Union[float, Iterable[float]] = ()
+    ) -> None:
+        if isinstance(targets, np.ndarray):
+            target_text = " ".join(map(str, targets.tolist()))
+        else:
+            target_text = " ".join(_target_text(t) for t in targets)
+        args = [arg] if isinstance(arg, numbers.Real) else list(arg)
+        if args:
+            self.lines.append(f"{name}({', '.join(repr(float(a)) for a in args)}) {target_text}")
+        else:
+            self.lines.append(f"{name} {target_text}")
+
+    def copy(self) -> "_ProgramText":
+        return _ProgramText(list(self.lines))
+
+    def __iadd__(self, other: "_ProgramText") -> "_ProgramText":
+        self.lines.extend(other.lines)
+        return self
+
+    def to_circuit(self) -> stim.Circuit:
+        return stim.Circuit("\n".join(self.lines))
+
+
+def _target_text(target: Union[int, stim.GateTarget]) -> str:
+    if isinstance(target, stim.GateTarget):
+        if target.is_measurement_record_target:
+            return f"rec[{target.value}]"
+        return str(target.value)
+    return str(target)
+
+
+@dataclass(frozen=True)
+class SurfaceCodeFragments:
+    """The head, body and tail of a memory experiment, which don't depend on its rounds.
+
+    The circuit with r rounds is `head + body * (r - 1) + tail`, so once the fragments
+    are generated, circuits with any number of rounds only cost a concatenation. The
+    fragments may be shared (see `generate_fragments`) and shouldn't be modified.
+    """
+    head: stim.Circuit
+    body: stim.Circuit
+    tail: stim.Circuit
+
+    def with_rounds(self, rounds: int) -> stim.Circuit:
+        if rounds < 1:
+            raise ValueError("Need rounds >= 1")
+        return self.head + self.body * (rounds - 1) + self.tail
+
+
+def _circuit_from_layout(
+        layout: SurfaceCodeLayout,
+        params: CircuitGenParameters,
+        is_memory_x: bool,
+        *,
+        exclude_other_basis_detectors: bool = False,
+        bulk: bool = True,
+        stats: Union[GenerationStats, _NullStats] = NULL_STATS
+) -> stim.Circuit:
+    fragments = _fragments_from_layout(
+        layout,
+        params,
+        is_memory_x,
+        exclude_other_basis_detectors=exclude_other_basis_detectors,
+        bulk=bulk,
+        stats=stats
+    )
+    return _concatenate(fragments, params.rounds, stats)
+
+
+def _concatenate(
+        fragments: SurfaceCodeFragments,
+        rounds: int,
+        stats: Union[GenerationStats, _NullStats]
+) -> stim.Circuit:
+    with stats.phase("concatenation") as counts:
+        circuit = fragments.with_rounds(rounds)
+        counts["rounds"] = rounds
+    return circuit
+
+
+def _fragments_from_layout(
+        layout: SurfaceCodeLayout,
+        params: CircuitGenParameters,
+        is_memory_x: bool,
+        *,
+        exclude_other_basis_detectors: bool = False,
+        bulk: bool = True,
+        as_text: bool = False,
+        stats: Union[GenerationStats, _NullStats] = NULL_STATS
+) -> SurfaceCodeFragments:
+    # In bulk mode each section is collected as program text and parsed in one go, which
+    # is much faster than appending its instructions to a stim.Circuit one at a time.
+    # With as_text, the sections are left as program text (e.g. to be written to a file).
+    new_section = _ProgramText if bulk or as_text else stim.Circuit
+    parse = bulk and not as_text
+
+    chosen_basis_observable = layout.x_observable if is_memory_x else layout.z_observable
+    chosen_basis_stabilizers = layout.x_stabilizers if is_memory_x else layout.z_stabilizers
+    chosen_basis_measure = layout.stabilizer_qubits[chosen_basis_stabilizers]
+    chosen_basis_measure_coords = layout.stabilizer_coords[chosen_basis_stabilizers]
+
+    data_qubits = layout.data_qubits
+    measurement_qubits = layout.measurement_qubits
+    x_measurement_qubits = layout.x_measurement_qubits
+    num_data = len(data_qubits)
+    m = len(measurement_qubits)
 
     # Build the repeated actions that make up the surface code cycle
-    cycle_actions = stim.Circuit()
-    params.append_begin_round_tick(cycle_actions, data_qubits)
-    params.append_unitary_1(cycle_actions, "H", x_measurement_qubits)
-    for targets in cnot_targets:
+    with stats.phase("cycle"):
+        cycle_actions = new_section()
+        params.append_begin_round_tick(cycle_actions, data_qubits)
+        params.append_unitary_1(cycle_actions, "H", x_measurement_qubits)
+        for targets in layout.cnot_targets:
+            cycle_actions.append_operation("TICK", [])
+            params.append_unitary_2(cycle_actions, "CNOT", targets)
+        cycle_actions.append_operation("TICK", [])
+        params.append_unitary_1(cycle_actions, "H", x_measurement_qubits)
         cycle_actions.append_operation("TICK", [])
-        params.append_unitary_2(cycle_actions, "CNOT", targets)
-    cycle_actions.append_operation("TICK", [])
-    params.append_unitary_1(cycle_actions, "H", x_measurement_qubits)
-    cycle_actions.append_operation("TICK", [])
-    params.append_measure_reset(cycle_actions, measurement_qubits)
+        params.append_measure_reset(cycle_actions, measurement_qubits)
 
     # Build the start of the circuit, getting a state that's ready to cycle
     # In particular, the first cycle has different detectors and so has to be handled special.
-    head = stim.Circuit()
-    for k, v in sorted(q2p.items()):
-        head.append_operation("QUBIT_COORDS", [k], [v.real, v.imag])
-    params.append_reset(head, data_qubits, "ZX"[is_memory_x])
-    params.append_reset(head, measurement_qubits)
-    head += cycle_actions
-    for measure in sorted(chosen_basis_measure_coords, key=lambda c: (c.real, c.imag)):
-        head.append_operation(
-            "DETECTOR",
-            [stim.target_rec(-len(measurement_qubits) + measure_coord_to_order[measure])],
-            [measure.real, measure.imag, 0.0]
-        )
-
-    # Build the repeated body of the circuit, including the detectors comparing to previous cycles.
-    body = cycle_actions.copy()
-    m = len(measurement_qubits)
-    body.append_operation("SHIFT_COORDS", [], [0.0, 0.0, 1.0])
-    for m_index in measurement_qubits:
-        m_coord = q2p[m_index]
-        k = len(measurement_qubits) - measure_coord_to_order[m_coord] - 1
-        if not exclude_other_basis_detectors or m_coord in chosen_basis_measure_coords:
-            body.append_operation(
+    with stats.phase("head") as counts:
+        head = new_section()
+        for k, (x, y) in zip(layout.qubits.tolist(), layout.qubit_coords.tolist()):
+            head.append_operation("QUBIT_COORDS", [k], [x, y])
+        params.append_reset(head, data_qubits, "ZX"[is_memory_x])
+        params.append_reset(head, measurement_qubits)
+        head += cycle_actions
+        chosen_measure_order = np.searchsorted(measurement_qubits, chosen_basis_measure)
+        for order, (x, y) in zip(chosen_measure_order.tolist(), chosen_basis_measure_coords.tolist()):
+            head.append_operation(
                 "DETECTOR",
-                [stim.target_rec(-k - 1), stim.target_rec(-k - 1 - m)],
-                [m_coord.real, m_coord.imag, 0.0]
+                [stim.target_rec(-m + order)],
+                [x, y, 0.0]
             )
+        if parse:
+            head = head.to_circuit()
+        counts["detectors"] = len(chosen_measure_order)
+
+    # Build the repeated body of the circuit, including the detectors comparing to previous cycles.
+    with stats.phase("body") as counts:
+        body = cycle_actions.copy()
+        body.append_operation("SHIFT_COORDS", [], [0.0, 0.0, 1.0])
+        is_chosen_basis = layout.measurement_is_x if is_memory_x else ~layout.measurement_is_x
+        num_detectors = 0
+        for order, ((x, y), chosen) in enumerate(zip(layout.measurement_coords.tolist(), is_chosen_basis.tolist())):
+            k = m - order - 1
+            if not exclude_other_basis_detectors or chosen:
+                body.append_operation(
+                    "DETECTOR",
+                    [stim.target_rec(-k - 1), stim.target_rec(-k - 1 - m)],
+                    [x, y, 0.0]
+                )
+                num_detectors += 1
+        if parse:
+            body = body.to_circuit()
+        counts["detectors"] = num_detectors
 
     # Build the end of the circuit, getting out of the cycle state and terminating.
     # In particular, the data measurements create detectors that have to be handled special.
     # Also, the tail is responsible for identifying the logical observable.
-    tail = stim.Circuit()
-    params.append_measure(tail, data_qubits, "ZX"[is_memory_x])
-    # Detectors
-    for measure in sorted(chosen_basis_measure_coords, key=lambda c: (c.real, c.imag)):
-        detectors: List[int] = []
-        for delta in z_order:
-            data = measure + delta
-            if data in p2q:
-                detectors.append(-len(data_qubits) + data_coord_to_order[data])
-            elif wraparound_length is not None:
-                data_wrapped = (data.real % wraparound_length) + (data.imag % wraparound_length) * 1j
-                detectors.append(-len(data_qubits) + data_coord_to_order[data_wrapped])
-        detectors.append(-len(data_qubits) - len(measurement_qubits) + measure_coord_to_order[measure])
-        detectors.sort(reverse=True)
-        tail.append_operation("DETECTOR", [stim.target_rec(x) for x in detectors], [measure.real, measure.imag, 1.0])
-
-    # Logical observable
-    obs_inc: List[int] = []
-    for q in chosen_basis_observable:
-        obs_inc.append(-len(data_qubits) + data_coord_to_order[q])
-    obs_inc.sort(reverse=True)
-    tail.append_operation("OBSERVABLE_INCLUDE", [stim.target_rec(x) for x in obs_inc], 0.0)
-
-    # Combine to form final circuit.
-    return head + body * (params.rounds - 1) + tail
+    with stats.phase("tail") as counts:
+        tail = new_section()
+        params.append_measure(tail, data_qubits, "ZX"[is_memory_x])
+        # Detectors
+        neighbours = layout.stabilizer_neighbours[chosen_basis_stabilizers]
+        neighbour_order = np.where(neighbours == -1, -1, np.searchsorted(data_qubits, neighbours))
+        for (x, y), order, data_orders in zip(
+                chosen_basis_measure_coords.tolist(), chosen_measure_order.tolist(), neighbour_order.tolist()):
+            detectors: List[int] = [-num_data + d for d in data_orders if d != -1]
+            detectors.append(-num_data - m + order)
+            detectors.sort(reverse=True)
+            tail.append_operation("DETECTOR", [stim.target_rec(r) for r in detectors], [x, y, 1.0])
 
+        # Logical observable, one per copy of the patch
+        obs_recs = -num_data + np.searchsorted(data_qubits, chosen_basis_observable)
+        for patch, patch_recs in enumerate(np.split(obs_recs, layout.num_patches)):
+            obs_inc: List[int] = patch_recs.tolist()
+            obs_inc.sort(reverse=True)
+            tail.append_operation("OBSERVABLE_INCLUDE", [stim.target_rec(x) for x in obs_inc], float(patch))
+        if parse:
+            tail = tail.to_circuit()
+        counts["detectors"] = len(neighbour_order)
 
-def generate_rotated_surface_code_circuit(
-        params: CircuitGenParameters,
-        is_memory_x: bool
-) -> stim.Circuit:
-    if params.distance is not None:
-        x_distance = params.distance
-        z_distance = params.distance
-    else:
-        x_distance = params.x_distance
-        z_distance = params.z_distance
+    return SurfaceCodeFragments(head=head, body=body, tail=tail)
 
-    # Place data qubits
-    data_coords: Set[complex] = set()
-    x_observable: List[complex] = []
-    z_observable: List[complex] = []
-    for x in [i + 0.5 for i in range(z_distance)]:
-        for y in [i + 0.5 for i in range(x_distance)]:
-            q = x * 2 + y * 2 * 1j
-            data_coords.add(q)
-            if y == 0.5:
-                z_observable.append(q)
-            if x == 0.5:
-                x_observable.append(q)
-
-    # Place measurement qubits.
-    x_measure_coords: Set[complex] = set()
-    z_measure_coords: Set[complex] = set()
-    for x in range(z_distance + 1):
-        for y in range(x_distance + 1):
-            q = x * 2 + y * 2j
-            on_boundary_1 = x == 0 or x == z_distance
-            on_boundary_2 = y == 0 or y == x_distance
-            parity = (x % 2) != (y % 2)
-            if on_boundary_1 and parity:
-                continue
-            if on_boundary_2 and not parity:
-                continue
-            if parity:
-                x_measure_coords.add(q)
-            else:
-                z_measure_coords.add(q)
+
+def _rotated_surface_code_layout(
+        x_distance: int,
+        z_distance: int,
+        stats: Union[GenerationStats, _NullStats] = NULL_STATS
+) -> SurfaceCodeLayout:
+    # Place data qubits, at odd coordinates.
+    x, y = np.meshgrid(np.arange(z_distance), np.arange(x_distance), indexing="ij")
+    data_coords = np.stack([x.ravel() * 2 + 1, y.ravel() * 2 + 1], axis=1)
+    x_observable = data_coords[data_coords[:, 0] == 1]
+    z_observable = data_coords[data_coords[:, 1] == 1]
+
+    # Place measurement qubits, at even coordinates.
+    x, y = np.meshgrid(np.arange(z_distance + 1), np.arange(x_distance + 1), indexing="ij")
+    x = x.ravel()
+    y = y.ravel()
+    on_boundary_1 = (x == 0) | (x == z_distance)
+    on_boundary_2 = (y == 0) | (y == x_distance)
+    parity = (x % 2) != (y % 2)
+    keep = ~(on_boundary_1 & parity) & ~(on_boundary_2 & ~parity)
+    measure_coords = np.stack([x * 2, y * 2], axis=1)
+    x_measure_coords = measure_coords[keep & parity]
+    z_measure_coords = measure_coords[keep & ~parity]
 
     # Define interaction orders so that hook errors run against the error grain instead of with it.
-    z_order: List[complex] = [1 + 1j, 1 - 1j, -1 + 1j, -1 - 1j]
-    x_order: List[complex] = [1 + 1j, -1 + 1j, 1 - 1j, -1 - 1j]
+    z_order = np.array([(1, 1), (1, -1), (-1, 1), (-1, -1)])
+    x_order = np.array([(1, 1), (-1, 1), (1, -1), (-1, -1)])
 
-    def coord_to_idx(q: complex) -> int:
-        q = q - math.fmod(q.real, 2) * 1j
-        return int(q.real + q.imag * (z_distance + 0.5))
+    def coord_to_idx(q: np.ndarray) -> np.ndarray:
+        # Pairs each data qubit with the measurement qubit diagonally below it, in rows of 2 * z_distance + 1.
+        x, y = q[:, 0], q[:, 1]
+        return x + (y - x % 2) // 2 * (2 * z_distance + 1)
 
-    return finish_surface_code_circuit(
-        coord_to_idx,
+    return _layout_from_arrays(
         data_coords,
+        coord_to_idx(data_coords),
         x_measure_coords,
+        coord_to_idx(x_measure_coords),
         z_measure_coords,
-        params,
+        coord_to_idx(z_measure_coords),
         x_order,
         z_order,
         x_observable,
         z_observable,
-        is_memory_x,
-        exclude_other_basis_detectors=params.exclude_other_basis_detectors
+        None,
+        stats
     )
 
 
-def _generate_unrotated_surface_or_toric_code_circuit(
-        params: CircuitGenParameters,
-        is_memory_x: bool,
-        is_toric: bool
-) -> stim.Circuit:
-    d = params.distance
-    assert params.rounds > 0
-
+def _unrotated_surface_or_toric_code_layout(
+        d: int,
+        is_toric: bool,
+        stats: Union[GenerationStats, _NullStats] = NULL_STATS
+) -> SurfaceCodeLayout:
     # Place qubits
-    data_coords: Set[complex] = set()
-    x_measure_coords: Set[complex] = set()
-    z_measure_coords: Set[complex] = set()
-    x_observable: List[complex] = []
-    z_observable: List[complex] = []
     length = 2 * d if is_toric else 2 * d - 1
-    for x in range(length):
-        for y in range(length):
-            q = x + y * 1j
-            parity = (x % 2) != (y % 2)
-            if parity:
-                if x % 2 == 0:
-                    z_measure_coords.add(q)
-                else:
-                    x_measure_coords.add(q)
-            else:
-                data_coords.add(q)
-                if x == 0:
-                    x_observable.append(q)
-                if y == 0:
-                    z_observable.append(q)
+    x, y = np.meshgrid(np.arange(length), np.arange(length), indexing="ij")
+    coords = np.stack([x.ravel(), y.ravel()], axis=1)
+    x = coords[:, 0]
+    y = coords[:, 1]
+    parity = (x % 2) != (y % 2)
+    is_data = ~parity
+    x_measure_coords = coords[parity & (x % 2 == 1)]
+    z_measure_coords = coords[parity & (x % 2 == 0)]
+    data_coords = coords[is_data]
+    x_observable = coords[is_data & (x == 0)]
+    z_observable = coords[is_data & (y == 0)]
 
     # Define interaction order. Doesn't matter so much for unrotated.
-    order: List[complex] = [1, 1j, -1j, -1]
+    order = np.array([(1, 0), (0, 1), (0, -1), (-1, 0)])
 
-    def coord_to_idx(q: complex) -> int:
-        return int(q.real + q.imag * length)
+    def coord_to_idx(q: np.ndarray) -> np.ndarray:
+        return q[:, 0] + q[:, 1] * length
 
-    # Delegate.
-    return finish_surface_code_circuit(
-        coord_to_idx,
+    return _layout_from_arrays(
         data_coords,
+        coord_to_idx(data_coords),
         x_measure_coords,
+        coord_to_idx(x_measure_coords),
         z_measure_coords,
-        params,
+        coord_to_idx(z_measure_coords),
         order,
         order,
         x_observable,
         z_observable,
+        2 * d if is_toric else None,
+        stats
+    )
+
+
+# Layouts are keyed on geometry alone, so circuits that only differ in their noise,
+# rounds or memory basis share the same entry.
+layout_cache = LRUCache(maxsize=128)
+
+
+def _cached_layout(key: tuple, factory: Callable[[], SurfaceCodeLayout],
+                   stats: Union[GenerationStats, _NullStats]) -> SurfaceCodeLayout:
+    built = False
+
+    def build() -> SurfaceCodeLayout:
+        nonlocal built
+        built = True
+        return factory()
+
+    with stats.phase("layout") as counts:
+        layout = layout_cache.get_or_create(key, build)
+        counts["cache_misses" if built else "cache_hits"] = 1
+    return layout
+
+
+def _cached_patches_layout(
+        key: tuple,
+        factory: Callable[[], SurfaceCodeLayout],
+        patches: int,
+        stats: Union[GenerationStats, _NullStats]
+) -> SurfaceCodeLayout:
+    if patches == 1:
+        return _cached_layout(key, factory, stats)
+    # Tiled layouts are cached alongside the single-patch layout they're made from.
+    return _cached_layout(
+        key + (patches,),
+        lambda: _tiled_layout(layout_cache.get_or_create(key, factory), patches),
+        stats
+    )
+
+
+def _rotated_layout_for_params(
+        params: CircuitGenParameters,
+        stats: Union[GenerationStats, _NullStats]
+) -> SurfaceCodeLayout:
+    if params.distance is not None:
+        x_distance = params.distance
+        z_distance = params.distance
+    else:
+        x_distance = params.x_distance
+        z_distance = params.z_distance
+    return _cached_patches_layout(
+        ("rotated", x_distance, z_distance),
+        lambda: _rotated_surface_code_layout(x_distance, z_distance, stats),
+        params.patches,
+        stats
+    )
+
+
+def _unrotated_layout_for_params(
+        params: CircuitGenParameters,
+        is_toric: bool,
+        stats: Union[GenerationStats, _NullStats]
+) -> SurfaceCodeLayout:
+    d = params.distance
+    return _cached_patches_layout(
+        ("toric" if is_toric else "unrotated", d),
+        lambda: _unrotated_surface_or_toric_code_layout(d, is_toric, stats),
+        params.patches,
+        stats
+    )
+
+
+def generate_rotated_surface_code_circuit(
+        params: CircuitGenParameters,
+        is_memory_x: bool,
+        stats: Optional[GenerationStats] = None
+) -> stim.Circuit:
+    _check_params(params)
+    stats = NULL_STATS if stats is None else stats
+    return _circuit_from_layout(
+        _rotated_layout_for_params(params, stats),
+        params,
+        is_memory_x,
+        exclude_other_basis_detectors=params.exclude_other_basis_detectors,
+        stats=stats
+    )
+
+
+def _generate_unrotated_surface_or_toric_code_circuit(
+        params: CircuitGenParameters,
+        is_memory_x: bool,
+        is_toric: bool,
+        stats: Optional[GenerationStats] = None
+) -> stim.Circuit:
+    _check_params(params)
+    stats = NULL_STATS if stats is None else stats
+    return _circuit_from_layout(
+        _unrotated_layout_for_params(params, is_toric, stats),
+        params,
         is_memory_x,
         exclude_other_basis_detectors=params.exclude_other_basis_detectors,
-        wraparound_length=2 * d if is_toric else None
+        stats=stats
     )
 
 
-def generate_surface_or_toric_code_circuit_from_params(params: CircuitGenParameters) -> stim.Circuit:
+def _layout_for_params(
+        params: CircuitGenParameters,
+        stats: Union[GenerationStats, _NullStats]
+) -> Tuple[SurfaceCodeLayout, bool]:
+    """Returns the layout of the circuit described by `params`, and whether it's an X memory."""
     if params.code_name == "surface_code":
         if params.task == "rotated_memory_x":
-            return generate_rotated_surface_code_circuit(params, True)
+            return _rotated_layout_for_params(params, stats), True
         elif params.task == "rotated_memory_z":
-            return generate_rotated_surface_code_circuit(params, False)
+            return _rotated_layout_for_params(params, stats), False
         elif params.task == "unrotated_memory_x":
             if params.distance is None:
                 raise NotImplementedError('Rectangular unrotated memories are '
                                           'not currently supported')
-            return _generate_unrotated_surface_or_toric_code_circuit(
-                params=params,
-                is_memory_x=True,
-                is_toric=False)
+            return _unrotated_layout_for_params(params, False, stats), True
         elif params.task == "unrotated_memory_z":
             if params.distance is None:
                 raise NotImplementedError('Rectangular unrotated memories are '
                                           'not currently supported')
-            return _generate_unrotated_surface_or_toric_code_circuit(
-                params=params,
-                is_memory_x=False,
-                is_toric=False)
+            return _unrotated_layout_for_params(params, False, stats), False
     elif params.code_name == "toric_code":
         if params.distance is None:
             raise NotImplementedError('Rectangular toric codes are '
                                       'not currently supported')
         if params.task == "unrotated_memory_x":
-            return _generate_unrotated_surface_or_toric_code_circuit(
-                params=params,
-                is_memory_x=True,
-                is_toric=True)
+            return _unrotated_layout_for_params(params, True, stats), True
         elif params.task == "unrotated_memory_z":
-            return _generate_unrotated_surface_or_toric_code_circuit(
-                params=params,
-                is_memory_x=False,
-                is_toric=True)
+            return _unrotated_layout_for_params(params, True, stats), False
 
     raise ValueError(f"Unrecognised task: {params.task}")
 
 
+def get_layout(
+        code_task: str,
+        *,
+        distance: int = None,
+        x_distance: int = None,
+        z_distance: int = None
+) -> SurfaceCodeLayout:
+    """Returns the (cached) layout of the circuits generated for a code task and distance.
+
+    The layout lists the qubit indices and coordinates used by the circuits, and the
+    pairs of qubits CNOTs are applied between (`couplers`), for building per-qubit and
+    per-coupler noise models (see `HeterogeneousNoiseParameters`).
+    """
+    params = _params_from_code_task(code_task, rounds=1, distance=distance, x_distance=x_distance,
+                                    z_distance=z_distance)
+    return _layout_for_params(params, NULL_STATS)[0]
+
+
+def _fragments_from_params(
+        params: CircuitGenParameters,
+        stats: Union[GenerationStats, _NullStats],
+        as_text: bool = False
+) -> SurfaceCodeFragments:
+    _check_params(params)
+    layout, is_memory_x = _layout_for_params(params, stats)
+    return _fragments_from_layout(
+        layout,
+        params,
+        is_memory_x,
+        exclude_other_basis_detectors=params.exclude_other_basis_detectors,
+        as_text=as_text,
+        stats=stats
+    )
+
+
+def generate_surface_or_toric_code_circuit_from_params(
+        params: CircuitGenParameters,
+        stats: Optional[GenerationStats] = None
+) -> stim.Circuit:
+    stats = NULL_STATS if stats is None else stats
+    return _concatenate(_fragments_from_params(params, stats), params.rounds, stats)
+
+
+def _write_lines(lines: List[str], file: TextIO) -> None:
+    if lines:
+        file.write("\n".join(lines))
+        file.write("\n")
+
+
+def write_circuit_from_params(
+        params: CircuitGenParameters,
+        file: Union[str, os.PathLike, TextIO],
+        stats: Optional[GenerationStats] = None
+) -> None:
+    """Writes the circuit for `params` to a .stim file, one section at a time.
+
+    The head, body and tail of the circuit are generated as program text and written
+    straight to the file, with the rounds after the first written as a REPEAT block
+    around a single copy of the body. So memory use only depends on the size of one
+    round of the circuit, rather than the whole circuit, and no `stim.Circuit` is built.
+    Probabilities are written at full precision, so the file loads to a circuit equal to
+    `generate_surface_or_toric_code_circuit_from_params(params)`.
+
+    Args:
+        params: The parameters of the circuit.
+        file: The path of the file to write, or a text file-like object to write to.
+        stats: Defaults to None. If given, a `GenerationStats` that is filled in with the
+            time spent in each phase, with the writing timed as "concatenation".
+    """
+    if not hasattr(file, "write"):
+        with open(file, "w") as f:
+            write_circuit_from_params(params, f, stats)
+        return
+    stats = NULL_STATS if stats is None else stats
+    fragments = _fragments_from_params(params, stats, as_text=True)
+    with stats.phase("concatenation") as counts:
+        _write_lines(fragments.head.lines, file)
+        # Matches body * (rounds - 1), which only makes a REPEAT block for 2 or more repetitions.
+        if params.rounds == 2:
+            _write_lines(fragments.body.lines, file)
+        elif params.rounds > 2:
+            file.write(f"REPEAT {params.rounds - 1} {{\n")
+            _write_lines(fragments.body.lines, file)
+            file.write("}\n")
+        _write_lines(fragments.tail.lines, file)
+        counts["rounds"] = params.rounds
+
+
+def write_circuit(
+        code_task: str,
+        file: Union[str, os.PathLike, TextIO],
+        *,
+        stats: Optional[GenerationStats] = None,
+        **kwargs
+) -> None:
+    """Generates a circuit straight into a .stim file, for circuits too large to hold in memory.
+
+    Takes the same arguments as `generate_circuit` (except `cache_dir` and
+    `return_detector_metadata`), plus the path or text file-like object to write to.
+    See `write_circuit_from_params`. The written file loads to a circuit equal to the
+    output of `generate_circuit`:
+
+        stimcircuits.write_circuit("surface_code:rotated_memory_z", "d301.stim", distance=301, rounds=301)
+    """
+    write_circuit_from_params(_params_from_code_task(code_task, **kwargs), file, stats)
+
+
+# Fragments are keyed on the canonical parameters with the rounds left out, since they
+# don't depend on them.
+fragments_cache = LRUCache(maxsize=32)
+
+
+def generate_fragments(
+        code_task: str,
+        *,
+        distance: int = None,
+        x_distance: int = None,
+        z_distance: int = None,
+        after_clifford_depolarization: float = 0.0,
+        before_round_data_depolarization: float = 0.0,
+        before_measure_flip_probability: float = 0.0,
+        after_reset_flip_probability: float = 0.0,
+        exclude_other_basis_detectors: bool = False,
+        patches: int = 1,
+) -> SurfaceCodeFragments:
+    """Generates the head, body and tail that circuits with any number of rounds are made of.
+
+    Takes the same arguments as `generate_circuit`, except for `rounds`. The fragments
+    are cached in `fragments_cache`, so sweeping over rounds costs a single generation,
+    plus a cheap concatenation per number of rounds:
+
+        fragments = generate_fragments("surface_code:rotated_memory_z", distance=5)
+        circuits = [fragments.with_rounds(r) for r in range(1, 51)]
+
+    `fragments.with_rounds(r)` is equal to `generate_circuit` with `rounds=r`.
+    """
+    params = _params_from_code_task(
+        code_task,
+        rounds=1,
+        distance=distance,
+        x_distance=x_distance,
+        z_distance=z_distance,
+        after_clifford_depolarization=after_clifford_depolarization,
+        before_round_data_depolarization=before_round_data_depolarization,
+        before_measure_flip_probability=before_measure_flip_probability,
+        after_reset_flip_probability=after_reset_flip_probability,
+        exclude_other_basis_detectors=exclude_other_basis_detectors,
+        patches=patches,
+    )
+    return fragments_cache.get_or_create(
+        params.canonical_json(),
+        lambda: _fragments_from_params(params, NULL_STATS)
+    )
+
+
 def generate_circuit(
         code_task: str,
         *,
@@ -418,7 +1189,11 @@ def generate_circuit(
         before_measure_flip_probability: float = 0.0,
         after_reset_flip_probability: float = 0.0,
         exclude_other_basis_detectors: bool = False,
-) -> stim.Circuit:
+        patches: int = 1,
+        cache_dir: Union[str, os.PathLike, DiskCache, None] = None,
+        stats: Optional[GenerationStats] = None,
+        return_detector_metadata: bool = False,
+) -> Union[stim.Circuit, Tuple[stim.Circuit, np.ndarray]]:
     """Generates common circuits.
 
         The generated circuits can include configurable noise.
@@ -476,10 +1251,192 @@ def generate_circuit(
             exclude_other_basis_detectors: Defaults to False. If True, do not add
                 detectors to measurement qubits that are measured in the opposite
                 basis to the chosen basis of the logical observable.
+            patches: Defaults to 1. The number of disjoint copies of the code to lay
+                out side by side in the circuit, so that each shot samples every copy.
+                Copy k has its qubit indices and x coordinates (and so its detector
+                coordinates) shifted past those of copy k - 1, and its logical
+                observable is observable k. This amortizes stim's per-shot overhead for
+                small distances.
+            cache_dir: Defaults to None. If given, a directory (or
+                `stimcircuits.disk_cache.DiskCache`) in which generated circuits are
+                cached as `.stim` files, keyed by a hash of the parameters and the stim
+                version. The cache can be shared by concurrent processes.
+            stats: Defaults to None. If given, a
+                `stimcircuits.instrumentation.GenerationStats` that is filled in with the
+                time spent in each phase of generation. Circuits loaded from `cache_dir`
+                aren't generated, so record no phases.
+            return_detector_metadata: Defaults to False. If True, also return the
+                round, stabilizer and coordinates of every detector, as computed by
+                `generate_detector_metadata`.
 
         Returns:
-            The generated circuit.
+            The generated circuit, or a tuple of the circuit and its detector metadata
+            if `return_detector_metadata` is True.
         """
+    params = _params_from_code_task(
+        code_task,
+        rounds=rounds,
+        distance=distance,
+        x_distance=x_distance,
+        z_distance=z_distance,
+        after_clifford_depolarization=after_clifford_depolarization,
+        before_round_data_depolarization=before_round_data_depolarization,
+        before_measure_flip_probability=before_measure_flip_probability,
+        after_reset_flip_probability=after_reset_flip_probability,
+        exclude_other_basis_detectors=exclude_other_basis_detectors,
+        patches=patches,
+    )
+    if cache_dir is not None:
+        circuit = _cached_circuit(_as_disk_cache(cache_dir), params)
+    else:
+        circuit = generate_surface_or_toric_code_circuit_from_params(params, stats)
+    if return_detector_metadata:
+        return circuit, _detector_metadata_from_params(params)
+    return circuit
+
+
+# The fields of the detector metadata returned by `generate_detector_metadata`.
+DETECTOR_METADATA_DTYPE = np.dtype([
+    ("round", np.int64),
+    ("stabilizer", np.int64),
+    ("qubit", np.int64),
+    ("basis", "U1"),
+    ("x", np.int64),
+    ("y", np.int64),
+])
+
+
+def _detector_metadata_from_layout(
+        layout: SurfaceCodeLayout,
+        rounds: int,
+        is_memory_x: bool,
+        exclude_other_basis_detectors: bool
+) -> np.ndarray:
+    # Mirrors the order in which _fragments_from_layout emits detectors: the head and tail
+    # have one detector per stabilizer of the chosen basis, in stabilizer order, and every
+    # repetition of the body has one per measurement, in measurement order.
+    chosen = np.arange(len(layout.stabilizer_qubits))[
+        layout.x_stabilizers if is_memory_x else layout.z_stabilizers]
+    by_qubit = np.argsort(layout.stabilizer_qubits)
+    measured = by_qubit[np.searchsorted(layout.stabilizer_qubits, layout.measurement_qubits, sorter=by_qubit)]
+    if exclude_other_basis_detectors:
+        measured = measured[layout.measurement_is_x if is_memory_x else ~layout.measurement_is_x]
+
+    stabilizer = np.concatenate([chosen, np.tile(measured, rounds - 1), chosen])
+    metadata = np.empty(len(stabilizer), dtype=DETECTOR_METADATA_DTYPE)
+    metadata["round"] = np.concatenate([
+        np.zeros(len(chosen), dtype=np.int64),
+        np.repeat(np.arange(1, rounds, dtype=np.int64), len(measured)),
+        np.full(len(chosen), rounds, dtype=np.int64),
+    ])
+    metadata["stabilizer"] = stabilizer
+    metadata["qubit"] = layout.stabilizer_qubits[stabilizer]
+    metadata["basis"] = np.where(stabilizer < layout.num_x_stabilizers, "X", "Z")
+    metadata["x"] = layout.stabilizer_coords[stabilizer, 0]
+    metadata["y"] = layout.stabilizer_coords[stabilizer, 1]
+    return metadata
+
+
+def _detector_metadata_from_params(params: CircuitGenParameters) -> np.ndarray:
+    _check_params(params)
+    layout, is_memory_x = _layout_for_params(params, NULL_STATS)
+    return _detector_metadata_from_layout(layout, params.rounds, is_memory_x, params.exclude_other_basis_detectors)
+
+
+def generate_detector_metadata(code_task: str, **kwargs) -> np.ndarray:
+    """Describes every detector of a generated circuit, without generating the circuit.
+
+    The metadata is computed arithmetically from the layout of the code, so it is cheap
+    even for circuits with millions of detectors.
+
+    Args:
+        code_task: The type of circuit, as for `generate_circuit`.
+        **kwargs: The remaining arguments of `generate_circuit`, e.g. `rounds` and
+            `distance`. The noise parameters are accepted but don't affect the result.
+
+    Returns:
+        A structured array with an entry per detector, in detector order, with dtype
+        `DETECTOR_METADATA_DTYPE`. Its fields are the "round" the detector compares
+        measurements up to (0 for the first round, and `rounds` for the detectors of
+        the final data measurements), the index of its "stabilizer" in the layout's
+        `stabilizer_qubits`, the measurement "qubit" of that stabilizer, its "basis"
+        ("X" or "Z"), and the "x" and "y" coordinates of the stabilizer. The detector's
+        coordinates in the circuit are (x, y, round).
+    """
+    return _detector_metadata_from_params(_params_from_code_task(code_task, **kwargs))
+
+
+def _generate_texts(specs: List[tuple]) -> List[str]:
+    texts = []
+    for spec in specs:
+        # Written at full precision, so the text parses to the exact circuit.
+        text = io.StringIO()
+        write_circuit_from_params(CircuitGenParameters(*spec), text)
+        texts.append(text.getvalue())
+    return texts
+
+
+def generate_circuits(
+        specs: Iterable[Mapping[str, Any]],
+        *,
+        workers: Optional[int] = None,
+        chunksize: Optional[int] = None,
+) -> List[stim.Circuit]:
+    """Generates many circuits, spreading the work over a pool of processes.
+
+    Workers are sent compact parameter tuples and send back circuit text with the
+    probabilities written at full precision (see `write_circuit_from_params`), so the
+    calling process only parses each text, and the output is identical to calling
+    `generate_circuit` for every spec.
+
+    Args:
+        specs: The circuits to generate. Each spec is a mapping of the circuit
+            parameters of `generate_circuit`, including `code_task`. The options that
+            don't describe the circuit (`cache_dir`, `stats` and
+            `return_detector_metadata`) aren't accepted, whatever the number of workers.
+        workers: Defaults to None. The number of worker processes. If None, one
+            worker per CPU is used. If 1, the circuits are generated in the calling
+            process.
+        chunksize: Defaults to None. The number of specs sent to a worker at a time.
+            If None, the specs are split into about four chunks per worker, so that
+            small circuits are not dominated by inter-process overhead.
+
+    Returns:
+        The generated circuits, in the same order as `specs`.
+    """
+    specs = list(specs)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers < 1:
+        raise ValueError("Need workers >= 1")
+    # Parsed up front, so that every spec is checked the same way on both paths.
+    params = [_params_from_code_task(**spec) for spec in specs]
+    if workers == 1 or len(specs) <= 1:
+        return [generate_surface_or_toric_code_circuit_from_params(p) for p in params]
+
+    compact_specs = [dataclasses.astuple(p) for p in params]
+    if chunksize is None:
+        chunksize = max(1, len(specs) // (4 * workers))
+    chunks = [compact_specs[k:k + chunksize] for k in range(0, len(compact_specs), chunksize)]
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+        return [stim.Circuit(text) for chunk in executor.map(_generate_texts, chunks) for text in chunk]
+
+
+def _params_from_code_task(
+        code_task: str,
+        *,
+        rounds: int,
+        distance: int = None,
+        x_distance: int = None,
+        z_distance: int = None,
+        after_clifford_depolarization: float = 0.0,
+        before_round_data_depolarization: float = 0.0,
+        before_measure_flip_probability: float = 0.0,
+        after_reset_flip_probability: float = 0.0,
+        exclude_other_basis_detectors: bool = False,
+        patches: int = 1,
+) -> CircuitGenParameters:
     if distance is not None:
         pass
     elif x_distance is not None and z_distance is not None:
@@ -489,7 +1446,7 @@ def generate_circuit(
                          'z_distance parameters must be specified')
     code_name, task = code_task.split(":")
     if code_name in ["surface_code", "toric_code"]:
-        params = CircuitGenParameters(
+        return CircuitGenParameters(
             code_name=code_name,
             task=task,
             rounds=rounds,
@@ -501,7 +1458,303 @@ def generate_circuit(
             before_measure_flip_probability=before_measure_flip_probability,
             after_reset_flip_probability=after_reset_flip_probability,
             exclude_other_basis_detectors=exclude_other_basis_detectors,
+            patches=patches,
         )
-        return generate_surface_or_toric_code_circuit_from_params(params)
     else:
         raise ValueError(f"Code name {code_name} not recognised")
+
+
+# The noise parameters of CircuitGenParameters, in the order used by noise templates.
+NOISE_PARAMETERS: Tuple[str, ...] = (
+    "after_clifford_depolarization",
+    "before_round_data_depolarization",
+    "before_measure_flip_probability",
+    "after_reset_flip_probability",
+)
+
+# Placeholder probabilities tagging which noise parameter produced each noise operation
+# of a template. They are exact in binary, so they survive the round trip through stim.
+_TEMPLATE_PROBABILITIES: Tuple[float, ...] = (0.125, 0.25, 0.375, 0.5)
+_NOISE_OPERATIONS = ("DEPOLARIZE1", "DEPOLARIZE2", "X_ERROR", "Z_ERROR")
+
+
+def _noise_kwargs(noise_point: Union[float, Mapping[str, float]]) -> Dict[str, float]:
+    """Converts a noise point to keyword arguments of `generate_circuit`.
+
+    A float p sets every noise parameter to p, whereas a mapping sets the named noise
+    parameters and leaves the others at zero.
+    """
+    if isinstance(noise_point, Mapping):
+        unknown = set(noise_point) - set(NOISE_PARAMETERS)
+        if unknown:
+            raise ValueError(f"Unrecognised noise parameters: {sorted(unknown)}")
+        return {name: float(noise_point.get(name, 0.0)) for name in NOISE_PARAMETERS}
+    return {name: float(noise_point) for name in NOISE_PARAMETERS}
+
+
+class _NoiseTemplate:
+    """A generated circuit whose noise operations can be refilled without regenerating it.
+
+    The template is generated once with every noise parameter set to a distinct
+    placeholder probability, so that every noise operation is present and can be traced
+    back to the parameter that produced it.
+    """
+
+    def __init__(self, template: stim.Circuit):
+        # Runs of noiseless operations are kept as whole circuits, so that filling the
+        # template appends a handful of blocks rather than every DETECTOR separately.
+        self._entries: List[tuple] = []
+        noiseless = stim.Circuit()
+        for op in template:
+            if not isinstance(op, stim.CircuitRepeatBlock) and op.name not in _NOISE_OPERATIONS:
+                noiseless.append(op)
+                continue
+            if len(noiseless) > 0:
+                self._entries.append(("circuit", noiseless))
+                noiseless = stim.Circuit()
+            if isinstance(op, stim.CircuitRepeatBlock):
+                self._entries.append(("repeat", op.repeat_count, _NoiseTemplate(op.body_copy())))
+            else:
+                channel = _TEMPLATE_PROBABILITIES.index(op.gate_args_copy()[0])
+                # Parsing program text is much faster than appending a list of targets.
+                targets = " ".join(str(t.value) for t in op.targets_copy())
+                self._entries.append(("noise", op.name, targets, channel))
+        if len(noiseless) > 0:
+            self._entries.append(("circuit", noiseless))
+
+    def fill(self, probabilities: List[float]) -> stim.Circuit:
+        circuit = stim.Circuit()
+        for entry in self._entries:
+            if entry[0] == "circuit":
+                circuit += entry[1]
+            elif entry[0] == "noise":
+                _, name, targets, channel = entry
+                if probabilities[channel] > 0:
+                    circuit.append_from_stim_program_text(f"{name}({probabilities[channel]!r}) {targets}")
+            else:
+                _, repeat_count, body = entry
+                circuit.append(stim.CircuitRepeatBlock(repeat_count, body.fill(probabilities)))
+        return circuit
+
+    def fill_text(self, probabilities: List[float]) -> str:
+        """Like `fill`, but returns program text which keeps the probabilities exact.
+
+        (The text produced by `str(stim.Circuit)` rounds the probabilities.)
+        """
+        lines: List[str] = []
+        for entry in self._entries:
+            if entry[0] == "circuit":
+                lines.append(str(entry[1]))
+            elif entry[0] == "noise":
+                _, name, targets, channel = entry
+                if probabilities[channel] > 0:
+                    lines.append(f"{name}({probabilities[channel]!r}) {targets}")
+            else:
+                _, repeat_count, body = entry
+                lines.append(f"REPEAT {repeat_count} {{\n{body.fill_text(probabilities)}\n}}")
+        return "\n".join(lines)
+
+
+def _exact_circuit_text(params: CircuitGenParameters) -> str:
+    placeholders = dict(zip(NOISE_PARAMETERS, _TEMPLATE_PROBABILITIES))
+    template = generate_surface_or_toric_code_circuit_from_params(dataclasses.replace(params, **placeholders))
+    return _NoiseTemplate(template).fill_text([getattr(params, name) for name in NOISE_PARAMETERS]) + "\n"
+
+
+def _as_disk_cache(cache_dir: Union[str, os.PathLike, DiskCache]) -> DiskCache:
+    return cache_dir if isinstance(cache_dir, DiskCache) else DiskCache(cache_dir)
+
+
+def _cached_circuit(cache: DiskCache, params: CircuitGenParameters) -> stim.Circuit:
+    text = cache.get_or_create_text(cache.entry_key(params) + ".stim", lambda: _exact_circuit_text(params))
+    return stim.Circuit(text)
+
+
+def generate_detector_error_model(
+        code_task: str,
+        *,
+        decompose_errors: bool = True,
+        cache_dir: Union[str, os.PathLike, DiskCache, None] = None,
+        **kwargs: Any
+) -> stim.DetectorErrorModel:
+    """Generates a circuit and returns its detector error model.
+
+    Args:
+        code_task: The type of circuit to generate, as for `generate_circuit`.
+        decompose_errors: Defaults to True. Passed on to
+            `stim.Circuit.detector_error_model`.
+        cache_dir: Defaults to None. If given, a directory (or `DiskCache`) used to
+            cache both the generated circuit and its detector error model, so that
+            repeated calls with the same arguments, even from other processes, skip
+            both the generation and the error analysis.
+        **kwargs: The remaining keyword arguments of `generate_circuit`.
+
+    Returns:
+        The detector error model of the generated circuit.
+    """
+    params = _params_from_code_task(code_task, **kwargs)
+    if cache_dir is None:
+        circuit = generate_surface_or_toric_code_circuit_from_params(params)
+        return circuit.detector_error_model(decompose_errors=decompose_errors)
+
+    cache = _as_disk_cache(cache_dir)
+    filename = cache.entry_key(params) + (".dem" if decompose_errors else ".undecomposed.dem")
+    text = cache.get_or_create_text(
+        filename,
+        lambda: str(_cached_circuit(cache, params).detector_error_model(decompose_errors=decompose_errors))
+    )
+    return stim.DetectorErrorModel(text)
+
+
+def generate_circuits_for_noise_grid(
+        code_task: str,
+        *,
+        rounds: int,
+        noise_points: Iterable[Union[float, Mapping[str, float]]],
+        distance: int = None,
+        x_distance: int = None,
+        z_distance: int = None,
+        exclude_other_basis_detectors: bool = False,
+        patches: int = 1,
+) -> List[stim.Circuit]:
+    """Generates one circuit per noise point, all sharing the same code and rounds.
+
+    The circuit is only generated once, as a template, and each noise point then just
+    fills in the arguments of its DEPOLARIZE1, DEPOLARIZE2, X_ERROR and Z_ERROR
+    operations. Each returned circuit is equal to the one `generate_circuit` returns
+    for the same arguments.
+
+    Args:
+        code_task: The type of circuit to generate, as for `generate_circuit`.
+        rounds: The number of rounds, as for `generate_circuit`.
+        noise_points: The noise settings to generate circuits for. Each is either a
+            float p, which sets every noise parameter to p, or a mapping from noise
+            parameter names (see `NOISE_PARAMETERS`) to probabilities, where missing
+            parameters default to 0.
+        distance: Defaults to None. As for `generate_circuit`.
+        x_distance: Defaults to None. As for `generate_circuit`.
+        z_distance: Defaults to None. As for `generate_circuit`.
+        exclude_other_basis_detectors: Defaults to False. As for `generate_circuit`.
+        patches: Defaults to 1. As for `generate_circuit`.
+
+    Returns:
+        The generated circuits, in the same order as `noise_points`.
+    """
+    params = _params_from_code_task(
+        code_task,
+        rounds=rounds,
+        distance=distance,
+        x_distance=x_distance,
+        z_distance=z_distance,
+        exclude_other_basis_detectors=exclude_other_basis_detectors,
+        patches=patches,
+        **dict(zip(NOISE_PARAMETERS, _TEMPLATE_PROBABILITIES))
+    )
+    template = _NoiseTemplate(generate_surface_or_toric_code_circuit_from_params(params))
+    circuits: List[stim.Circuit] = []
+    for noise_point in noise_points:
+        noise = _noise_kwargs(noise_point)
+        circuits.append(template.fill([noise[name] for name in NOISE_PARAMETERS]))
+    return circuits
+
+
+def iter_grid_metadata(
+        code_tasks: Iterable[str],
+        distances: Iterable[int],
+        rounds: Union[Iterable[int], Callable[[int], Iterable[int]]],
+        noise_points: Iterable[Union[float, Mapping[str, float]]],
+        *,
+        exclude_other_basis_detectors: bool = False,
+) -> Iterator[Dict[str, Any]]:
+    """Lazily lists the points of a parameter grid, without generating any circuits.
+
+    Points are yielded in the order of `code_tasks`, then `distances`, then `rounds`,
+    then `noise_points`. Each point is a dict of `generate_circuit` keyword arguments
+    (including `code_task`) together with a "content_hash", the
+    `CircuitGenParameters.content_hash` of the circuit it describes. The hash is stable
+    across processes and versions, so it can be used to record which points are done.
+
+    Args:
+        code_tasks: The code tasks, as for `generate_circuit`.
+        distances: The code distances.
+        rounds: The numbers of rounds, or a function returning the numbers of rounds to
+            use at a given distance (e.g. `lambda d: [d, 3 * d]`).
+        noise_points: The noise settings, as for `generate_circuits_for_noise_grid`.
+        exclude_other_basis_detectors: Defaults to False. As for `generate_circuit`.
+
+    Yields:
+        The metadata of each point of the grid.
+    """
+    # The inputs may be single-use iterators, but are iterated once per outer loop.
+    code_tasks = list(code_tasks)
+    distances = list(distances)
+    rounds = rounds if callable(rounds) else list(rounds)
+    noise_points = [_noise_kwargs(noise_point) for noise_point in noise_points]
+    for code_task in code_tasks:
+        for distance in distances:
+            for r in (rounds(distance) if callable(rounds) else rounds):
+                for noise in noise_points:
+                    kwargs = dict(
+                        code_task=code_task,
+                        rounds=r,
+                        distance=distance,
+                        exclude_other_basis_detectors=exclude_other_basis_detectors,
+                        **noise
+                    )
+                    kwargs["content_hash"] = _params_from_code_task(**kwargs).content_hash()
+                    yield kwargs
+
+
+def iter_grid_circuits(
+        code_tasks: Iterable[str],
+        distances: Iterable[int],
+        rounds: Union[Iterable[int], Callable[[int], Iterable[int]]],
+        noise_points: Iterable[Union[float, Mapping[str, float]]],
+        *,
+        exclude_other_basis_detectors: bool = False,
+        skip: Container[str] = (),
+) -> Iterator[Tuple[Dict[str, Any], stim.Circuit]]:
+    """Lazily generates the circuits of a parameter grid, as (metadata, circuit) pairs.
+
+    The grid and its metadata are those of `iter_grid_metadata`. Each circuit is only
+    generated when its pair is consumed, and is equal to the circuit `generate_circuit`
+    returns for the metadata. Consecutive points that only differ in their noise share
+    a noise template (see `generate_circuits_for_noise_grid`), so each circuit is
+    generated once per code task, distance and number of rounds.
+
+    Args:
+        code_tasks: The code tasks, as for `generate_circuit`.
+        distances: The code distances.
+        rounds: The numbers of rounds, or a function returning the numbers of rounds to
+            use at a given distance.
+        noise_points: The noise settings, as for `generate_circuits_for_noise_grid`.
+        exclude_other_basis_detectors: Defaults to False. As for `generate_circuit`.
+        skip: Defaults to no points. The content hashes of points to leave out, e.g.
+            the points finished before a restart. Skipped points aren't generated.
+
+    Yields:
+        The metadata and circuit of each point of the grid that isn't skipped.
+    """
+    template_key = None
+    template = None
+    for metadata in iter_grid_metadata(
+            code_tasks,
+            distances,
+            rounds,
+            noise_points,
+            exclude_other_basis_detectors=exclude_other_basis_detectors
+    ):
+        if metadata["content_hash"] in skip:
+            continue
+        key = (metadata["code_task"], metadata["distance"], metadata["rounds"])
+        if key != template_key:
+            params = _params_from_code_task(
+                metadata["code_task"],
+                rounds=metadata["rounds"],
+                distance=metadata["distance"],
+                exclude_other_basis_detectors=exclude_other_basis_detectors,
+                **dict(zip(NOISE_PARAMETERS, _TEMPLATE_PROBABILITIES))
+            )
+            template = _NoiseTemplate(generate_surface_or_toric_code_circuit_from_params(params))
+            template_key = key
+        yield metadata, template.fill([metadata[name] for name in NOISE_PARAMETERS])
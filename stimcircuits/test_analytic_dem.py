@@ -0,0 +1,169 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import pytest
+import stim
+
+from stimcircuits.analytic_dem import generate_analytic_detector_error_model, generate_detector_error_model_slices
+from stimcircuits.optimize import detector_error_models_equivalent
+from stimcircuits.surface_code import generate_circuit
+CODE_TASKS = [
+    "surface_code:rotated_memory_x",
+    "surface_code:rotated_memory_z",
+    "surface_code:unrotated_memory_x",
+    "surface_code:unrotated_memory_z",
+    "toric_code:unrotated_memory_x",
+    "toric_code:unrotated_memory_z",
+]
+# The distances, rounds and noise (p1 to p4, in the order of NOISE) of the generation tests.
+DISTANCE_ROUNDS_NOISE = [
+    (3, 10, 0.001, 0.002, 0.003, 0.004),
+    (3, 2, 0.001, 0.002, 0.003, 0.004),
+    (5, 1, 0.1, 0.002, 0.003, 0.004),
+    (2, 2, 0, 0.01, 0, 0),
+]
+TEST_PARAMS = [(code_task,) + row for code_task in CODE_TASKS for row in DISTANCE_ROUNDS_NOISE]
+TEST_PARAMS_DISTANCES = [
+    ("surface_code:unrotated_memory_x", 3, 3, 3, 10, 0.001, 0.002, 0.003, 0.004),
+    ("surface_code:unrotated_memory_z", 5, 5, 5, 1, 0.1, 0.002, 0.003, 0.004),
+    ("surface_code:rotated_memory_x", 3, 5, 3, 10, 0.001, 0.002, 0.003, 0.004),
+    ("surface_code:rotated_memory_z", 5, 3, 5, 1, 0.1, 0.002, 0.003, 0.004),
+]
+TEST_PARAMS_RECTANGULAR = [
+    ("surface_code:rotated_memory_x", 3, 3, 10, 0.001, 0.002, 0.003, 0.004),
+    ("surface_code:rotated_memory_x", 5, 3, 1, 0.1, 0.002, 0.003, 0.004),
+    ("surface_code:rotated_memory_x", 3, 5, 1, 0.1, 0.002, 0.003, 0.004),
+    ("surface_code:rotated_memory_x", 2, 3, 2, 0, 0.01, 0, 0),
+    ("surface_code:rotated_memory_z", 3, 5, 2, 0.001, 0.002, 0.003, 0.004),
+    ("surface_code:rotated_memory_z", 5, 3, 3, 0.1, 0.002, 0.003, 0.004),
+    ("surface_code:rotated_memory_z", 2, 2, 2, 0, 0.01, 0, 0),
+]
+
+NOISE = ("after_clifford_depolarization", "before_round_data_depolarization",
+         "before_measure_flip_probability", "after_reset_flip_probability")
+
+
+def _assert_matches_stim(code_task: str, **kwargs) -> None:
+    analytic = generate_analytic_detector_error_model(code_task, **kwargs)
+    expected = generate_circuit(code_task, **kwargs).detector_error_model(decompose_errors=True)
+    assert detector_error_models_equivalent(analytic, expected)
+    assert analytic.get_detector_coordinates() == expected.get_detector_coordinates()
+    # Decomposed into graphlike errors.
+    for instruction in analytic.flattened():
+        if instruction.type == "error":
+            components = [[]]
+            for target in instruction.targets_copy():
+                if target.is_separator():
+                    components.append([])
+                elif target.is_relative_detector_id():
+                    components[-1].append(target)
+            assert all(len(component) <= 2 for component in components)
+
+
+@pytest.mark.parametrize("exclude_other_basis_detectors", [False, True])
+@pytest.mark.parametrize("code_task,distance,rounds,p1,p2,p3,p4",
+                         TEST_PARAMS)
+def test_matches_stim(code_task, distance, rounds, p1, p2, p3, p4, exclude_other_basis_detectors) -> None:
+    _assert_matches_stim(code_task, distance=distance, rounds=rounds,
+                         exclude_other_basis_detectors=exclude_other_basis_detectors,
+                         **dict(zip(NOISE, (p1, p2, p3, p4))))
+
+
+@pytest.mark.parametrize("code_task,distance,x_distance,z_distance,rounds,p1,p2,p3,p4",
+                         TEST_PARAMS_DISTANCES)
+def test_matches_stim_with_distances(code_task, distance, x_distance, z_distance, rounds, p1, p2, p3, p4) -> None:
+    _assert_matches_stim(code_task, distance=distance, x_distance=x_distance, z_distance=z_distance,
+                         rounds=rounds, **dict(zip(NOISE, (p1, p2, p3, p4))))
+
+
+@pytest.mark.parametrize("code_task,x_distance,z_distance,rounds,p1,p2,p3,p4",
+                         TEST_PARAMS_RECTANGULAR)
+def test_matches_stim_rectangular(code_task, x_distance, z_distance, rounds, p1, p2, p3, p4) -> None:
+    _assert_matches_stim(code_task, x_distance=x_distance, z_distance=z_distance, rounds=rounds,
+                         **dict(zip(NOISE, (p1, p2, p3, p4))))
+
+
+@pytest.mark.parametrize("rounds", [1, 2, 3, 5])
+def test_matches_stim_with_patches(rounds: int) -> None:
+    _assert_matches_stim("surface_code:rotated_memory_z", distance=3, rounds=rounds, patches=2,
+                         after_clifford_depolarization=0.001, before_measure_flip_probability=0.002)
+
+
+def test_rounds_are_repeated() -> None:
+    dem = generate_analytic_detector_error_model("surface_code:rotated_memory_x", distance=3, rounds=100,
+                                                 after_clifford_depolarization=0.001)
+    assert any(isinstance(item, stim.DemRepeatBlock) and item.repeat_count == 98 for item in dem)
+    assert dem.num_detectors == 4 + 99 * 8 + 4
+    assert np.isclose(len(str(dem)), len(str(generate_analytic_detector_error_model(
+        "surface_code:rotated_memory_x", distance=3, rounds=1000, after_clifford_depolarization=0.001))), rtol=0.01)
+
+
+@pytest.mark.parametrize("rounds,patches", [(1, 1), (3, 1), (5, 2)])
+def test_noiseless_has_no_errors(rounds: int, patches: int) -> None:
+    dem = generate_analytic_detector_error_model("surface_code:unrotated_memory_z", distance=3, rounds=rounds,
+                                                 patches=patches)
+    expected = generate_circuit("surface_code:unrotated_memory_z", distance=3, rounds=rounds,
+                                patches=patches).detector_error_model(decompose_errors=True)
+    assert dem.num_errors == 0
+    assert dem.num_detectors == expected.num_detectors
+    assert dem.num_observables == expected.num_observables == patches
+    assert detector_error_models_equivalent(dem, expected)
+
+
+@pytest.mark.parametrize("code_task", ["surface_code:rotated_memory_x", "toric_code:unrotated_memory_z"])
+@pytest.mark.parametrize("rounds", [2, 3, 4, 7])
+def test_slices_with_rounds_match_stim(code_task: str, rounds: int) -> None:
+    kwargs = dict(distance=3, after_clifford_depolarization=0.001, before_round_data_depolarization=0.002,
+                  before_measure_flip_probability=0.003, after_reset_flip_probability=0.004)
+    slices = generate_detector_error_model_slices(code_task, **kwargs)
+    dem = slices.with_rounds(rounds)
+    expected = generate_circuit(code_task, rounds=rounds, **kwargs).detector_error_model(decompose_errors=True)
+    assert detector_error_models_equivalent(dem, expected)
+    assert dem.get_detector_coordinates() == expected.get_detector_coordinates()
+
+
+@pytest.mark.parametrize("noise", [0, 0.001])
+@pytest.mark.parametrize("patches", [1, 2])
+def test_slices_count_observables_like_stim(noise: float, patches: int) -> None:
+    kwargs = dict(distance=3, patches=patches, after_clifford_depolarization=noise)
+    slices = generate_detector_error_model_slices("surface_code:rotated_memory_z", **kwargs)
+    for rounds in (2, 4):
+        expected = generate_circuit("surface_code:rotated_memory_z", rounds=rounds, **kwargs).detector_error_model(
+            decompose_errors=True)
+        assert slices.with_rounds(rounds).num_observables == expected.num_observables == patches
+        assert slices.window(rounds, tail=True).num_observables == patches
+
+
+def test_slice_windows() -> None:
+    slices = generate_detector_error_model_slices("surface_code:rotated_memory_z", distance=3,
+                                                  after_clifford_depolarization=0.001)
+    assert slices.head.num_detectors == 4 + 8
+    assert slices.bulk.num_detectors == 8 + 8
+    assert slices.tail.num_detectors == 8 + 4
+
+    window = slices.window(5)
+    # The errors of the last round also flip the detectors of the next round.
+    assert window.num_detectors == 6 * 8
+    coordinates = window.get_detector_coordinates()
+    assert all(coordinates[k][2] == k // 8 for k in range(5 * 8))
+    assert all(coordinates[k] == [] for k in range(5 * 8, 6 * 8))
+    assert slices.window(5, head=True).num_detectors == 4 + 4 * 8 + 8
+    assert slices.window(5, tail=True).num_detectors == 5 * 8 + 4
+    assert str(slices.window(5, head=True, tail=True)) == str(slices.with_rounds(5))
+
+    with pytest.raises(ValueError):
+        slices.window(1, head=True, tail=True)
+    with pytest.raises(ValueError):
+        slices.with_rounds(1)
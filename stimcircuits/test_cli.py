@@ -0,0 +1,120 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import subprocess
+import sys
+
+import pytest
+import stim
+
+from stimcircuits.cli import main
+from stimcircuits.surface_code import generate_circuit, _params_from_code_task
+
+
+def test_single_circuit(tmp_path, capsys) -> None:
+    output = tmp_path / "d3.stim"
+    main(["--code-task", "surface_code:rotated_memory_z", "--distance", "3", "--rounds", "4",
+          "--after-clifford-depolarization", "0.0012345678", "--output", str(output), "--dem"])
+    expected = generate_circuit("surface_code:rotated_memory_z", distance=3, rounds=4,
+                                after_clifford_depolarization=0.0012345678)
+    circuit = stim.Circuit.from_file(str(output))
+    assert circuit == expected
+    assert stim.DetectorErrorModel.from_file(str(tmp_path / "d3.dem")) == \
+        expected.detector_error_model(decompose_errors=True)
+    assert capsys.readouterr().out.split() == [str(output), str(tmp_path / "d3.dem")]
+
+
+def test_single_circuit_to_stdout(capsys) -> None:
+    main(["--code-task", "toric_code:unrotated_memory_x", "--distance", "3", "--rounds", "2"])
+    out = capsys.readouterr().out
+    assert stim.Circuit(out) == generate_circuit("toric_code:unrotated_memory_x", distance=3, rounds=2)
+
+
+@pytest.mark.parametrize("jobs", ["1", "2"])
+def test_grid_from_json_and_csv(tmp_path, capsys, jobs: str) -> None:
+    specs = [
+        {"code_task": "surface_code:rotated_memory_x", "distance": 3, "rounds": 3,
+         "before_measure_flip_probability": 0.01},
+        {"code_task": "surface_code:unrotated_memory_z", "distance": 3, "rounds": 2, "name": "unrotated"},
+    ]
+    (tmp_path / "grid.json").write_text(json.dumps(specs))
+    (tmp_path / "grid.csv").write_text(
+        "code_task,distance,x_distance,z_distance,rounds,before_measure_flip_probability,name\n"
+        "surface_code:rotated_memory_x,3,,,3,0.01,\n"
+        "surface_code:unrotated_memory_z,3,,,2,,unrotated\n"
+    )
+    for grid in ["grid.json", "grid.csv"]:
+        out_dir = tmp_path / grid.replace(".", "_")
+        main(["--grid", str(tmp_path / grid), "--output-dir", str(out_dir), "--jobs", jobs, "--dem"])
+        content_hash = _params_from_code_task(
+            **{k: v for k, v in specs[0].items() if k != "name"}).content_hash()
+        written = capsys.readouterr().out.split()
+        assert written == [str(out_dir / f"{content_hash}.stim"), str(out_dir / f"{content_hash}.dem"),
+                           str(out_dir / "unrotated.stim"), str(out_dir / "unrotated.dem")]
+        for spec, path in zip(specs, written[::2]):
+            kwargs = {k: v for k, v in spec.items() if k != "name"}
+            assert stim.Circuit.from_file(path) == generate_circuit(**kwargs)
+
+
+def test_grid_rejects_unknown_fields(tmp_path) -> None:
+    (tmp_path / "grid.json").write_text(json.dumps([{"code_task": "surface_code:rotated_memory_x", "p": 1}]))
+    with pytest.raises(SystemExit):
+        main(["--grid", str(tmp_path / "grid.json")])
+
+
+@pytest.mark.parametrize("spec,message", [
+    ({"code_task": "surface_code:rotated_memory_x", "distance": 3}, "rounds"),
+    ({"code_task": "surface_code:rotated_memory_x", "rounds": 3, "x_distance": 3}, "distance"),
+])
+def test_grid_reports_missing_fields(tmp_path, capsys, spec, message: str) -> None:
+    (tmp_path / "grid.json").write_text(json.dumps([spec]))
+    with pytest.raises(SystemExit):
+        main(["--grid", str(tmp_path / "grid.json"), "--output-dir", str(tmp_path / "out")])
+    assert message in capsys.readouterr().err
+
+
+def test_grid_rejects_duplicate_output_names(tmp_path, capsys) -> None:
+    spec = {"code_task": "surface_code:rotated_memory_x", "rounds": 2, "distance": 3}
+    for specs in ([dict(spec, name="a"), dict(spec, distance=5, name="a")], [spec, spec]):
+        (tmp_path / "grid.json").write_text(json.dumps(specs))
+        with pytest.raises(SystemExit):
+            main(["--grid", str(tmp_path / "grid.json"), "--output-dir", str(tmp_path / "out"), "--jobs", "2"])
+        assert "distinct names" in capsys.readouterr().err
+        assert not (tmp_path / "out").exists()
+
+
+@pytest.mark.parametrize("jobs", ["0", "-2", "two"])
+def test_grid_rejects_invalid_jobs(tmp_path, capsys, jobs: str) -> None:
+    (tmp_path / "grid.json").write_text(json.dumps([{"code_task": "surface_code:rotated_memory_x", "rounds": 2,
+                                                     "distance": 3}]))
+    with pytest.raises(SystemExit):
+        main(["--grid", str(tmp_path / "grid.json"), "--output-dir", str(tmp_path / "out"), "--jobs", jobs])
+    assert "--jobs" in capsys.readouterr().err
+    assert not (tmp_path / "out").exists()
+
+
+def test_submodules_are_reachable_from_the_package() -> None:
+    code = "import stimcircuits; print(stimcircuits.surface_code.generate_circuit is stimcircuits.generate_circuit)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert out.split() == ["True"]
+
+
+def test_module_entry_point_does_not_import_stim_until_needed() -> None:
+    code = "import sys, stimcircuits, stimcircuits.cli; print('stim' in sys.modules, 'numpy' in sys.modules)"
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+    assert out.split() == ["False", "False"]
+    out = subprocess.run([sys.executable, "-m", "stimcircuits", "--help"], capture_output=True, text=True,
+                         check=True).stdout
+    assert "--grid" in out
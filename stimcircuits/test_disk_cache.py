@@ -0,0 +1,113 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import os
+
+import pytest
+import stim
+
+from stimcircuits.disk_cache import DiskCache
+from stimcircuits.surface_code import generate_circuit, generate_detector_error_model
+
+circuit_kwargs = dict(
+    code_task="surface_code:rotated_memory_x",
+    distance=3,
+    rounds=4,
+    after_clifford_depolarization=0.1 / 3,
+    before_measure_flip_probability=0.002,
+)
+
+
+def test_cached_circuit_and_dem_match_uncached(tmp_path) -> None:
+    expected_circuit = generate_circuit(**circuit_kwargs)
+    expected_dem = expected_circuit.detector_error_model(decompose_errors=True)
+    for _ in range(2):
+        assert generate_circuit(**circuit_kwargs, cache_dir=tmp_path) == expected_circuit
+        assert generate_detector_error_model(**circuit_kwargs, cache_dir=tmp_path) == expected_dem
+    assert sorted(os.path.splitext(f)[1] for f in os.listdir(tmp_path)) == [".dem", ".stim"]
+    assert generate_detector_error_model(**circuit_kwargs) == expected_dem
+
+
+def test_cache_hit_skips_generation(tmp_path) -> None:
+    cache = DiskCache(tmp_path)
+    generate_detector_error_model(**circuit_kwargs, cache_dir=cache)
+    (dem_file,) = [f for f in os.listdir(tmp_path) if f.endswith(".dem")]
+    # A planted entry is returned as is, showing that nothing was recomputed.
+    cache.put_text(dem_file, "error(0.125) D0\n")
+    assert generate_detector_error_model(**circuit_kwargs, cache_dir=cache) == stim.DetectorErrorModel(
+        "error(0.125) D0")
+
+
+def test_entry_key_depends_on_parameters_not_how_distance_is_given(tmp_path) -> None:
+    cache = DiskCache(tmp_path)
+    generate_circuit(**circuit_kwargs, cache_dir=cache)
+    generate_circuit(**{**circuit_kwargs, "x_distance": 5, "z_distance": 7}, cache_dir=cache)
+    assert len(os.listdir(tmp_path)) == 1
+    generate_circuit(**{**circuit_kwargs, "rounds": 5}, cache_dir=cache)
+    assert len(os.listdir(tmp_path)) == 2
+
+
+def test_eviction_keeps_cache_under_max_bytes(tmp_path) -> None:
+    cache = DiskCache(tmp_path, max_bytes=250)
+    keys = [f"{k:064x}" for k in range(5)]
+    for key in keys:
+        cache.put_text(f"{key}.stim", "H 0\n" * 20)
+    assert cache.total_bytes() <= 250
+    assert sorted(os.listdir(tmp_path)) == [f"{key}.stim" for key in keys[2:]]
+    cache.clear()
+    assert os.listdir(tmp_path) == []
+
+
+def test_puts_only_scan_the_directory_when_needed(tmp_path, monkeypatch) -> None:
+    scans = []
+    entries = DiskCache._entries
+    monkeypatch.setattr(DiskCache, "_entries", lambda self: scans.append(1) or entries(self))
+    cache = DiskCache(tmp_path, max_bytes=10_000)
+    for k in range(200):
+        cache.put_text(f"{k:064x}.stim", "H 0\n")
+    # One scan to start the running total, then one every 64 puts.
+    assert len(scans) == 1 + 200 // 64
+    # Crossing max_bytes evicts straight away.
+    cache.put_text(f"{200:064x}.stim", "H 0\n" * 2500)
+    assert cache.total_bytes() <= 10_000
+
+
+def test_other_files_in_cache_dir_are_kept(tmp_path) -> None:
+    # Files that aren't entries, including old ones named like temporary files.
+    others = ["results.csv", "notes.stim", ".tmp-old", "abc.dem"]
+    for name in others:
+        (tmp_path / name).write_text("x" * 1000)
+        os.utime(tmp_path / name, (0, 0))
+    cache = DiskCache(tmp_path, max_bytes=100)
+    generate_detector_error_model(**circuit_kwargs, cache_dir=cache)
+    cache.evict()
+    assert cache.total_bytes() <= 100
+    assert set(others) <= set(os.listdir(tmp_path))
+    cache.clear()
+    assert sorted(os.listdir(tmp_path)) == sorted(others)
+    with pytest.raises(ValueError):
+        cache.put_text("results.csv", "overwritten")
+
+
+def _generate_in_subprocess(cache_dir: str) -> str:
+    return str(generate_detector_error_model(**circuit_kwargs, cache_dir=cache_dir))
+
+
+def test_concurrent_processes_share_cache(tmp_path) -> None:
+    with concurrent.futures.ProcessPoolExecutor(max_workers=4) as executor:
+        texts = list(executor.map(_generate_in_subprocess, [str(tmp_path)] * 8))
+    expected = generate_circuit(**circuit_kwargs).detector_error_model(decompose_errors=True)
+    assert all(stim.DetectorErrorModel(text) == expected for text in texts)
+    assert not any(f.startswith(".stimcircuits-tmp-") for f in os.listdir(tmp_path))
@@ -0,0 +1,161 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import math
+import time
+
+import numpy as np
+import pytest
+
+from stimcircuits import estimation
+from stimcircuits.estimation import (
+    BATCHES_PER_TASK,
+    _task_seed,
+    estimate_logical_error_rate,
+    schedule_shots,
+    wilson_interval,
+)
+from stimcircuits.surface_code import generate_circuit, iter_grid_metadata
+
+KWARGS = dict(distance=3, rounds=3, after_clifford_depolarization=0.02)
+
+
+def test_estimate_is_independent_of_workers() -> None:
+    serial = estimate_logical_error_rate("surface_code:rotated_memory_z", max_shots=5000, batch_size=700,
+                                         workers=1, seed=5, **KWARGS)
+    parallel = estimate_logical_error_rate("surface_code:rotated_memory_z", max_shots=5000, batch_size=700,
+                                           workers=2, seed=5, **KWARGS)
+    assert serial == parallel
+    assert serial.shots == 5000
+    assert 0 < serial.errors < 5000
+    assert serial.logical_error_rate == serial.errors / 5000
+
+
+def test_early_stopping_is_deterministic() -> None:
+    results = [
+        estimate_logical_error_rate("surface_code:rotated_memory_x", max_shots=100_000, max_errors=50,
+                                    batch_size=100, workers=workers, seed=1, **KWARGS)
+        for workers in (1, 3)
+    ]
+    assert results[0] == results[1]
+    assert results[0].errors >= 50
+    assert results[0].shots < 100_000
+    assert results[0].shots % 100 == 0
+
+
+def test_batches_of_a_task_share_one_sampler() -> None:
+    estimate = estimate_logical_error_rate("surface_code:rotated_memory_z", max_shots=BATCHES_PER_TASK * 100,
+                                           batch_size=100, workers=1, seed=7, **KWARGS)
+    sampler = generate_circuit("surface_code:rotated_memory_z", **KWARGS).compile_detector_sampler(
+        seed=_task_seed(7, 0))
+    errors = sum(int(np.count_nonzero(np.any(sampler.sample(100, separate_observables=True)[1], axis=1)))
+                 for _ in range(BATCHES_PER_TASK))
+    assert estimate == (BATCHES_PER_TASK * 100, errors, 7)
+
+
+def test_noiseless_circuit_has_no_errors() -> None:
+    estimate = estimate_logical_error_rate("toric_code:unrotated_memory_x", max_shots=1000, distance=3, rounds=2,
+                                           workers=1)
+    assert estimate == (1000, 0, estimate.seed)
+    assert math.isnan(estimate_logical_error_rate("surface_code:rotated_memory_x", max_shots=0, distance=3,
+                                                  rounds=2, workers=1).logical_error_rate)
+
+
+def test_decoding_reduces_errors() -> None:
+    pytest.importorskip("pymatching")
+    raw = estimate_logical_error_rate("surface_code:rotated_memory_z", max_shots=5000, workers=1, seed=2, **KWARGS)
+    decoded = estimate_logical_error_rate("surface_code:rotated_memory_z", max_shots=5000, workers=1, seed=2,
+                                          decoder="pymatching", **KWARGS)
+    assert decoded.errors < raw.errors
+
+
+def test_invalid_arguments() -> None:
+    with pytest.raises(ValueError):
+        estimate_logical_error_rate("surface_code:rotated_memory_z", max_shots=10, decoder="unknown", **KWARGS)
+    with pytest.raises(ValueError):
+        estimate_logical_error_rate("surface_code:rotated_memory_z", max_shots=10, max_errors=0, **KWARGS)
+    with pytest.raises(ValueError):
+        estimate_logical_error_rate("surface_code:rotated_memory_z", max_shots=10, workers=0, **KWARGS)
+
+
+def test_wilson_interval() -> None:
+    low, high = wilson_interval(10, 100)
+    assert low < 0.1 < high
+    assert wilson_interval(0, 100)[0] == 0
+    assert wilson_interval(0, 0) == (0, 1)
+    assert wilson_interval(1000, 10000)[1] - wilson_interval(1000, 10000)[0] < high - low
+
+
+GRID = list(iter_grid_metadata(["surface_code:rotated_memory_z"], [3], [2, 4], [0.001, 0.02]))
+
+
+def test_schedule_spends_the_budget_where_intervals_are_widest() -> None:
+    estimates = schedule_shots(GRID, max_shots=20_000, batch_size=1000, seed=3)
+    assert [e.point["rounds"] for e in estimates] == [p["rounds"] for p in GRID]
+    assert sum(e.shots for e in estimates) == 20_000
+    assert all(e.shots >= 1000 and e.seconds > 0 for e in estimates)
+    # Rarer errors have wider relative intervals, so get more shots.
+    low_noise = sum(e.shots for e in estimates if e.point["after_clifford_depolarization"] == 0.001)
+    assert low_noise > 20_000 - low_noise
+
+
+def test_schedule_times_only_sampling(monkeypatch) -> None:
+    def slow_generate(params):
+        time.sleep(0.5)
+        return generate_circuit(f"{params.code_name}:{params.task}", **KWARGS)
+
+    monkeypatch.setattr(estimation, "generate_surface_or_toric_code_circuit_from_params", slow_generate)
+    monkeypatch.setattr(estimation, "_worker_cache", estimation.LRUCache(maxsize=4))
+    (estimate,) = schedule_shots(GRID[:1], max_shots=100, batch_size=100, seed=3)
+    assert estimate.shots == 100
+    # Generating the circuit isn't charged to the point's shots.
+    assert 0 < estimate.seconds < 0.5
+    # But it is charged to the budget, so the second point is never sampled.
+    estimates = schedule_shots(GRID[2:4], max_seconds=0.25, batch_size=100, seed=3)
+    assert [e.shots for e in estimates] == [100, 0]
+
+
+def test_schedule_builds_each_point_once(monkeypatch) -> None:
+    builds = []
+
+    def counting_generate(params):
+        builds.append(params.content_hash())
+        return generate_circuit(f"{params.code_name}:{params.task}", distance=params.distance,
+                                rounds=params.rounds,
+                                after_clifford_depolarization=params.after_clifford_depolarization)
+
+    monkeypatch.setattr(estimation, "generate_surface_or_toric_code_circuit_from_params", counting_generate)
+    monkeypatch.setattr(estimation, "_worker_cache", estimation.LRUCache(maxsize=4))
+    grid = list(iter_grid_metadata(["surface_code:rotated_memory_z"], [3], [2, 3, 4], [0.001, 0.01, 0.02]))
+    estimates = schedule_shots(grid, max_shots=30_000, batch_size=200, seed=3)
+    assert len(grid) > 4 and sum(e.shots for e in estimates) == 30_000
+    assert sorted(builds) == sorted(set(builds)) and len(builds) == len(grid)
+    # The cache is given back its own size afterwards.
+    assert estimation._worker_cache.info().maxsize == 4
+
+
+def test_schedule_resumes_from_checkpoint(tmp_path) -> None:
+    path = tmp_path / "schedule.json"
+    first = schedule_shots(GRID, max_shots=8000, batch_size=1000, seed=3, checkpoint_path=path)
+    saved = json.loads(path.read_text())
+    assert saved["seed"] == 3
+    assert sum(p["shots"] for p in saved["points"].values()) == 8000
+
+    resumed = schedule_shots(GRID, max_shots=12_000, batch_size=1000, checkpoint_path=path, workers=2)
+    assert sum(e.shots for e in resumed) == 12_000
+    assert all(r.shots >= f.shots and r.errors >= f.errors for r, f in zip(resumed, first))
+    assert schedule_shots(GRID, max_shots=12_000, batch_size=1000, checkpoint_path=path) == resumed
+    with pytest.raises(ValueError):
+        schedule_shots(GRID, max_shots=12_000, checkpoint_path=path, seed=4)
@@ -0,0 +1,50 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from stimcircuits.instrumentation import GenerationStats, PHASES
+from stimcircuits.surface_code import generate_circuit, layout_cache
+
+
+def test_phases_are_recorded() -> None:
+    layout_cache.clear()
+    calls = []
+    stats = GenerationStats(callback=lambda phase, seconds, counts: calls.append(phase))
+    circuit = generate_circuit("surface_code:rotated_memory_x", distance=5, rounds=5,
+                               after_clifford_depolarization=0.001, stats=stats)
+    assert set(stats.phases) == set(PHASES)
+    assert sorted(calls) == sorted(PHASES)
+    assert stats.phases["layout"].counts == {"cache_misses": 1}
+    assert stats.phases["indexing"].counts["qubits"] == 2 * 5 ** 2 - 1
+    assert stats.phases["cnot_scheduling"].counts["cnots"] == 4 * 16 + 2 * 8
+    detectors = sum(stats.phases[p].counts["detectors"] for p in ("head", "body", "tail"))
+    assert detectors + 3 * stats.phases["body"].counts["detectors"] == circuit.num_detectors
+    # Nested phases are only counted once in the total.
+    assert stats.total_seconds() <= sum(s.seconds for s in stats.phases.values())
+    assert str(stats).count("\n") == len(PHASES) - 1
+
+
+def test_cache_hits_skip_layout_building() -> None:
+    layout_cache.clear()
+    stats = GenerationStats()
+    for _ in range(2):
+        generate_circuit("toric_code:unrotated_memory_z", distance=3, rounds=2, stats=stats)
+    assert stats.phases["layout"].counts == {"cache_misses": 1, "cache_hits": 1}
+    assert stats.phases["indexing"].calls == 1
+    assert stats.phases["head"].calls == 2
+
+
+def test_generation_without_stats_is_unchanged() -> None:
+    kwargs = dict(code_task="surface_code:unrotated_memory_x", distance=3, rounds=3,
+                  before_measure_flip_probability=0.01)
+    assert generate_circuit(**kwargs) == generate_circuit(**kwargs, stats=GenerationStats())
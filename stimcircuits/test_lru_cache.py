@@ -0,0 +1,87 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from stimcircuits.lru_cache import LRUCache
+
+
+def test_hits_misses_and_evictions() -> None:
+    cache = LRUCache(maxsize=2)
+    assert cache.get_or_create("a", lambda: 1) == 1
+    assert cache.get_or_create("b", lambda: 2) == 2
+    assert cache.get_or_create("a", lambda: -1) == 1
+    # "b" is now the least recently used entry.
+    assert cache.get_or_create("c", lambda: 3) == 3
+    assert "a" in cache
+    assert "b" not in cache
+    info = cache.info()
+    assert (info.hits, info.misses, info.evictions, info.maxsize, info.currsize) == (1, 3, 1, 2, 2)
+
+
+def test_resize_and_clear() -> None:
+    cache = LRUCache(maxsize=3)
+    for k in range(3):
+        cache.get_or_create(k, lambda: k)
+    cache.resize(1)
+    assert len(cache) == 1
+    assert 2 in cache
+    assert cache.info().evictions == 2
+    cache.clear()
+    assert cache.info() == (0, 0, 0, 1, 0)
+
+
+def test_zero_maxsize_disables_storage() -> None:
+    cache = LRUCache(maxsize=0)
+    calls = []
+    cache.get_or_create("a", lambda: calls.append(1))
+    cache.get_or_create("a", lambda: calls.append(1))
+    assert len(calls) == 2
+    assert len(cache) == 0
+
+
+def test_negative_maxsize() -> None:
+    with pytest.raises(ValueError):
+        LRUCache(maxsize=-1)
+
+
+def test_concurrent_misses_build_once() -> None:
+    cache = LRUCache()
+    calls = []
+
+    def slow_factory():
+        calls.append(threading.get_ident())
+        time.sleep(0.05)
+        return object()
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        values = list(pool.map(lambda _: cache.get_or_create("a", slow_factory), range(8)))
+    assert len(calls) == 1
+    assert all(v is values[0] for v in values)
+    assert cache.info().misses == 1
+    assert cache.info().hits == 7
+
+
+def test_failed_factory_is_retried() -> None:
+    cache = LRUCache()
+
+    def fail():
+        raise RuntimeError("boom")
+
+    with pytest.raises(RuntimeError):
+        cache.get_or_create("a", fail)
+    assert cache.get_or_create("a", lambda: 1) == 1
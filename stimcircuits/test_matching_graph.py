@@ -0,0 +1,158 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+from typing import Dict, Tuple
+
+import numpy as np
+import pytest
+import stim
+
+from stimcircuits.analytic_dem import generate_analytic_detector_error_model
+from stimcircuits.matching_graph import MatchingGraph, generate_matching_graph, matching_graph_from_dem
+from stimcircuits.surface_code import generate_detector_error_model
+
+
+def _reference_edges(dem: stim.DetectorErrorModel) -> Dict[Tuple[int, int], Tuple[float, int]]:
+    """Builds the edges of the graph one flattened instruction at a time."""
+    boundary = dem.num_detectors
+    edges: Dict[Tuple[int, int], Tuple[float, int]] = {}
+    for instruction in dem.flattened():
+        if instruction.type != "error":
+            continue
+        p = instruction.args_copy()[0]
+        components = [[]]
+        for target in instruction.targets_copy():
+            if target.is_separator():
+                components.append([])
+            else:
+                components[-1].append(target)
+        for component in components:
+            dets = [t.val for t in component if t.is_relative_detector_id()]
+            obs = sum(1 << t.val for t in component if t.is_logical_observable_id())
+            if not dets:
+                continue
+            key = tuple(sorted(dets + [boundary] * (2 - len(dets))))
+            if key in edges:
+                q, first_obs = edges[key]
+                edges[key] = (p * (1 - q) + q * (1 - p), first_obs)
+            else:
+                edges[key] = (p, obs)
+    return edges
+
+
+@pytest.mark.parametrize("code_task,exclude", [
+    ("surface_code:rotated_memory_x", True),
+    ("surface_code:rotated_memory_z", False),
+    ("surface_code:unrotated_memory_x", True),
+    ("toric_code:unrotated_memory_z", True),
+])
+def test_matching_graph_matches_dem(code_task: str, exclude: bool) -> None:
+    # Enough rounds for the detector error model to contain a repeat block.
+    dem = generate_detector_error_model(code_task, distance=3, rounds=12, after_clifford_depolarization=0.001,
+                                        before_measure_flip_probability=0.002,
+                                        exclude_other_basis_detectors=exclude)
+    assert "repeat" in str(dem)
+    graph = matching_graph_from_dem(dem)
+    expected = _reference_edges(dem)
+    assert graph.num_detectors == dem.num_detectors
+    assert graph.num_edges == len(expected)
+    for (u, v), p, w, obs, is_boundary in zip(graph.edges.tolist(), graph.probabilities, graph.weights,
+                                               graph.observables.tolist(), graph.is_boundary):
+        expected_p, expected_obs = expected[(u, v)]
+        assert p == pytest.approx(expected_p, rel=1e-12)
+        assert w == pytest.approx(np.log((1 - p) / p))
+        assert obs == expected_obs
+        assert is_boundary == (v == graph.boundary_node)
+    for array in (graph.edges, graph.probabilities, graph.weights, graph.observables, graph.is_boundary):
+        assert array.flags.c_contiguous
+
+
+@pytest.mark.parametrize("code_task", ["surface_code:rotated_memory_x", "surface_code:unrotated_memory_z",
+                                       "toric_code:unrotated_memory_x"])
+@pytest.mark.parametrize("rounds,patches", [(1, 1), (2, 1), (3, 1), (6, 2)])
+def test_generated_graph_matches_analytic_dem(code_task: str, rounds: int, patches: int) -> None:
+    kwargs = dict(distance=3, rounds=rounds, patches=patches, after_clifford_depolarization=0.001,
+                  before_round_data_depolarization=0.002, before_measure_flip_probability=0.003,
+                  after_reset_flip_probability=0.004)
+    graph = generate_matching_graph(code_task, **kwargs)
+    expected = matching_graph_from_dem(generate_analytic_detector_error_model(code_task, **kwargs))
+    assert (graph.num_detectors, graph.num_observables) == (expected.num_detectors, expected.num_observables)
+    # Compare edges regardless of their order.
+    order, expected_order = (np.lexsort(g.edges.T[::-1]) for g in (graph, expected))
+    np.testing.assert_array_equal(graph.edges[order], expected.edges[expected_order])
+    np.testing.assert_allclose(graph.probabilities[order], expected.probabilities[expected_order], rtol=1e-12)
+    np.testing.assert_array_equal(graph.observables[order], expected.observables[expected_order])
+
+
+def test_csr() -> None:
+    graph = generate_matching_graph("surface_code:rotated_memory_z", distance=3, rounds=3,
+                                    before_round_data_depolarization=0.01)
+    indptr, indices, edge_ids = graph.to_csr()
+    assert indptr[-1] == 2 * graph.num_edges
+    for node in range(graph.num_detectors + 1):
+        for neighbour, edge in zip(indices[indptr[node]:indptr[node + 1]], edge_ids[indptr[node]:indptr[node + 1]]):
+            assert sorted(graph.edges[edge].tolist()) == sorted([node, neighbour])
+
+
+def test_rejects_non_graphlike_dem() -> None:
+    with pytest.raises(ValueError, match="graphlike"):
+        matching_graph_from_dem(stim.DetectorErrorModel("error(0.1) D0 D1 D2"))
+
+
+def test_merges_parallel_edges_with_different_observables() -> None:
+    # The edge flips the observables of its likeliest errors.
+    graph = matching_graph_from_dem(stim.DetectorErrorModel("error(0.1) D0 D1 L0\nerror(0.2) D1 D0"))
+    assert graph.edges.tolist() == [[0, 1]]
+    assert graph.probabilities[0] == pytest.approx(0.1 * 0.8 + 0.2 * 0.9)
+    assert graph.observables.tolist() == [0]
+    # Errors flipping the same observables count together.
+    graph = matching_graph_from_dem(stim.DetectorErrorModel("error(0.15) D0\nrepeat 2 {\n error(0.1) D0 L0\n}"))
+    assert graph.observables.tolist() == [1]
+    assert graph.probabilities[0] == pytest.approx((1 - 0.7 * 0.8 * 0.8) / 2)
+    # Parallel edges with the same observables are merged.
+    graph = matching_graph_from_dem(stim.DetectorErrorModel("error(0.1) D0 L0\nerror(0.2) D1 ^ D0 L0"))
+    assert graph.edges.tolist() == [[0, 2], [1, 2]]
+    assert graph.probabilities[0] == pytest.approx(0.1 * 0.8 + 0.2 * 0.9)
+    assert graph.observables.tolist() == [1, 0]
+
+
+@pytest.mark.parametrize("code_task", ["surface_code:rotated_memory_x", "toric_code:unrotated_memory_z"])
+def test_generated_graph_of_distance_two(code_task: str) -> None:
+    kwargs = dict(distance=2, rounds=3, after_clifford_depolarization=0.001, before_measure_flip_probability=0.01)
+    graph = generate_matching_graph(code_task, **kwargs)
+    expected = matching_graph_from_dem(generate_analytic_detector_error_model(code_task, **kwargs))
+    order, expected_order = (np.lexsort(g.edges.T[::-1]) for g in (graph, expected))
+    np.testing.assert_array_equal(graph.edges[order], expected.edges[expected_order])
+    np.testing.assert_allclose(graph.probabilities[order], expected.probabilities[expected_order], rtol=1e-12)
+    np.testing.assert_array_equal(graph.observables[order], expected.observables[expected_order])
+
+
+def test_save_load_and_cache(tmp_path) -> None:
+    kwargs = dict(distance=3, rounds=4, after_clifford_depolarization=0.003)
+    graph = generate_matching_graph("surface_code:rotated_memory_x", **kwargs)
+    graph.save(tmp_path / "graph")
+    loaded = MatchingGraph.load(tmp_path / "graph")
+    assert isinstance(loaded.edges, np.memmap)
+    np.testing.assert_array_equal(loaded.edges, graph.edges)
+    np.testing.assert_array_equal(loaded.weights, graph.weights)
+
+    cache_dir = tmp_path / "cache"
+    cached = generate_matching_graph("surface_code:rotated_memory_x", cache_dir=cache_dir, **kwargs)
+    assert isinstance(cached.probabilities, np.memmap)
+    np.testing.assert_array_equal(cached.probabilities, graph.probabilities)
+    assert any(name.endswith(".graph.json") for name in os.listdir(cache_dir))
+    again = generate_matching_graph("surface_code:rotated_memory_x", cache_dir=cache_dir, mmap=False, **kwargs)
+    assert not isinstance(again.observables, np.memmap)
+    np.testing.assert_array_equal(again.observables, graph.observables)
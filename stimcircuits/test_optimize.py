@@ -0,0 +1,127 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import pytest
+import stim
+
+from stimcircuits.optimize import (
+    canonical_error_map,
+    circuits_equivalent,
+    detector_error_models_equivalent,
+    optimize_circuit,
+)
+from stimcircuits.surface_code import generate_circuit
+
+ANNOTATIONS = {"DETECTOR", "OBSERVABLE_INCLUDE", "QUBIT_COORDS", "SHIFT_COORDS", "TICK"}
+
+
+def _num_operations(circuit: stim.Circuit) -> int:
+    return sum(1 for instruction in circuit.flattened() if instruction.name not in ANNOTATIONS)
+
+
+@pytest.mark.parametrize("code_task", [
+    "surface_code:rotated_memory_x",
+    "surface_code:rotated_memory_z",
+    "surface_code:unrotated_memory_x",
+    "toric_code:unrotated_memory_z",
+])
+@pytest.mark.parametrize("remove_ticks", [False, True])
+def test_optimized_circuits_are_equivalent(code_task: str, remove_ticks: bool) -> None:
+    circuit = generate_circuit(code_task, distance=3, rounds=4, after_clifford_depolarization=0.001,
+                               before_round_data_depolarization=0.001, before_measure_flip_probability=0.0023456789,
+                               after_reset_flip_probability=0.0023456789)
+    optimized = optimize_circuit(circuit, remove_ticks=remove_ticks)
+    assert _num_operations(optimized) < _num_operations(circuit)
+    assert circuits_equivalent(circuit, optimized)
+    assert optimized.num_measurements == circuit.num_measurements
+    assert optimized.get_detector_coordinates() == circuit.get_detector_coordinates()
+    assert ("TICK" in str(optimized)) != remove_ticks
+    # Probabilities are kept at full precision.
+    assert any(instruction.gate_args_copy() == [0.0023456789] for instruction in optimized.flattened())
+
+
+def _gate_by_gate(circuit: stim.Circuit) -> stim.Circuit:
+    """Applies each gate of a circuit and its noise to one qubit (or pair) at a time."""
+    instructions = list(circuit.flattened())
+    result = stim.Circuit()
+    k = 0
+    while k < len(instructions):
+        gate = instructions[k]
+        noise = instructions[k + 1] if k + 1 < len(instructions) else None
+        if gate.name in ("CX", "H") and noise is not None and noise.targets_copy() == gate.targets_copy():
+            width = 2 if gate.name == "CX" else 1
+            targets = gate.targets_copy()
+            for start in range(0, len(targets), width):
+                result.append(gate.name, targets[start:start + width])
+                result.append(noise.name, targets[start:start + width], noise.gate_args_copy())
+            k += 2
+        else:
+            result.append(gate)
+            k += 1
+    return result
+
+
+def test_merges_gate_by_gate_circuits() -> None:
+    circuit = generate_circuit("surface_code:rotated_memory_z", distance=5, rounds=5,
+                               after_clifford_depolarization=0.001, before_round_data_depolarization=0.002,
+                               before_measure_flip_probability=0.003, after_reset_flip_probability=0.004)
+    gate_by_gate = _gate_by_gate(circuit)
+    assert len(gate_by_gate.flattened()) > 4 * len(circuit.flattened())
+    optimized = optimize_circuit(gate_by_gate)
+    assert len(optimized.flattened()) <= len(circuit.flattened())
+    assert circuits_equivalent(optimized, circuit)
+    # On the generated circuit itself, most of the reduction comes from removing the TICKs.
+    assert len(optimize_circuit(circuit, remove_ticks=True).flattened()) < 0.9 * len(circuit.flattened())
+
+
+def test_merges_across_other_qubits_only() -> None:
+    circuit = stim.Circuit("""
+        X_ERROR(0.1) 0
+        H 1
+        X_ERROR(0.1) 2
+        CX 0 2
+        X_ERROR(0.1) 3
+        M 0
+        X_ERROR(0.1) 0
+        DETECTOR rec[-1]
+    """)
+    assert optimize_circuit(circuit) == stim.Circuit("""
+        X_ERROR(0.1) 0 2 3
+        H 1
+        CX 0 2
+        M 0
+        X_ERROR(0.1) 0
+        DETECTOR rec[-1]
+    """)
+
+
+def test_moves_blocking_instructions_before_the_merge() -> None:
+    circuit = stim.Circuit("""
+        DEPOLARIZE1(0.1) 0
+        H 1
+        DEPOLARIZE1(0.1) 1
+    """)
+    assert optimize_circuit(circuit) == stim.Circuit("""
+        H 1
+        DEPOLARIZE1(0.1) 0 1
+    """)
+
+
+def test_equivalence_check_detects_differences() -> None:
+    a = stim.DetectorErrorModel("error(0.1) D0 D1\nerror(0.2) D1 ^ D0 L0\nerror(0.01) D0 D1")
+    b = stim.DetectorErrorModel("error(0.2) D0 D1 L0\nerror(0.108) D1 D0")
+    assert canonical_error_map(b) == {frozenset(["D0", "D1", "L0"]): 0.2, frozenset(["D0", "D1"]): 0.108}
+    assert detector_error_models_equivalent(a, b)
+    assert not detector_error_models_equivalent(a, stim.DetectorErrorModel("error(0.2) D0 D1 L0\nerror(0.1) D1 D0"))
+    assert not detector_error_models_equivalent(a, stim.DetectorErrorModel("error(0.2) D0 L0\nerror(0.108) D1 D0"))
@@ -0,0 +1,131 @@
+# Copyright 2022 Oscar Higgott
+
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+
+#      http://www.apache.org/licenses/LICENSE-2.0
+
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import json
+
+import numpy as np
+import pytest
+import stim
+
+from stimcircuits.sampling import (
+    compiled_detector_sampler,
+    compiled_m2d_converter,
+    sample_to_file,
+    sampler_cache,
+)
+from stimcircuits.surface_code import generate_circuit
+
+CIRCUIT_KWARGS = dict(
+    code_task="surface_code:rotated_memory_z",
+    distance=3,
+    rounds=3,
+    after_clifford_depolarization=0.02,
+    before_measure_flip_probability=0.02,
+)
+
+
+@pytest.mark.parametrize("format", ["b8", "01"])
+def test_sample_to_file_matches_stim(tmp_path, format: str) -> None:
+    path = tmp_path / f"dets.{format}"
+    result = sample_to_file(**CIRCUIT_KWARGS, shots=1001, chunk_size=2000, path=path, format=format, seed=5)
+    circuit = generate_circuit(**CIRCUIT_KWARGS)
+    assert result.num_detectors == circuit.num_detectors
+    dets = stim.read_shot_data_file(path=str(path), format=format, num_detectors=circuit.num_detectors)
+    obs = stim.read_shot_data_file(path=result.obs_path, format=format, num_observables=1)
+    assert dets.shape == (1001, circuit.num_detectors)
+    assert obs.shape == (1001, 1)
+
+    expected_dets, expected_obs = circuit.compile_detector_sampler(seed=5).sample(1001, separate_observables=True)
+    np.testing.assert_array_equal(dets, expected_dets)
+    np.testing.assert_array_equal(obs, expected_obs)
+
+
+def test_sample_to_file_is_deterministic_when_seeded(tmp_path) -> None:
+    for name in ["a", "b"]:
+        sample_to_file(**CIRCUIT_KWARGS, shots=1001, chunk_size=100, path=tmp_path / name, seed=3)
+    assert (tmp_path / "a").read_bytes() == (tmp_path / "b").read_bytes()
+    assert (tmp_path / "a.obs").read_bytes() == (tmp_path / "b.obs").read_bytes()
+
+
+def test_sample_to_file_resumes(tmp_path) -> None:
+    path = tmp_path / "dets.b8"
+    progress_path = tmp_path / "dets.b8.progress"
+    sample_to_file(**CIRCUIT_KWARGS, shots=500, chunk_size=100, path=path, seed=1)
+    complete = path.read_bytes()
+
+    # Simulate an interruption after the first two chunks.
+    progress = json.loads(progress_path.read_text())
+    assert progress["shots_done"] == 500
+    progress["shots_done"] = 200
+    progress_path.write_text(json.dumps(progress))
+    row = len(complete) // 500
+    path.write_bytes(complete[:200 * row] + bytes(300 * row))
+
+    sample_to_file(**CIRCUIT_KWARGS, shots=500, chunk_size=100, path=path, seed=1)
+    resumed = path.read_bytes()
+    assert resumed[:200 * row] == complete[:200 * row]
+    assert any(resumed[200 * row:])
+    assert json.loads(progress_path.read_text())["shots_done"] == 500
+
+    # Finished runs aren't resampled.
+    sample_to_file(**CIRCUIT_KWARGS, shots=500, chunk_size=100, path=path, seed=1)
+    assert path.read_bytes() == resumed
+
+
+def test_sample_to_file_refuses_to_mix_runs(tmp_path) -> None:
+    path = tmp_path / "dets.b8"
+    sample_to_file(**CIRCUIT_KWARGS, shots=10, path=path)
+    with pytest.raises(ValueError, match="different sampling run"):
+        sample_to_file(**CIRCUIT_KWARGS, shots=20, path=path)
+    with pytest.raises(ValueError, match="format"):
+        sample_to_file(**CIRCUIT_KWARGS, shots=10, path=tmp_path / "other", format="csv")
+
+
+def test_compiled_samplers_are_cached() -> None:
+    sampler_cache.clear()
+    sampler = compiled_detector_sampler(**CIRCUIT_KWARGS)
+    assert compiled_detector_sampler(**CIRCUIT_KWARGS) is sampler
+    # Equal parameters of different types share the entry.
+    kwargs = dict(CIRCUIT_KWARGS, before_measure_flip_probability=np.float64(0.02), x_distance=7)
+    assert compiled_detector_sampler(**kwargs) is sampler
+    assert compiled_detector_sampler(**dict(CIRCUIT_KWARGS, rounds=4)) is not sampler
+    assert sampler.sample(10).shape == (10, generate_circuit(**CIRCUIT_KWARGS).num_detectors)
+
+    converter = compiled_m2d_converter(**CIRCUIT_KWARGS)
+    assert compiled_m2d_converter(**CIRCUIT_KWARGS) is converter
+    info = sampler_cache.info()
+    # The cache holds the two circuits, shared by the samplers and the converter.
+    assert (info.hits, info.misses, info.currsize) == (4, 2, 2)
+    # Samplers of circuits that are no longer cached are compiled again.
+    sampler_cache.clear()
+    assert compiled_detector_sampler(**CIRCUIT_KWARGS) is not sampler
+
+
+def test_compiled_samplers_are_per_thread() -> None:
+    sampler_cache.clear()
+    sampler = compiled_detector_sampler(**CIRCUIT_KWARGS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        other = executor.submit(compiled_detector_sampler, **CIRCUIT_KWARGS).result()
+    assert other is not sampler
+    assert compiled_detector_sampler(**CIRCUIT_KWARGS) is sampler
+    # The threads share the circuit.
+    assert sampler_cache.info().currsize == 1
+
+
+def test_seeded_samplers_are_fresh() -> None:
+    first = compiled_detector_sampler(**CIRCUIT_KWARGS, seed=3)
+    second = compiled_detector_sampler(**CIRCUIT_KWARGS, seed=3)
+    assert first is not second and first is not compiled_detector_sampler(**CIRCUIT_KWARGS)
+    assert np.array_equal(first.sample(20), second.sample(20))
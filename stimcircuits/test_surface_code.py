@@ -12,9 +12,33 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
+
+import numpy as np
 import pytest
 import stim
-from stimcircuits.surface_code import generate_circuit
+from stimcircuits.surface_code import (
+    CircuitGenParameters,
+    HeterogeneousNoiseParameters,
+    generate_surface_or_toric_code_circuit_from_params,
+    get_layout,
+    finish_surface_code_circuit,
+    generate_circuit,
+    generate_circuits,
+    generate_circuits_for_noise_grid,
+    generate_detector_metadata,
+    generate_fragments,
+    fragments_cache,
+    iter_grid_circuits,
+    iter_grid_metadata,
+    layout_cache,
+    write_circuit,
+    write_circuit_from_params,
+    _circuit_from_layout,
+    _params_from_code_task,
+    _rotated_surface_code_layout,
+    _unrotated_surface_or_toric_code_layout,
+)
 from typing import Set
 
 gen_test_params_surface_code = [
@@ -312,3 +336,492 @@ def test_no_boundary_for_toric_code_circuits(
         if isinstance(instruction, stim.DemInstruction) and instruction.type == "error":
             num_dets = sum(1 for t in instruction.targets_copy() if t.is_relative_detector_id())
             assert num_dets > 1
+
+
+def test_layout_cache_is_shared_between_noise_settings_and_bases() -> None:
+    layout_cache.clear()
+    for p in (0.001, 0.002, 0.003):
+        for task in ("surface_code:rotated_memory_x", "surface_code:rotated_memory_z"):
+            generate_circuit(task, distance=5, rounds=3, after_clifford_depolarization=p)
+    info = layout_cache.info()
+    assert info.misses == 1
+    assert info.hits == 5
+    assert info.currsize == 1
+
+    generate_circuit("surface_code:unrotated_memory_x", distance=5, rounds=3)
+    generate_circuit("toric_code:unrotated_memory_x", distance=5, rounds=3)
+    assert layout_cache.info().misses == 3
+
+    layout_cache.clear()
+    assert layout_cache.info() == (0, 0, 0, layout_cache.info().maxsize, 0)
+
+
+def test_cached_layout_gives_identical_circuits() -> None:
+    layout_cache.clear()
+    first = generate_circuit("toric_code:unrotated_memory_z", distance=3, rounds=4,
+                             after_clifford_depolarization=0.01)
+    second = generate_circuit("toric_code:unrotated_memory_z", distance=3, rounds=4,
+                              after_clifford_depolarization=0.01)
+    assert layout_cache.info().hits == 1
+    assert first == second
+
+
+@pytest.mark.parametrize(
+    "code_task,distance,rounds",
+    sorted({(t[0], t[1], t[2]) for t in gen_test_params_surface_code + gen_test_params_toric_code})
+)
+def test_noise_grid_matches_generate_circuit(code_task: str, distance: int, rounds: int) -> None:
+    noise_points = [
+        0.001,
+        0,
+        {"after_clifford_depolarization": 0.01},
+        {"before_round_data_depolarization": 0.02, "after_reset_flip_probability": 0.03},
+        {"before_measure_flip_probability": 0.04, "after_clifford_depolarization": 0.05},
+    ]
+    for exclude in (False, True):
+        circuits = generate_circuits_for_noise_grid(
+            code_task,
+            distance=distance,
+            rounds=rounds,
+            noise_points=noise_points,
+            exclude_other_basis_detectors=exclude
+        )
+        assert len(circuits) == len(noise_points)
+        for noise_point, circuit in zip(noise_points, circuits):
+            if isinstance(noise_point, dict):
+                kwargs = noise_point
+            else:
+                kwargs = dict(
+                    after_clifford_depolarization=noise_point,
+                    before_round_data_depolarization=noise_point,
+                    before_measure_flip_probability=noise_point,
+                    after_reset_flip_probability=noise_point
+                )
+            expected = generate_circuit(
+                code_task,
+                distance=distance,
+                rounds=rounds,
+                exclude_other_basis_detectors=exclude,
+                **kwargs
+            )
+            assert circuit == expected
+
+
+def test_noise_grid_rejects_unknown_noise_parameters() -> None:
+    with pytest.raises(ValueError):
+        generate_circuits_for_noise_grid(
+            "surface_code:rotated_memory_x",
+            distance=3,
+            rounds=2,
+            noise_points=[{"after_clifford_depolarisation": 0.01}]
+        )
+
+
+@pytest.mark.parametrize("workers,chunksize", [(1, None), (2, None), (2, 1), (3, 5)])
+def test_generate_circuits_matches_generate_circuit(workers: int, chunksize: int) -> None:
+    specs = [
+        dict(code_task=code_task, distance=distance, rounds=rounds,
+             after_clifford_depolarization=p1, before_round_data_depolarization=p2,
+             before_measure_flip_probability=p3, after_reset_flip_probability=p4)
+        for code_task, distance, rounds, p1, p2, p3, p4 in gen_test_params_surface_code + gen_test_params_toric_code
+    ]
+    specs.append(dict(code_task="surface_code:rotated_memory_z", x_distance=3, z_distance=5, rounds=2,
+                      after_clifford_depolarization=0.1 / 3, exclude_other_basis_detectors=True))
+    circuits = generate_circuits(specs, workers=workers, chunksize=chunksize)
+    assert circuits == [generate_circuit(**spec) for spec in specs]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_generate_circuits_accepts_the_same_specs_for_any_workers(workers: int) -> None:
+    specs = [dict(code_task="surface_code:rotated_memory_x", distance=3, rounds=2, patches=2),
+             dict(code_task="toric_code:unrotated_memory_z", distance=2, rounds=3, before_measure_flip_probability=0.01)]
+    assert generate_circuits(specs, workers=workers) == [generate_circuit(**spec) for spec in specs]
+    for option in (dict(return_detector_metadata=True), dict(cache_dir="unused"), dict(noise=0.1)):
+        with pytest.raises(TypeError):
+            generate_circuits([dict(specs[0], **option), specs[1]], workers=workers)
+
+
+def test_generate_circuits_propagates_errors() -> None:
+    with pytest.raises(ValueError):
+        generate_circuits([dict(code_task="surface_code:rotated_memory_x", distance=3, rounds=0)] * 2, workers=2)
+
+
+def _finish_unrotated_circuit(is_toric: bool, is_memory_x: bool, scale: float, **kwargs) -> stim.Circuit:
+    """Lays out an unrotated d=3 patch from Python complex coordinates, scaled by `scale`."""
+    d = 3
+    length = 2 * d if is_toric else 2 * d - 1
+    data_coords: Set[complex] = set()
+    x_measure_coords: Set[complex] = set()
+    z_measure_coords: Set[complex] = set()
+    x_observable = []
+    z_observable = []
+    for x in range(length):
+        for y in range(length):
+            q = (x + y * 1j) * scale
+            if (x % 2) != (y % 2):
+                (z_measure_coords if x % 2 == 0 else x_measure_coords).add(q)
+            else:
+                data_coords.add(q)
+                if x == 0:
+                    x_observable.append(q)
+                if y == 0:
+                    z_observable.append(q)
+    order = [scale, scale * 1j, -scale * 1j, -scale]
+    params = CircuitGenParameters(code_name="toric_code" if is_toric else "surface_code",
+                                  task="unrotated_memory_" + "zx"[is_memory_x], rounds=3, distance=d,
+                                  after_clifford_depolarization=0.001, **kwargs)
+    return finish_surface_code_circuit(
+        lambda q: int(round(q.real / scale + q.imag / scale * length)),
+        data_coords,
+        x_measure_coords,
+        z_measure_coords,
+        params,
+        order,
+        order,
+        x_observable,
+        z_observable,
+        is_memory_x,
+        wraparound_length=2 * d * scale if is_toric else None
+    )
+
+
+@pytest.mark.parametrize("is_toric,is_memory_x", [(False, False), (False, True), (True, False), (True, True)])
+def test_finish_surface_code_circuit_from_python_coordinates(is_toric: bool, is_memory_x: bool) -> None:
+    circuit = _finish_unrotated_circuit(is_toric, is_memory_x, 1)
+    code_name = "toric_code" if is_toric else "surface_code"
+    expected = generate_circuit(f"{code_name}:unrotated_memory_{'zx'[is_memory_x]}", distance=3, rounds=3,
+                                after_clifford_depolarization=0.001)
+    assert circuit == expected
+
+
+def _without_coords(circuit: stim.Circuit) -> stim.Circuit:
+    result = stim.Circuit()
+    for instruction in circuit.flattened():
+        if instruction.name == "DETECTOR":
+            result.append("DETECTOR", instruction.targets_copy())
+        elif instruction.name not in ("QUBIT_COORDS", "SHIFT_COORDS"):
+            result.append(instruction)
+    return result
+
+
+@pytest.mark.parametrize("is_toric,is_memory_x", [(False, False), (True, True)])
+@pytest.mark.parametrize("patches", [1, 2])
+def test_finish_surface_code_circuit_accepts_non_integer_coordinates(
+        is_toric: bool, is_memory_x: bool, patches: int) -> None:
+    circuit = _finish_unrotated_circuit(is_toric, is_memory_x, 0.5, patches=patches)
+    expected = _finish_unrotated_circuit(is_toric, is_memory_x, 1, patches=patches)
+    assert _without_coords(circuit) == _without_coords(expected)
+    if patches == 1:
+        assert circuit.get_final_qubit_coordinates() == {
+            q: [x / 2, y / 2] for q, (x, y) in expected.get_final_qubit_coordinates().items()}
+        assert circuit.get_detector_coordinates() == {
+            k: [x / 2, y / 2, t] for k, (x, y, t) in expected.get_detector_coordinates().items()}
+
+
+def test_toric_layout_wraps_integer_coordinates() -> None:
+    layout = _unrotated_surface_or_toric_code_layout(3, is_toric=True)
+    inside = layout.data_qubits_at([[0, 0], [5, 1]])
+    wrapped = layout.data_qubits_at([[6, 0], [-1, 7]])
+    assert inside.tolist() == wrapped.tolist()
+    assert (inside >= 0).all()
+
+
+def test_stabilizer_neighbour_index() -> None:
+    rotated = _rotated_surface_code_layout(3, 5)
+    assert rotated.stabilizer_neighbours.shape == (len(rotated.measurement_qubits), 4)
+    weights = (rotated.stabilizer_neighbours != -1).sum(axis=1)
+    assert set(weights.tolist()) == {2, 4}
+    assert np.isin(rotated.stabilizer_neighbours[rotated.stabilizer_neighbours != -1], rotated.data_qubits).all()
+    # Each data qubit is in two stabilizers of each type, except on the boundaries.
+    x_counts = np.bincount(rotated.stabilizer_neighbours[rotated.x_stabilizers].ravel() + 1)[1:]
+    assert x_counts[rotated.data_qubits].max() == 2
+
+    toric = _unrotated_surface_or_toric_code_layout(3, is_toric=True)
+    assert (toric.stabilizer_neighbours != -1).all()
+    assert (np.bincount(toric.stabilizer_neighbours.ravel())[toric.data_qubits] == 4).all()
+
+    # The CNOT layers are read off the index.
+    for k, targets in enumerate(toric.cnot_targets):
+        pairs = targets.reshape(-1, 2)
+        x = toric.x_stabilizers
+        z = toric.z_stabilizers
+        assert pairs[:x.stop].tolist() == np.stack(
+            [toric.stabilizer_qubits[x], toric.stabilizer_neighbours[x, k]], axis=1).tolist()
+        assert pairs[x.stop:].tolist() == np.stack(
+            [toric.stabilizer_neighbours[z, k], toric.stabilizer_qubits[z]], axis=1).tolist()
+
+
+@pytest.mark.parametrize(
+    "code_task,distance,rounds,after_clifford_depolarization,before_round_data_depolarization,"
+    "before_measure_flip_probability,after_reset_flip_probability",
+    gen_test_params_surface_code + gen_test_params_toric_code
+)
+def test_bulk_emission_matches_appending_instructions(
+        code_task: str,
+        distance: int,
+        rounds: int,
+        after_clifford_depolarization: float,
+        before_round_data_depolarization: float,
+        before_measure_flip_probability: float,
+        after_reset_flip_probability: float
+) -> None:
+    code_name, task = code_task.split(":")
+    if task.startswith("rotated"):
+        layout = _rotated_surface_code_layout(distance, distance)
+    else:
+        layout = _unrotated_surface_or_toric_code_layout(distance, is_toric=code_name == "toric_code")
+    params = CircuitGenParameters(
+        code_name=code_name,
+        task=task,
+        rounds=rounds,
+        distance=distance,
+        after_clifford_depolarization=after_clifford_depolarization,
+        before_round_data_depolarization=before_round_data_depolarization,
+        before_measure_flip_probability=before_measure_flip_probability,
+        after_reset_flip_probability=after_reset_flip_probability
+    )
+    for exclude in (False, True):
+        kwargs = dict(exclude_other_basis_detectors=exclude)
+        bulk = _circuit_from_layout(layout, params, task.endswith("x"), bulk=True, **kwargs)
+        appended = _circuit_from_layout(layout, params, task.endswith("x"), bulk=False, **kwargs)
+        assert bulk == appended
+
+
+def test_grid_iterator_is_lazy_and_matches_generate_circuit() -> None:
+    grid = dict(
+        code_tasks=["surface_code:rotated_memory_x", "toric_code:unrotated_memory_z"],
+        distances=iter([3, 4]),
+        rounds=lambda d: [1, d],
+        noise_points=[0, 0.001, {"after_clifford_depolarization": 0.01}],
+    )
+    metadata = list(iter_grid_metadata(**grid))
+    assert len(metadata) == 2 * 2 * 2 * 3
+    assert metadata[0]["content_hash"] == CircuitGenParameters(
+        code_name="surface_code", task="rotated_memory_x", rounds=1, distance=3).content_hash()
+    assert len({m["content_hash"] for m in metadata}) == len(metadata)
+
+    grid["distances"] = [3, 4]
+    layout_cache.clear()
+    pairs = iter_grid_circuits(**grid)
+    assert layout_cache.info().misses == 0
+    for expected, (m, circuit) in zip(metadata, pairs):
+        assert m == expected
+        kwargs = {k: v for k, v in m.items() if k != "content_hash"}
+        assert circuit == generate_circuit(**kwargs)
+
+
+def test_grid_iterator_skips_finished_points() -> None:
+    grid = dict(
+        code_tasks=["surface_code:unrotated_memory_x"],
+        distances=[3],
+        rounds=[2, 3],
+        noise_points=[0.001, 0.002],
+    )
+    metadata = list(iter_grid_metadata(**grid))
+    done = {metadata[0]["content_hash"], metadata[3]["content_hash"]}
+    remaining = [m for m, _ in iter_grid_circuits(**grid, skip=done)]
+    assert remaining == metadata[1:3]
+
+
+@pytest.mark.parametrize("code_task", [
+    "surface_code:rotated_memory_x",
+    "surface_code:unrotated_memory_z",
+    "toric_code:unrotated_memory_x",
+])
+def test_fragments_with_rounds_match_generate_circuit(code_task: str) -> None:
+    fragments_cache.clear()
+    kwargs = dict(distance=3, after_clifford_depolarization=0.001, before_measure_flip_probability=0.002)
+    for rounds in range(1, 7):
+        fragments = generate_fragments(code_task, **kwargs)
+        assert fragments.with_rounds(rounds) == generate_circuit(code_task, rounds=rounds, **kwargs)
+    assert fragments_cache.info().misses == 1
+    assert fragments_cache.info().hits == 5
+    with pytest.raises(ValueError):
+        fragments.with_rounds(0)
+
+
+@pytest.mark.parametrize("code_task", [
+    "surface_code:rotated_memory_x",
+    "surface_code:rotated_memory_z",
+    "surface_code:unrotated_memory_x",
+    "toric_code:unrotated_memory_z",
+])
+def test_detector_metadata_matches_circuit(code_task: str) -> None:
+    for exclude in (False, True):
+        circuit, metadata = generate_circuit(code_task, distance=3, rounds=4, exclude_other_basis_detectors=exclude,
+                                             return_detector_metadata=True)
+        assert len(metadata) == circuit.num_detectors
+        detector_coords = circuit.get_detector_coordinates()
+        qubit_coords = circuit.get_final_qubit_coordinates()
+        for k, entry in enumerate(metadata):
+            assert detector_coords[k] == [entry["x"], entry["y"], entry["round"]]
+            assert qubit_coords[entry["qubit"]] == [entry["x"], entry["y"]]
+            if "unrotated" in code_task:
+                # X stabilizers are measured at odd x coordinates.
+                assert (entry["x"] % 2 == 1) == (entry["basis"] == "X")
+        chosen_basis = "X" if code_task.endswith("x") else "Z"
+        assert set(metadata["basis"][metadata["round"] == 0]) == {chosen_basis}
+        assert set(metadata["basis"]) == ({chosen_basis} if exclude else {"X", "Z"})
+
+
+def test_detector_metadata_without_circuit() -> None:
+    metadata = generate_detector_metadata("surface_code:rotated_memory_z", distance=5, rounds=10)
+    circuit = generate_circuit("surface_code:rotated_memory_z", distance=5, rounds=10)
+    assert len(metadata) == circuit.num_detectors
+    assert np.array_equal(np.bincount(metadata["round"]), [12] + [24] * 9 + [12])
+
+
+def _heterogeneous_params(code_task: str, values, seed: int = 0, **kwargs) -> HeterogeneousNoiseParameters:
+    code_name, task = code_task.split(":")
+    layout = get_layout(code_task, distance=3)
+    rng = np.random.default_rng(seed)
+    n = int(layout.qubits.max()) + 1
+    return HeterogeneousNoiseParameters(
+        code_name=code_name,
+        task=task,
+        rounds=3,
+        distance=3,
+        qubit_after_clifford_depolarization=rng.choice(values, n),
+        qubit_before_round_data_depolarization=rng.choice(values, n),
+        qubit_before_measure_flip_probability=rng.choice(values, n),
+        qubit_after_reset_flip_probability=rng.choice(values, n),
+        couplers=layout.couplers[:, ::-1],
+        coupler_after_clifford_depolarization=rng.choice(values, len(layout.couplers)),
+        **kwargs
+    )
+
+
+@pytest.mark.parametrize("code_task", ["surface_code:rotated_memory_x", "toric_code:unrotated_memory_z"])
+def test_uniform_heterogeneous_noise_matches_uniform_noise(code_task: str) -> None:
+    params = _heterogeneous_params(code_task, [0.001])
+    expected = generate_circuit(code_task, distance=3, rounds=3, after_clifford_depolarization=0.001,
+                                before_round_data_depolarization=0.001, before_measure_flip_probability=0.001,
+                                after_reset_flip_probability=0.001)
+    assert generate_surface_or_toric_code_circuit_from_params(params) == expected
+
+
+@pytest.mark.parametrize("code_task", ["surface_code:rotated_memory_z", "surface_code:unrotated_memory_x"])
+def test_heterogeneous_noise_is_applied_per_target(code_task: str) -> None:
+    values = [0, 0.001, 0.002, 0.003]
+    params = _heterogeneous_params(code_task, values, seed=1)
+    circuit = generate_surface_or_toric_code_circuit_from_params(params)
+    coupler_probability = {tuple(sorted(pair)): p for pair, p in zip(
+        params.couplers.tolist(), params.coupler_after_clifford_depolarization.tolist())}
+    instructions = list(circuit.flattened())
+    noise = {"DEPOLARIZE1", "DEPOLARIZE2", "X_ERROR", "Z_ERROR"}
+    for k, instruction in enumerate(instructions):
+        name = instruction.name
+        targets = [t.value for t in instruction.targets_copy()]
+        p = instruction.gate_args_copy()[0] if name in noise else None
+        previous = next((i.name for i in reversed(instructions[:k]) if i.name not in noise), None)
+        following = next((i.name for i in instructions[k + 1:] if i.name not in noise), None)
+        if name == "DEPOLARIZE2":
+            for pair in zip(targets[::2], targets[1::2]):
+                assert coupler_probability[tuple(sorted(pair))] == p
+        elif name == "DEPOLARIZE1":
+            per_qubit = (params.qubit_after_clifford_depolarization if previous == "H"
+                         else params.qubit_before_round_data_depolarization)
+            assert set(per_qubit[targets].tolist()) == {p}
+        elif name in ("X_ERROR", "Z_ERROR"):
+            per_qubit = (params.qubit_before_measure_flip_probability if following.startswith("M")
+                         else params.qubit_after_reset_flip_probability)
+            assert set(per_qubit[targets].tolist()) == {p}
+        if p is not None:
+            # Targets with zero probability are left out.
+            assert p > 0
+
+
+def test_heterogeneous_noise_hash() -> None:
+    a = _heterogeneous_params("surface_code:rotated_memory_x", [0.001, 0.002], seed=1)
+    b = _heterogeneous_params("surface_code:rotated_memory_x", [0.001, 0.002], seed=1)
+    c = _heterogeneous_params("surface_code:rotated_memory_x", [0.001, 0.002], seed=2)
+    assert a.content_hash() == b.content_hash() != c.content_hash()
+    with pytest.raises(ValueError):
+        HeterogeneousNoiseParameters(code_name="surface_code", task="rotated_memory_x", rounds=1, distance=3,
+                                     couplers=np.zeros((2, 2), dtype=int))
+
+
+@pytest.mark.parametrize("rounds", [1, 2, 3, 10])
+@pytest.mark.parametrize("code_task", ["surface_code:rotated_memory_x", "toric_code:unrotated_memory_z"])
+def test_write_circuit_matches_generate_circuit(code_task: str, rounds: int, tmp_path) -> None:
+    kwargs = dict(distance=3, rounds=rounds, after_clifford_depolarization=0.0012345678,
+                  before_round_data_depolarization=0.002, before_measure_flip_probability=0.003,
+                  after_reset_flip_probability=0.004, exclude_other_basis_detectors=True)
+    expected = generate_circuit(code_task, **kwargs)
+    out = io.StringIO()
+    write_circuit(code_task, out, **kwargs)
+    assert stim.Circuit(out.getvalue()) == expected
+    assert ("REPEAT" in out.getvalue()) == (rounds > 2)
+    write_circuit(code_task, tmp_path / "circuit.stim", **kwargs)
+    assert stim.Circuit.from_file(str(tmp_path / "circuit.stim")) == expected
+
+
+def test_write_circuit_from_heterogeneous_params() -> None:
+    params = _heterogeneous_params("surface_code:rotated_memory_z", [0.0011111111, 0.002, 0.0])
+    out = io.StringIO()
+    write_circuit_from_params(params, out)
+    assert stim.Circuit(out.getvalue()) == generate_surface_or_toric_code_circuit_from_params(params)
+
+
+@pytest.mark.parametrize("code_task", [
+    "surface_code:rotated_memory_x",
+    "surface_code:unrotated_memory_z",
+    "toric_code:unrotated_memory_x",
+])
+def test_patches_are_disjoint_copies(code_task: str) -> None:
+    kwargs = dict(distance=3, rounds=3, after_clifford_depolarization=0.001, before_measure_flip_probability=0.002)
+    single = generate_circuit(code_task, **kwargs)
+    tiled = generate_circuit(code_task, patches=3, **kwargs)
+    assert tiled.num_detectors == 3 * single.num_detectors
+    assert tiled.num_observables == 3
+    assert tiled.detector_error_model().num_errors == 3 * single.detector_error_model().num_errors
+
+    # Each copy has its own qubits, and detector coordinates shifted along x.
+    coords = tiled.get_final_qubit_coordinates()
+    assert len(coords) == 3 * len(single.get_final_qubit_coordinates())
+    assert len(set(map(tuple, coords.values()))) == len(coords)
+    metadata = generate_detector_metadata(code_task, patches=3, **kwargs)
+    detector_coords = tiled.get_detector_coordinates()
+    assert all(detector_coords[k] == [metadata["x"][k], metadata["y"][k], metadata["round"][k]]
+               for k in range(len(metadata)))
+
+    # Every error only flips detectors and observables of one copy.
+    detector_patch = metadata["qubit"] // (max(single.get_final_qubit_coordinates()) + 1)
+    for error in tiled.detector_error_model().flattened():
+        if error.type == "error":
+            patches = {detector_patch[t.val] if t.is_relative_detector_id() else t.val
+                       for t in error.targets_copy() if not t.is_separator()}
+            assert len(patches) == 1
+
+
+def test_single_patch_keeps_hash() -> None:
+    params = _params_from_code_task("surface_code:rotated_memory_x", rounds=3, distance=3)
+    assert "patches" not in params.canonical_json()
+    tiled = _params_from_code_task("surface_code:rotated_memory_x", rounds=3, distance=3, patches=2)
+    assert tiled.content_hash() != params.content_hash()
+    assert generate_fragments("surface_code:rotated_memory_x", distance=3, patches=2).with_rounds(3) == \
+        generate_surface_or_toric_code_circuit_from_params(tiled)
+    with pytest.raises(ValueError):
+        generate_circuit("surface_code:rotated_memory_x", rounds=3, distance=3, patches=0)
+
+
+def test_numpy_probabilities() -> None:
+    circuit = generate_circuit(
+        "surface_code:rotated_memory_z",
+        rounds=3,
+        distance=3,
+        after_clifford_depolarization=np.float32(0.001),
+        before_round_data_depolarization=np.float64(0.002),
+        before_measure_flip_probability=np.float64(0.003),
+        after_reset_flip_probability=np.float32(0.004)
+    )
+    expected = stim.Circuit.generated(
+        "surface_code:rotated_memory_z",
+        rounds=3,
+        distance=3,
+        after_clifford_depolarization=float(np.float32(0.001)),
+        before_round_data_depolarization=0.002,
+        before_measure_flip_probability=0.003,
+        after_reset_flip_probability=float(np.float32(0.004))
+    )
+    assert circuit == expected